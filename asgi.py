@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, Optional
+from a2wsgi import WSGIMiddleware
+from loguru import logger
+
+from main import SERVER_TIMING, app as flask_app, openai_handler, sse_event
+from src.utils.admission import AdmissionError
+from src.utils.event_loop import get_background_loop
+from src.utils.resilience import TurnFailedError, friendly_error
+from src.utils.timings import server_timing_header, start_timings
+
+class AsyncChatApp:
+    """
+    ASGI application for serving under uvicorn workers.
+
+    /api/chat and /api/chat/stream are handled natively: they await the
+    OpenAIHandler coroutines on the server's event loop, so an idle chat costs
+    a coroutine instead of a blocked worker. Every other route is served by
+    the Flask app through a thread pool.
+
+    The native routes bypass Flask's request hooks: they add Server-Timing
+    themselves, but are not covered by request profiling, since a profile of
+    the shared event loop would mix every request in flight.
+    """
+
+    def __init__(self, wsgi_app, wsgi_workers: int = 10):
+        self.flask_app = wsgi_app
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=wsgi_workers)
+        self.session_serializer = wsgi_app.session_interface.get_signing_serializer(wsgi_app)
+        self.routes = {
+            ("POST", "/api/chat"): self.api_chat,
+            ("POST", "/api/chat/stream"): self.api_chat_stream,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http":
+            route = self.routes.get((scope["method"], scope["path"]))
+            if route is not None:
+                await route(scope, receive, send)
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Sync code (Flask views in the thread pool) submits to the server's loop
+                get_background_loop().adopt(asyncio.get_running_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _session_user(self, scope) -> Optional[Dict[str, Any]]:
+        """Read the logged-in user from Flask's signed session cookie."""
+        cookie_name = self.flask_app.config["SESSION_COOKIE_NAME"]
+        for name, value in scope.get("headers", []):
+            if name != b"cookie":
+                continue
+            for part in value.decode("latin-1").split(";"):
+                key, _, cookie = part.strip().partition("=")
+                if key == cookie_name and cookie:
+                    try:
+                        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+                        return self.session_serializer.loads(cookie, max_age=max_age).get("user")
+                    except Exception:
+                        return None
+        return None
+
+    @staticmethod
+    async def _read_message(receive) -> str:
+        """Read the JSON request body and return its stripped `message` field."""
+        body = b""
+        while True:
+            event = await receive()
+            body += event.get("body", b"")
+            if not event.get("more_body"):
+                break
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        return data.get("message", "").strip() if isinstance(data, dict) else ""
+
+    @staticmethod
+    async def _send_json(send, status: int, data: dict, headers: Optional[list] = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + (headers or []),
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _start_turn(self, scope, receive, send):
+        """Validate the request; None if a response was sent."""
+        user = self._session_user(scope)
+        if user is None:
+            await self._send_json(send, 401, {"error": "Unauthorized"})
+            return None
+        message_text = await self._read_message(receive)
+        if not message_text:
+            await self._send_json(send, 400, {"error": "Empty message"})
+            return None
+        try:
+            # Reads the usage database for the quota; keep that off the event loop
+            await asyncio.to_thread(openai_handler.check_admission, user["id"])
+        except AdmissionError as e:
+            await self._send_admission_error(send, e)
+            return None
+        return user, message_text
+
+    async def _send_admission_error(self, send, error: AdmissionError) -> None:
+        await self._send_json(
+            send,
+            error.status_code,
+            {"error": str(error)},
+            headers=[(b"retry-after", str(error.retry_after).encode())],
+        )
+
+    async def api_chat(self, scope, receive, send):
+        started = time.perf_counter()
+        timings = start_timings() if SERVER_TIMING else None
+        turn = await self._start_turn(scope, receive, send)
+        if turn is None:
+            return
+        user, message_text = turn
+        try:
+            response = await openai_handler.aprocess_message(user["id"], message_text)
+        except AdmissionError as e:
+            await self._send_admission_error(send, e)
+            return
+        except TurnFailedError as e:
+            await self._send_json(send, e.status_code, {"error": str(e)})
+            return
+        headers = []
+        if timings is not None:
+            timings["total"] = (time.perf_counter() - started) * 1000
+            headers.append((b"server-timing", server_timing_header(timings).encode()))
+        await self._send_json(send, 200, {"response": response}, headers=headers)
+
+    async def api_chat_stream(self, scope, receive, send):
+        started = time.perf_counter()
+        timings = start_timings() if SERVER_TIMING else None
+        turn = await self._start_turn(scope, receive, send)
+        if turn is None:
+            return
+        user, message_text = turn
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+
+        # Stop generating (and spending tokens) if the client goes away
+        stream_task = asyncio.current_task()
+        streaming = True
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            # The disconnect may arrive once the response is complete
+            if streaming and not stream_task.done():
+                stream_task.cancel()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            full_response = ""
+            try:
+                async for delta in openai_handler.astream_message(user["id"], message_text):
+                    full_response += delta
+                    await self._send_event(send, sse_event("delta", {"delta": delta}))
+            except AdmissionError as e:
+                await self._send_event(send, sse_event("error", {"error": str(e), "status": e.status_code}))
+            except Exception as e:
+                logger.error(f"Error streaming message: {str(e)}")
+                await self._send_event(send, sse_event("error", {"error": friendly_error(e)}))
+            else:
+                done = {"response": full_response, "timestamp": datetime.now().isoformat()}
+                # Sent with the last event, since the headers went out before the turn ran
+                if timings is not None:
+                    timings["total"] = (time.perf_counter() - started) * 1000
+                    done["timings"] = timings
+                await self._send_event(send, sse_event("done", done))
+            await send({"type": "http.response.body", "body": b""})
+        except asyncio.CancelledError:
+            logger.info(f"Client disconnected during stream for user {user['id']}")
+        finally:
+            streaming = False
+            watcher.cancel()
+
+    @staticmethod
+    async def _send_event(send, event: str) -> None:
+        await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+
+
+app = AsyncChatApp(flask_app, wsgi_workers=int(os.getenv("ASGI_WSGI_WORKERS", "10")))
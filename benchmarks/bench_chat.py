@@ -0,0 +1,306 @@
+"""
+End-to-end benchmark of the chat endpoints.
+
+Drives login, /chat and /api/chat on a running server with a fixed number of
+concurrent clients, and reports throughput, latency percentiles, time to first
+byte and the per-stage breakdown from the Server-Timing header (or, for the
+stream, from the timings in its final "done" event). Results are saved as JSON
+so runs on different commits can be compared.
+
+Start the server against the mock LLM backend, with stage timings enabled:
+
+    LLM_BACKEND=mock SERVER_TIMING=1 gunicorn --bind 0.0.0.0:5000 main:app
+
+then run for example:
+
+    python benchmarks/bench_chat.py --url http://localhost:5000 --concurrency 20 --requests 500
+    python benchmarks/bench_chat.py --compare benchmarks/results/<previous run>.json
+
+Chat scenarios log in by signing a Flask session cookie with the server's
+FLASK_SECRET_KEY, so they need no Supabase account. The login scenario posts
+real credentials (--email/--password) and is skipped without them.
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+from flask import Flask
+
+SCENARIOS = ("login", "chat_page", "chat_post", "api_chat", "api_chat_stream")
+
+MESSAGES = [
+    "Como ligar o RPD?",
+    "O NeuroSpa mostra uma mensagem de erro ao iniciar",
+    "Como atualizar o firmware do PcZapper?",
+    "Qual a frequência recomendada no Colorgen?",
+    "Meu aparelho não liga, o que faço?",
+    "Quanto tempo dura uma sessão?",
+]
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+class Sample:
+    """Timings of one request, in milliseconds."""
+
+    def __init__(self, status: int, latency: float, ttfb: float, stages: Dict[str, float]):
+        self.status = status
+        self.latency = latency
+        self.ttfb = ttfb
+        self.stages = stages
+
+
+def session_cookie(secret_key: str, user_id: str) -> str:
+    """Sign a Flask session cookie for a benchmark user, as the login view would."""
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({"user": {"id": user_id, "email": f"{user_id}@bench.local"}})
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Parse a Server-Timing header into {stage: milliseconds}."""
+    stages: Dict[str, float] = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                try:
+                    stages[name] = float(value)
+                except ValueError:
+                    pass
+    return stages
+
+def parse_done_timings(body: str) -> Dict[str, float]:
+    """Get the stage timings from the "done" event of a Server-Sent Events stream."""
+    for message in body.split("\n\n"):
+        lines = message.strip().split("\n")
+        if lines[0] == "event: done" and len(lines) > 1 and lines[1].startswith("data: "):
+            try:
+                timings = json.loads(lines[1][len("data: "):]).get("timings") or {}
+            except ValueError:
+                return {}
+            return {name: float(duration) for name, duration in timings.items()}
+    return {}
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+class ChatBenchmark:
+    """Runs the benchmark scenarios against one server."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.counter = 0
+
+    def _message(self) -> str:
+        self.counter += 1
+        message = MESSAGES[self.counter % len(MESSAGES)]
+        # A unique suffix defeats the response cache unless repeats are wanted
+        return message if self.args.repeat_messages else f"{message} (#{self.counter})"
+
+    def _request(self, scenario: str) -> Dict[str, Any]:
+        """Build the arguments of one request for a scenario."""
+        if scenario == "login":
+            return {"method": "POST", "url": "/", "data": {"email": self.args.email, "password": self.args.password}}
+        if scenario == "chat_page":
+            return {"method": "GET", "url": "/chat"}
+        if scenario == "chat_post":
+            return {"method": "POST", "url": "/chat", "data": {"message": self._message()}}
+        if scenario == "api_chat":
+            return {"method": "POST", "url": "/api/chat", "json": {"message": self._message()}}
+        return {"method": "POST", "url": "/api/chat/stream", "json": {"message": self._message()}}
+
+    async def _timed_request(self, client: httpx.AsyncClient, scenario: str) -> Sample:
+        started = time.perf_counter()
+        ttfb = None
+        # A stream's timings come in its last event, so keep its body
+        chunks: List[bytes] = []
+        async with client.stream(**self._request(scenario)) as response:
+            async for chunk in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = (time.perf_counter() - started) * 1000
+                if scenario == "api_chat_stream":
+                    chunks.append(chunk)
+            latency = (time.perf_counter() - started) * 1000
+            if scenario == "api_chat_stream":
+                stages = parse_done_timings(b"".join(chunks).decode("utf-8", "replace"))
+            else:
+                stages = parse_server_timing(response.headers.get("server-timing"))
+            return Sample(
+                status=response.status_code,
+                latency=latency,
+                ttfb=ttfb if ttfb is not None else latency,
+                stages=stages,
+            )
+
+    async def _client_loop(self, scenario: str, client: httpx.AsyncClient, remaining: List[int], samples: List[Sample], errors: Dict[str, int]) -> None:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            try:
+                samples.append(await self._timed_request(client, scenario))
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    def _client(self, index: int) -> httpx.AsyncClient:
+        cookies = {}
+        if self.args.secret_key:
+            cookies["session"] = session_cookie(self.args.secret_key, f"bench-user-{index}")
+        return httpx.AsyncClient(base_url=self.args.url, cookies=cookies, timeout=self.args.timeout)
+
+    async def run_scenario(self, scenario: str) -> Dict[str, Any]:
+        """Run one scenario with `concurrency` clients and summarize it."""
+        clients = [self._client(i) for i in range(self.args.concurrency)]
+        try:
+            # Warm up connections, templates and the server's caches
+            await self._client_loop(scenario, clients[0], [self.args.warmup], [], {})
+            samples: List[Sample] = []
+            errors: Dict[str, int] = {}
+            remaining = [self.args.requests]
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                self._client_loop(scenario, client, remaining, samples, errors)
+                for client in clients
+            ])
+            elapsed = time.perf_counter() - started
+        finally:
+            await asyncio.gather(*[client.aclose() for client in clients])
+
+        statuses: Dict[str, int] = {}
+        for sample in samples:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+        ok = [s for s in samples if s.status < 400]
+        stage_names = sorted({name for s in ok for name in s.stages})
+        return {
+            "requests": len(samples),
+            "concurrency": self.args.concurrency,
+            "elapsed_seconds": elapsed,
+            "throughput_rps": len(ok) / elapsed if elapsed else None,
+            "statuses": statuses,
+            "errors": errors,
+            "latency_ms": summarize([s.latency for s in ok]),
+            "ttfb_ms": summarize([s.ttfb for s in ok]),
+            "stages_ms": {name: summarize([s.stages[name] for s in ok if name in s.stages]) for name in stage_names},
+        }
+
+    async def run(self) -> Dict[str, Any]:
+        results: Dict[str, Any] = {}
+        for scenario in self.args.scenarios:
+            if scenario == "login" and not (self.args.email and self.args.password):
+                print("Skipping login: pass --email and --password (or BENCH_EMAIL/BENCH_PASSWORD)")
+                continue
+            print(f"Running {scenario} ({self.args.requests} requests, concurrency {self.args.concurrency})...")
+            results[scenario] = await self.run_scenario(scenario)
+            print_scenario(scenario, results[scenario])
+        return results
+
+
+def fmt(value: Optional[float]) -> str:
+    return f"{value:9.1f}" if value is not None else "        -"
+
+def print_scenario(name: str, result: Dict[str, Any]) -> None:
+    print(f"  {name}: {fmt(result['throughput_rps'])} req/s  statuses={result['statuses']}  errors={result['errors']}")
+    print(f"    {'':22}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = [("latency", result["latency_ms"]), ("ttfb", result["ttfb_ms"])]
+    rows += [(f"stage {stage}", stats) for stage, stats in result["stages_ms"].items()]
+    for label, stats in rows:
+        print(f"    {label:22}{fmt(stats['mean'])}{fmt(stats['p50'])}{fmt(stats['p95'])}{fmt(stats['p99'])}")
+
+def print_comparison(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    """Print throughput and latency changes relative to a previous run."""
+    print(f"\nCompared with {baseline['meta'].get('git_commit')} ({baseline['meta'].get('started_at')}):")
+    for name, result in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        for label, old, new in (
+            ("throughput", before["throughput_rps"], result["throughput_rps"]),
+            ("p50", before["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            ("p95", before["latency_ms"]["p95"], result["latency_ms"]["p95"]),
+            ("p99", before["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+        ):
+            if old and new is not None:
+                print(f"  {name:16}{label:11}{fmt(old)} -> {fmt(new)}  ({(new - old) / old * 100:+.1f}%)")
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the chat endpoints of a running server.")
+    parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the server")
+    parser.add_argument("--scenarios", default="login,chat_page,api_chat", type=lambda v: v.split(","),
+                        help=f"Comma-separated scenarios among: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="Unrecorded requests before each scenario")
+    parser.add_argument("--timeout", type=float, default=120, help="Request timeout, in seconds")
+    parser.add_argument("--secret-key", default=os.getenv("FLASK_SECRET_KEY", "supersecretkey"),
+                        help="Server's FLASK_SECRET_KEY, to sign session cookies")
+    parser.add_argument("--email", default=os.getenv("BENCH_EMAIL"), help="Account for the login scenario")
+    parser.add_argument("--password", default=os.getenv("BENCH_PASSWORD"), help="Password for the login scenario")
+    parser.add_argument("--repeat-messages", action="store_true",
+                        help="Reuse identical messages (measures the response cache)")
+    parser.add_argument("--label", default="", help="Free-form description saved with the results")
+    parser.add_argument("--output", type=Path, help="Results file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", type=Path, help="Previous results file to compare with")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    started_at = datetime.now()
+    commit = git_commit()
+    scenarios = asyncio.run(ChatBenchmark(args).run())
+    results = {
+        "meta": {
+            "started_at": started_at.isoformat(),
+            "git_commit": commit,
+            "label": args.label,
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "repeat_messages": args.repeat_messages,
+        },
+        "scenarios": scenarios,
+    }
+    output = args.output or RESULTS_DIR / f"{started_at:%Y%m%d-%H%M%S}-{commit or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {output}")
+    if args.compare:
+        print_comparison(json.loads(args.compare.read_text()), results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,18 @@
+import os
+import shutil
+
+# Prometheus metrics are shared between workers through files in
+# PROMETHEUS_MULTIPROC_DIR; see src/utils/metrics.py.
+
+def on_starting(server):
+    """Start every deploy with an empty metrics directory."""
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
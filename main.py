@@ -1,16 +1,37 @@
 import os
+import hmac
+import json
+import time
+import uuid
+import random
+from typing import Optional
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, Response, g, render_template, request, redirect, url_for, session, flash
+from loguru import logger
 from src.utils.logger import setup_logger
 from src.utils.supabase_client import SupabaseClient
 from src.utils.openai_handler import OpenAIHandler
+from src.utils.admission import AdmissionError
+from src.utils.conversation_store import get_conversation_store
 from src.utils.chat_history import ChatHistory
+from src.utils.chat_jobs import ChatJobQueue
+from src.utils.resilience import TurnFailedError, friendly_error
+from src.utils.event_loop import get_background_loop
+from src.utils.metrics import render_metrics
+from src.utils.profiling import RequestProfile
+from src.utils.usage import UsageStore
+from src.utils.search_index import get_search_index
+from src.utils.timings import get_timings, server_timing_header, start_timings
 from datetime import datetime
+from pathlib import Path
 
 load_dotenv()
 
 # Verify required environment variables
-required_vars = ["SUPABASE_URL", "SUPABASE_KEY", "OPENAI_API_KEY"]
+required_vars = ["SUPABASE_URL", "SUPABASE_KEY"]
+# The mock LLM backend runs offline, without an API key
+if os.getenv("LLM_BACKEND", "agents").lower() != "mock":
+    required_vars.append("OPENAI_API_KEY")
 missing_vars = [var for var in required_vars if not os.getenv(var)]
 
 if missing_vars:
@@ -25,6 +46,57 @@ setup_logger()
 
 supabase = SupabaseClient()
 openai_handler = OpenAIHandler()
+conversations = get_conversation_store()
+
+# Number of messages rendered per page of chat history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = 200
+
+# Longest a client may long-poll a chat job, in seconds
+CHAT_JOB_MAX_WAIT = 30
+
+# Shared secret for the admin endpoints, sent in the X-Admin-Token header (unset disables them)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def run_chat_turn(user_id: str, message_text: str, turn_timestamp: str) -> str:
+    """Run a queued chat turn; the handler saves the question (with the job's timestamp) and the reply."""
+    return openai_handler.process_message(user_id, message_text, timestamp=turn_timestamp)
+
+def recover_chat_turn(user_id: str, message_text: str, turn_timestamp: str) -> Optional[str]:
+    """Find the reply to a queued turn in the history, or None if the turn never finished."""
+    messages = ChatHistory(user_id).get_messages_between(start=turn_timestamp)
+    for i, message in enumerate(messages):
+        if message["role"] == "user" and message["timestamp"] == turn_timestamp and message["content"] == message_text:
+            # The question is only ever saved together with its reply
+            return next((reply["content"] for reply in messages[i + 1:] if reply["role"] == "assistant"), None)
+    return None
+
+chat_jobs = ChatJobQueue(
+    run_chat_turn,
+    db_path=Path(os.getenv("CHAT_JOB_DB", "chat_history/jobs.db")),
+    workers=int(os.getenv("CHAT_JOB_WORKERS", "4")),
+    ttl_seconds=float(os.getenv("CHAT_JOB_TTL_SECONDS", "3600")),
+    recover_turn=recover_chat_turn,
+)
+
+# Report per-stage timings of each request in a Server-Timing header, or in
+# the final event of a stream (used by benchmarks)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+@app.before_request
+def start_request_timings():
+    if SERVER_TIMING:
+        g.request_started = time.perf_counter()
+        start_timings()
+
+@app.after_request
+def add_server_timing(response):
+    timings = get_timings() if SERVER_TIMING else None
+    # Headers of a stream go out before its stages run; its timings are sent in the done event
+    if timings is not None and not response.is_streamed:
+        timings["total"] = (time.perf_counter() - g.request_started) * 1000
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
 
 @app.route("/", methods=["GET", "POST"])
 def login():
@@ -76,17 +148,30 @@ def chat():
     if "user" not in session:
         return redirect(url_for("login"))
     user = session["user"]
-    chat_history = ChatHistory(user["id"])
+    # A failed turn saves nothing, so its message is put back in the form
+    draft = ""
+    status = 200
     if request.method == "POST":
         message_text = request.form.get("message", "").strip()
         if message_text:
-            timestamp = datetime.now().isoformat()
-            chat_history.add_message("user", message_text, timestamp)
-            response = openai_handler.process_message(user["id"], message_text)
-            timestamp = datetime.now().isoformat()
-            chat_history.add_message("assistant", response, timestamp)
-    messages = chat_history.get_messages()
-    return render_template("chat.html", user=user, messages=messages)
+            try:
+                openai_handler.check_admission(user["id"])
+                openai_handler.process_message(user["id"], message_text)
+            except AdmissionError as e:
+                return str(e), e.status_code, {"Retry-After": str(e.retry_after)}
+            except TurnFailedError as e:
+                flash(str(e), "danger")
+                draft = message_text
+                status = e.status_code
+    page = conversations.page(user["id"], HISTORY_PAGE_SIZE)
+    return render_template(
+        "chat.html",
+        user=user,
+        messages=page["messages"],
+        has_more=page["has_more"],
+        next_before=page["next_before"],
+        draft=draft,
+    ), status
 
 from flask import jsonify
 
@@ -95,6 +180,10 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
+def admission_error_response(error: AdmissionError):
+    """JSON response for a turn rejected by admission control."""
+    return jsonify({"error": str(error)}), error.status_code, {"Retry-After": str(error.retry_after)}
+
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
     if "user" not in session:
@@ -104,13 +193,206 @@ def api_chat():
     message_text = data.get("message", "").strip() if data else ""
     if not message_text:
         return jsonify({"error": "Empty message"}), 400
-    chat_history = ChatHistory(user["id"])
-    timestamp = datetime.now().isoformat()
-    chat_history.add_message("user", message_text, timestamp)
-    response = openai_handler.process_message(user["id"], message_text)
-    timestamp = datetime.now().isoformat()
-    chat_history.add_message("assistant", response, timestamp)
+    try:
+        openai_handler.check_admission(user["id"])
+        response = openai_handler.process_message(user["id"], message_text)
+    except AdmissionError as e:
+        return admission_error_response(e)
+    except TurnFailedError as e:
+        return jsonify({"error": str(e)}), e.status_code
     return jsonify({"response": response})
 
+def job_response(job: dict) -> dict:
+    """Public view of a chat job."""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "response": job["response"],
+        "error": job["error"],
+        "status_url": url_for("api_chat_job", job_id=job["id"]),
+    }
+
+@app.route("/api/chat/jobs", methods=["POST"])
+def api_chat_jobs():
+    if "user" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    user = session["user"]
+    data = request.get_json()
+    message_text = data.get("message", "").strip() if data else ""
+    if not message_text:
+        return jsonify({"error": "Empty message"}), 400
+    try:
+        openai_handler.check_admission(user["id"])
+    except AdmissionError as e:
+        return admission_error_response(e)
+    # The handler saves the question with its answer once a worker has run the turn
+    job = chat_jobs.submit(user["id"], message_text)
+    return jsonify(job_response(job)), 202, {"Location": url_for("api_chat_job", job_id=job["id"])}
+
+@app.route("/api/chat/jobs/<job_id>", methods=["GET"])
+def api_chat_job(job_id):
+    if "user" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    user = session["user"]
+    wait = max(0.0, min(request.args.get("wait", 0, type=float), CHAT_JOB_MAX_WAIT))
+    job = chat_jobs.wait(job_id, wait) if wait else chat_jobs.get(job_id)
+    if job is None or job["user_id"] != user["id"]:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_response(job))
+
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    if "user" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    user = session["user"]
+    limit = request.args.get("limit", HISTORY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    before = request.args.get("before") or None
+    return jsonify(conversations.page(user["id"], limit, before))
+
+def is_admin_request() -> bool:
+    """Whether the request carries the admin token."""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.route("/api/history/search", methods=["GET"])
+def api_history_search():
+    # Users search their own history; support staff (admin token) search everyone's
+    if is_admin_request():
+        user_id = request.args.get("user_id") or None
+    elif "user" in session:
+        user_id = session["user"]["id"]
+    else:
+        return jsonify({"error": "Unauthorized"}), 401
+    search_index = get_search_index()
+    if search_index is None:
+        return jsonify({"error": "Search is disabled"}), 404
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+    limit = max(1, min(request.args.get("limit", 20, type=int), 100))
+    offset = max(0, request.args.get("offset", 0, type=int))
+    return jsonify(search_index.search(query, user_id=user_id, limit=limit, offset=offset))
+
+@app.route("/api/admin/usage", methods=["GET"])
+def admin_usage():
+    if not is_admin_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    group_by = [group for group in request.args.get("group_by", "user").split(",") if group]
+    if not group_by or any(group not in UsageStore.GROUPS for group in group_by):
+        return jsonify({"error": f"group_by must be among: {', '.join(UsageStore.GROUPS)}"}), 400
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    usage = openai_handler.usage_store.summary(
+        group_by,
+        start=request.args.get("start") or None,
+        end=request.args.get("end") or None,
+        user_id=request.args.get("user_id") or None,
+        limit=limit,
+    )
+    return jsonify({"group_by": group_by, "usage": usage})
+
+@app.route("/api/admin/cache/invalidate", methods=["POST"])
+def admin_invalidate_cache():
+    if not is_admin_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    specialist = data.get("specialist") or None
+    vector_store_id = data.get("vector_store_id") or None
+    if specialist and vector_store_id:
+        return jsonify({"error": "Give either specialist or vector_store_id, not both"}), 400
+    if vector_store_id:
+        removed = openai_handler.invalidate_vector_store(vector_store_id)
+    elif specialist is None or specialist in openai_handler.especialistas:
+        removed = openai_handler.invalidate_cache(specialist)
+    else:
+        return jsonify({"error": f"Unknown specialist: {specialist}"}), 404
+    return jsonify({"removed": removed})
+
+# Opt-in profiling of single requests: an X-Profile header with the admin token,
+# or a random share of requests. The hooks are not installed otherwise.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+def start_request_profile():
+    wanted = bool(request.headers.get("X-Profile")) and is_admin_request()
+    if not wanted and not (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return
+    profile = RequestProfile(
+        uuid.uuid4().hex[:16],
+        f"{request.method} {request.path}",
+        loop_thread=get_background_loop().thread_ident,
+    )
+    profile.start()
+    g.profile = profile
+
+def finish_request_profile(response):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        response.headers["X-Profile-Id"] = profile.request_id
+        # Streamed responses are only done once the body has been sent
+        response.call_on_close(profile.stop)
+    return response
+
+def abandon_request_profile(error=None):
+    # after_request is skipped when the view raised
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+
+if ADMIN_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(abandon_request_profile)
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/api/chat/stream", methods=["POST"])
+def api_chat_stream():
+    if "user" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    user = session["user"]
+    data = request.get_json()
+    message_text = data.get("message", "").strip() if data else ""
+    if not message_text:
+        return jsonify({"error": "Empty message"}), 400
+    try:
+        openai_handler.check_admission(user["id"])
+    except AdmissionError as e:
+        return admission_error_response(e)
+
+    timings = get_timings() if SERVER_TIMING else None
+    request_started = g.request_started if timings is not None else None
+
+    def generate():
+        full_response = ""
+        try:
+            for delta in openai_handler.stream_message(user["id"], message_text):
+                full_response += delta
+                yield sse_event("delta", {"delta": delta})
+        except AdmissionError as e:
+            yield sse_event("error", {"error": str(e), "status": e.status_code})
+            return
+        except Exception as e:
+            logger.error(f"Error streaming message: {str(e)}")
+            yield sse_event("error", {"error": friendly_error(e)})
+            return
+        done = {"response": full_response, "timestamp": datetime.now().isoformat()}
+        if timings is not None:
+            timings["total"] = (time.perf_counter() - request_started) * 1000
+            done["timings"] = timings
+        yield sse_event("done", done)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,163 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from loguru import logger
+
+from src.utils.metrics import ADMISSION_REJECTED, UPSTREAM_IN_FLIGHT, UPSTREAM_WAITING
+
+class AdmissionError(Exception):
+    """Raised when a chat turn is rejected to protect the upstream LLM."""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class OverloadedError(AdmissionError):
+    """Too many chat turns are running or waiting across all users."""
+
+    status_code = 503
+
+
+class UserBusyError(AdmissionError):
+    """The user already has the maximum number of chat turns in flight."""
+
+    status_code = 429
+
+
+class QuotaExceededError(AdmissionError):
+    """The user has used up their daily token quota."""
+
+    status_code = 429
+
+
+class _Timeout:
+    """
+    Minimal asyncio.timeout for Python 3.10: cancel the current task after
+    `seconds` and raise asyncio.TimeoutError instead of CancelledError.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expired = False
+
+    async def __aenter__(self) -> "_Timeout":
+        self._task = asyncio.current_task()
+        self._handle = asyncio.get_running_loop().call_later(max(self.seconds, 0), self._expire)
+        return self
+
+    def _expire(self) -> None:
+        self.expired = True
+        self._task.cancel()
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self._handle.cancel()
+        if self.expired and exc_type is asyncio.CancelledError:
+            raise asyncio.TimeoutError() from exc
+        return False
+
+
+def _timeout(seconds: float):
+    """asyncio.timeout where available (Python 3.11+), else the 3.10 fallback."""
+    if hasattr(asyncio, "timeout"):
+        return asyncio.timeout(seconds)
+    return _Timeout(seconds)
+
+
+class AdmissionController:
+    """
+    Admission control for upstream LLM calls.
+
+    A global semaphore caps concurrent upstream calls; callers beyond it wait
+    in a bounded queue for at most `queue_timeout` seconds, and are rejected
+    immediately once the queue is full. Each user may also only have
+    `max_per_user` turns in flight. Limits are per process, and all callers
+    must run on the same event loop.
+    """
+
+    def __init__(self, max_concurrent: int = 16, max_queue: int = 64, max_per_user: int = 2, queue_timeout: float = 15):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._per_user: Dict[str, int] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Get the semaphore for the running loop (recreated if the loop changed)."""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+        return self._semaphore
+
+    def check(self, user_id: str) -> None:
+        """
+        Fail fast, without reserving anything, if a new turn would be rejected now.
+        Lets callers refuse a request before doing any work for it.
+        """
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self._reject(UserBusyError("You already have a message being answered. Please wait for it to finish.", retry_after=2))
+        if self.active >= self.max_concurrent and self.waiting >= self.max_queue:
+            self._reject(OverloadedError("The assistant is busy right now. Please try again in a few seconds."))
+
+    def _reject(self, error: AdmissionError) -> None:
+        self.rejected += 1
+        ADMISSION_REJECTED.labels(type(error).__name__).inc()
+        logger.warning(f"Admission rejected: {error} (active={self.active}, waiting={self.waiting})")
+        raise error
+
+    @asynccontextmanager
+    async def user_slot(self, user_id: str) -> AsyncIterator[None]:
+        """Hold one of the user's in-flight turns for the duration of the block."""
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self._reject(UserBusyError("You already have a message being answered. Please wait for it to finish.", retry_after=2))
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+    @asynccontextmanager
+    async def upstream_slot(self) -> AsyncIterator[None]:
+        """Hold a global upstream slot, waiting in the bounded queue if needed."""
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self._reject(OverloadedError("The assistant is busy right now. Please try again in a few seconds."))
+            self.waiting += 1
+            UPSTREAM_WAITING.inc()
+            # Unlike wait_for, acquiring in this task never loses a slot granted
+            # just as the timeout fires
+            acquired = False
+            try:
+                async with _timeout(self.queue_timeout):
+                    await semaphore.acquire()
+                    acquired = True
+            except BaseException as e:
+                if acquired:
+                    semaphore.release()
+                if isinstance(e, asyncio.TimeoutError):
+                    self._reject(OverloadedError("The assistant is busy right now. Please try again in a few seconds."))
+                raise
+            finally:
+                self.waiting -= 1
+                UPSTREAM_WAITING.dec()
+        else:
+            await semaphore.acquire()
+        self.active += 1
+        UPSTREAM_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            UPSTREAM_IN_FLIGHT.dec()
+            semaphore.release()
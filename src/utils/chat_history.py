@@ -1,64 +1,201 @@
 import os
-import json
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from loguru import logger
 
+from src.utils.timings import stage
+from src.utils.search_index import get_search_index
+from src.utils.history_storage import HistoryStorage, JsonHistoryStorage, JsonlHistoryStorage, SqliteHistoryStorage, WriteBehindHistoryStorage, page_cursor
+
+_storage: Optional[HistoryStorage] = None
+_storage_lock = threading.Lock()
+
+def get_history_storage() -> HistoryStorage:
+    """
+    Get the process-wide history storage backend.
+
+    The backend is selected with CHAT_HISTORY_BACKEND: "json" (default) keeps
+    one JSON document per user, "jsonl" uses the append-only line format
+    (archiving old messages in compressed segments once a file reaches
+    CHAT_HISTORY_SEGMENT_BYTES, if set) and "sqlite" stores everything in
+    one database (CHAT_HISTORY_DB).
+    With CHAT_HISTORY_WRITE_BEHIND=1 appends are buffered and written in the
+    background in batches (CHAT_HISTORY_FLUSH_BATCH messages or every
+    CHAT_HISTORY_FLUSH_INTERVAL seconds), until CHAT_HISTORY_MAX_PENDING
+    messages are waiting.
+    """
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = os.getenv("CHAT_HISTORY_BACKEND", "json").lower()
+            history_dir = Path(os.getenv("CHAT_HISTORY_DIR", "chat_history"))
+            if backend == "json":
+                _storage = JsonHistoryStorage(history_dir)
+            elif backend == "jsonl":
+                _storage = JsonlHistoryStorage(
+                    history_dir,
+                    fsync=os.getenv("CHAT_HISTORY_FSYNC", "never").lower(),
+                    fsync_interval=float(os.getenv("CHAT_HISTORY_FSYNC_INTERVAL", "1.0")),
+                    segment_bytes=int(os.getenv("CHAT_HISTORY_SEGMENT_BYTES", "0")),
+                )
+            elif backend == "sqlite":
+                db_path = Path(os.getenv("CHAT_HISTORY_DB", str(history_dir / "history.db")))
+                _storage = SqliteHistoryStorage(db_path, history_dir)
+            else:
+                raise ValueError(f"Unknown CHAT_HISTORY_BACKEND: {backend}")
+            if os.getenv("CHAT_HISTORY_WRITE_BEHIND", "0") == "1":
+                _storage = WriteBehindHistoryStorage(
+                    _storage,
+                    # Index messages once they are written, not while they are only buffered
+                    on_flush=index_messages,
+                    batch_size=int(os.getenv("CHAT_HISTORY_FLUSH_BATCH", "50")),
+                    flush_interval=float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "1.0")),
+                    max_pending=int(os.getenv("CHAT_HISTORY_MAX_PENDING", "10000")),
+                )
+                backend += " (write-behind)"
+            logger.info(f"Chat history backend: {backend}")
+        return _storage
+
+def index_messages(user_id: str, messages: List[Dict[str, Any]]) -> None:
+    """Add written messages to the search index, if enabled. Errors are logged, not raised."""
+    search_index = get_search_index()
+    if search_index is None:
+        return
+    try:
+        with stage("history_index"):
+            search_index.add_many(user_id, messages)
+    except Exception as e:
+        logger.error(f"Error indexing chat messages: {str(e)}")
+
 class ChatHistory:
     """
-    Manages chat history for users, saving to local JSON files.
+    Manages chat history for users, saving to local files.
     In a production app, this would use Supabase for storage.
     """
-    
+
     def __init__(self, user_id: str):
         self.user_id = user_id
-        self.history_dir = Path("chat_history")
-        self.history_file = self.history_dir / f"{user_id}.json"
-        
-        # Create history directory if it doesn't exist
-        self.history_dir.mkdir(exist_ok=True)
-        
-        # Create history file if it doesn't exist
-        if not self.history_file.exists():
-            self.history_file.write_text(json.dumps({"messages": []}))
-            
+        self.storage = get_history_storage()
+
+        # Create (or migrate) the user's history if needed
+        with stage("history_read"):
+            self.storage.ensure(user_id)
+
     def get_messages(self) -> List[Dict[str, Any]]:
         """Get all messages for the user."""
         try:
-            with open(self.history_file, "r") as f:
-                data = json.load(f)
-                return data.get("messages", [])
+            with stage("history_read"):
+                return self.storage.read(self.user_id)
         except Exception as e:
             logger.error(f"Error getting chat history: {str(e)}")
             return []
+
+    def get_recent_messages(self, limit: int) -> List[Dict[str, Any]]:
+        """Get the last `limit` messages for the user, oldest first."""
+        try:
+            with stage("history_read"):
+                return self.storage.tail(self.user_id, limit)
+        except Exception as e:
+            logger.error(f"Error getting recent chat history: {str(e)}")
+            return []
+
+    def get_page(self, limit: int, before: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get one page of the user's history, for cursor-based pagination.
+        
+        Args:
+            limit: Maximum number of messages in the page
+            before: Cursor from a previous page; None for the latest messages
             
-    def add_message(self, role: str, content: str, timestamp: str) -> None:
-        """Add a message to the user's history."""
+        Returns:
+            Dict with the page's `messages` (oldest first), `has_more` and the
+            `next_before` cursor to request the previous page
+        """
         try:
-            messages = self.get_messages()
+            # One extra message tells whether there is an older page
+            with stage("history_read"):
+                messages = self.storage.page(self.user_id, limit + 1, before)
+        except Exception as e:
+            logger.error(f"Error getting chat history page: {str(e)}")
+            messages = []
+        has_more = len(messages) > limit
+        messages = messages[-limit:] if limit > 0 else []
+        return {
+            "messages": messages,
+            "has_more": has_more,
+            "next_before": page_cursor(messages, before) if has_more and messages else None,
+        }
+
+    def get_messages_between(
+        self,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get the user's messages with start <= timestamp < end, oldest first.
+        
+        Args:
+            start: Inclusive lower bound as an ISO timestamp (None for no bound)
+            end: Exclusive upper bound as an ISO timestamp (None for no bound)
+            limit: Maximum number of messages, counted from the oldest
             
-            # Add new message
-            messages.append({
+        Returns:
+            The matching messages
+        """
+        try:
+            with stage("history_read"):
+                return self.storage.range(self.user_id, start, end, limit)
+        except Exception as e:
+            logger.error(f"Error getting chat history range: {str(e)}")
+            return []
+
+    def add_message(self, role: str, content: str, timestamp: str) -> None:
+        """Add a message to the user's history (and to the search index, if enabled)."""
+        try:
+            self.add_messages([{
                 "role": role,
                 "content": content,
                 "timestamp": timestamp
-            })
-            
-            # Save updated messages
-            with open(self.history_file, "w") as f:
-                json.dump({"messages": messages}, f, indent=2)
-                
-            logger.info(f"Added message to history for user {self.user_id}")
+            }])
+        except Exception:
+            # Already logged; unlike add_messages, this never raises
+            pass
+
+    def add_messages(self, messages: List[Dict[str, Any]]) -> Tuple[Optional[tuple], Optional[tuple]]:
+        """
+        Add several messages to the user's history with a single write (and to the search index, if enabled).
+
+        Returns:
+            The storage versions right before and after the write (see HistoryStorage.append_many_versioned)
+
+        Raises:
+            Exception: If the history could not be written
+        """
+        try:
+            with stage("history_write"):
+                versions = self.storage.append_many_versioned(self.user_id, messages)
+
+            logger.info(f"Added {len(messages)} messages to history for user {self.user_id}")
         except Exception as e:
-            logger.error(f"Error adding message to chat history: {str(e)}")
-            
+            logger.error(f"Error adding messages to chat history: {str(e)}")
+            raise
+
+        # Buffered storages index the messages when they flush them
+        if not self.storage.buffered:
+            index_messages(self.user_id, messages)
+        return versions
+
     def clear_history(self) -> None:
         """Clear the user's chat history."""
         try:
-            with open(self.history_file, "w") as f:
-                json.dump({"messages": []}, f)
-                
+            self.storage.clear(self.user_id)
+            search_index = get_search_index()
+            if search_index is not None:
+                search_index.clear(self.user_id)
+
             logger.info(f"Cleared history for user {self.user_id}")
         except Exception as e:
-            logger.error(f"Error clearing chat history: {str(e)}")
\ No newline at end of file
+            logger.error(f"Error clearing chat history: {str(e)}")
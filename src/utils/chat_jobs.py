@@ -0,0 +1,250 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from loguru import logger
+
+class ChatJobQueue:
+    """
+    Local job queue for chat turns that run in the background.
+
+    Jobs live in a SQLite database so that any gunicorn worker can report the
+    status of a job submitted to another one. Each process runs a pool of
+    worker threads that claim queued jobs and call
+    `run_turn(user_id, message, turn_timestamp)`. A user's jobs run one at a
+    time, in the order they were submitted, so each turn sees the previous
+    one in the history; a job fails if `run_turn` raises.
+
+    A job still running after `stale_seconds` (its worker died) is claimed
+    again. The turn keeps the timestamp given at its first claim, so
+    `recover_turn(user_id, message, turn_timestamp)`, if set, can look the
+    turn up in the history and return its reply instead of running it twice
+    (None if it never finished).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL,
+            response TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            turn_timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs (user_id, status);
+    """
+
+    POLL_INTERVAL = 0.25
+    # Longest idle workers (and waits on jobs run by other processes) go without polling
+    MAX_POLL_INTERVAL = 10.0
+
+    def __init__(
+        self,
+        run_turn: Callable[[str, str, str], str],
+        db_path: Path,
+        workers: int = 4,
+        ttl_seconds: float = 3600,
+        stale_seconds: float = 600,
+        recover_turn: Optional[Callable[[str, str, str], Optional[str]]] = None,
+    ):
+        self.run_turn = run_turn
+        self.recover_turn = recover_turn
+        self.db_path = db_path
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        # Notified when a job run by this process finishes
+        self._finished = threading.Condition()
+        self._pid: Optional[int] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's connection (one per thread, reopened after a fork)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(str(self.db_path), isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            # Set first: switching to WAL needs a lock that another connection may hold
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            self._migrate(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection) -> None:
+        """Add columns missing from a database created by an older version."""
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+        if "turn_timestamp" not in columns:
+            try:
+                connection.execute("ALTER TABLE jobs ADD COLUMN turn_timestamp TEXT")
+            except sqlite3.OperationalError:
+                # Added by another process in the meantime
+                pass
+
+    def _ensure_workers(self) -> None:
+        """Start this process's worker threads on first use."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"chat-job-worker-{i}", daemon=True).start()
+            logger.info(f"Started {self.workers} chat job workers (pid={self._pid})")
+
+    def submit(self, user_id: str, message: str) -> Dict[str, Any]:
+        """
+        Queue a chat turn.
+
+        Args:
+            user_id: ID of the user
+            message: User's message
+
+        Returns:
+            The new job
+        """
+        self._ensure_workers()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        connection = self._connect()
+        connection.execute(
+            "INSERT INTO jobs (id, user_id, message, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+            (job_id, user_id, message, now, now),
+        )
+        # Finished jobs are only kept long enough for clients to collect them
+        connection.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (now - self.ttl_seconds,),
+        )
+        with self._wakeup:
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Get a job by ID, or None if it does not exist."""
+        row = self._connect().execute(
+            "SELECT id, user_id, status, response, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Long-poll a job until it finishes or the timeout expires.
+
+        Args:
+            job_id: ID of the job
+            timeout: Maximum number of seconds to wait
+
+        Returns:
+            The job in its latest state, or None if it does not exist
+        """
+        deadline = time.monotonic() + timeout
+        interval = self.POLL_INTERVAL
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+                return job
+            # Woken as soon as a job finishes in this process; polling (less and
+            # less often) catches jobs finished by other processes
+            with self._finished:
+                self._finished.wait(min(interval, remaining))
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Atomically move the oldest queued (or stale running) job to running,
+        skipping users that already have a job running.
+
+        Returns:
+            The job's id, user_id, message and turn_timestamp, and whether it
+            was `reclaimed` from a worker that stopped; None if there is none
+        """
+        connection = self._connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stale_before = now - self.stale_seconds
+            row = connection.execute(
+                "SELECT id, user_id, message, status, turn_timestamp FROM jobs AS job "
+                "WHERE (status = 'queued' AND NOT EXISTS ("
+                "    SELECT 1 FROM jobs AS other WHERE other.user_id = job.user_id"
+                "    AND other.status = 'running' AND other.updated_at >= ?"
+                ")) OR (status = 'running' AND updated_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (stale_before, stale_before),
+            ).fetchone()
+            job = None
+            if row is not None:
+                job = {
+                    "id": row["id"],
+                    "user_id": row["user_id"],
+                    "message": row["message"],
+                    # Kept across claims, so a re-run turn can be matched with the first one
+                    "turn_timestamp": row["turn_timestamp"] or datetime.now().isoformat(),
+                    "reclaimed": row["status"] == "running",
+                }
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ?, turn_timestamp = ? WHERE id = ?",
+                    (now, job["turn_timestamp"], job["id"]),
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return job
+
+    def _finish(self, job_id: str, status: str, response: Optional[str] = None, error: Optional[str] = None) -> None:
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, response = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, response, error, time.time(), job_id),
+        )
+        with self._finished:
+            self._finished.notify_all()
+        # The user's next job, if any, can run now
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _worker(self) -> None:
+        interval = self.POLL_INTERVAL
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming chat job: {str(e)}")
+                job = None
+            if job is None:
+                # Woken early by local submissions; polling, less and less often
+                # while idle, picks up other workers' jobs
+                with self._wakeup:
+                    self._wakeup.wait(interval)
+                interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+                continue
+            interval = self.POLL_INTERVAL
+            try:
+                response = None
+                if job["reclaimed"] and self.recover_turn is not None:
+                    # The worker that claimed it first may have finished the turn before it stopped
+                    response = self.recover_turn(job["user_id"], job["message"], job["turn_timestamp"])
+                    if response is not None:
+                        logger.info(f"Chat job {job['id']} was answered before its worker stopped; not running it again")
+                if response is None:
+                    response = self.run_turn(job["user_id"], job["message"], job["turn_timestamp"])
+                self._finish(job["id"], "done", response=response)
+            except Exception as e:
+                logger.error(f"Chat job {job['id']} failed: {str(e)}")
+                self._finish(job["id"], "failed", error=str(e))
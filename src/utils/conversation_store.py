@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+
+from src.utils.chat_history import ChatHistory
+from src.utils.history_storage import StripedLocks
+from src.utils.history_storage import page_cursor
+
+class Conversation:
+    """The most recent messages of a user, as cached by ConversationStore."""
+
+    def __init__(self, messages: List[Dict[str, Any]], start: int, version: Optional[tuple]):
+        self.messages = messages
+        # Position of the first cached message in the user's whole history
+        self.start = start
+        # Storage version the cache matches (see HistoryStorage.version)
+        self.version = version
+        self.size_bytes = sum(len(msg["content"].encode("utf-8")) for msg in messages)
+        self.last_active = time.monotonic()
+
+
+class ConversationStore:
+    """
+    Single source of a user's conversation for the agents and for the UI.
+
+    Every message is written once, to the persisted history (ChatHistory),
+    and appended to an in-memory hot cache of each active user's most recent
+    `hot_messages` messages. The agent context and the latest page of the UI
+    are read from the cache; older pages come from the persisted history.
+
+    A user's cache is loaded from the persisted history on first use (so a
+    restarted worker picks the conversation up where it was) and reloaded
+    when the storage reports that another process wrote to it. Caches are
+    evicted when idle for too long or, least recently used first, when the
+    number of users or the cached bytes exceed the limits.
+    """
+
+    def __init__(
+        self,
+        hot_messages: int = 50,
+        max_users: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_seconds: float = 3600,
+    ):
+        self.hot_messages = hot_messages
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        # Sum of size_bytes over the cached conversations
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        # Held while loading or writing a user's conversation, so a load never misses a write
+        self._user_locks = StripedLocks()
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        return self._user_locks.get(user_id)
+
+    def _cached(self, user_id: str) -> Optional[Conversation]:
+        with self._lock:
+            conversation = self._conversations.get(user_id)
+            if conversation is not None:
+                self._conversations.move_to_end(user_id)
+                conversation.last_active = time.monotonic()
+            return conversation
+
+    def _load(self, user_id: str, chat_history: ChatHistory) -> Conversation:
+        """Read the hot messages from the persisted history into the cache. Called with the user's lock held."""
+        version = chat_history.storage.version(user_id)
+        messages = chat_history.get_recent_messages(self.hot_messages)
+        # Counting is only needed when older messages were left out
+        start = chat_history.storage.count(user_id) - len(messages) if len(messages) == self.hot_messages else 0
+        conversation = Conversation(messages, max(start, 0), version)
+        with self._lock:
+            previous = self._conversations.pop(user_id, None)
+            if previous is not None:
+                self._total_bytes -= previous.size_bytes
+            self._conversations[user_id] = conversation
+            self._total_bytes += conversation.size_bytes
+            self._evict(keep=user_id)
+        logger.debug(f"Loaded {len(messages)} messages into the conversation cache for user {user_id}")
+        return conversation
+
+    def _snapshot(self, user_id: str) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Copy the user's cached messages, loading them if missing or changed by another process.
+
+        Returns:
+            The messages and the position of the first one in the user's history
+        """
+        with self._user_lock(user_id):
+            chat_history = ChatHistory(user_id)
+            conversation = self._cached(user_id)
+            if conversation is None or conversation.version != chat_history.storage.version(user_id):
+                conversation = self._load(user_id, chat_history)
+            return list(conversation.messages), conversation.start
+
+    def recent(self, user_id: str) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Get the user's most recent messages, oldest first.
+
+        Args:
+            user_id: ID of the user
+
+        Returns:
+            Up to `hot_messages` messages, with role, content and timestamp, and
+            the position of the first one in the user's whole history (0 for
+            the oldest message), which stays the same as messages are added
+        """
+        return self._snapshot(user_id)
+
+    def page(self, user_id: str, limit: int, before: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get one page of the user's history, like ChatHistory.get_page.
+
+        The latest page is served from the cache when it holds enough messages.
+        """
+        if before is None:
+            messages, start = self._snapshot(user_id)
+            if len(messages) > limit or start == 0:
+                page = messages[-limit:] if limit > 0 else []
+                has_more = len(messages) > limit
+                return {
+                    "messages": page,
+                    "has_more": has_more,
+                    "next_before": page_cursor(page, None) if has_more and page else None,
+                }
+        return ChatHistory(user_id).get_page(limit, before)
+
+    def add_message(self, user_id: str, role: str, content: str, timestamp: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Persist a message and add it to the user's cached conversation.
+
+        Args:
+            user_id: ID of the user
+            role: "user" or "assistant"
+            content: Message text
+            timestamp: ISO timestamp; now if None
+
+        Returns:
+            The stored message
+        """
+        message = {"role": role, "content": content, "timestamp": timestamp or datetime.now().isoformat()}
+        self.add_messages(user_id, [message])
+        return message
+
+    def add_messages(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """
+        Persist messages with a single write and add them to the user's cached conversation.
+
+        Args:
+            user_id: ID of the user
+            messages: Messages with role, content and timestamp, oldest first
+
+        Raises:
+            Exception: If the history could not be written
+        """
+        with self._user_lock(user_id):
+            # Raises if the write failed, leaving the cache as it was
+            before, after = ChatHistory(user_id).add_messages(messages)
+            conversation = self._cached(user_id)
+            # Only extend a cache that matched the history right before this write;
+            # if another process wrote in the meantime, reload it on next use
+            if conversation is None or conversation.version != before:
+                self._forget(user_id)
+                return
+            size_bytes = conversation.size_bytes
+            conversation.messages.extend(messages)
+            conversation.size_bytes += sum(len(msg["content"].encode("utf-8")) for msg in messages)
+            while len(conversation.messages) > self.hot_messages:
+                dropped = conversation.messages.pop(0)
+                conversation.size_bytes -= len(dropped["content"].encode("utf-8"))
+                conversation.start += 1
+            conversation.version = after
+            with self._lock:
+                # Unless it was evicted in the meantime
+                if self._conversations.get(user_id) is conversation:
+                    self._total_bytes += conversation.size_bytes - size_bytes
+                self._evict(keep=user_id)
+
+    def clear(self, user_id: str) -> None:
+        """Delete the user's history."""
+        with self._user_lock(user_id):
+            ChatHistory(user_id).clear_history()
+            self._forget(user_id)
+
+    def _forget(self, user_id: str) -> None:
+        with self._lock:
+            conversation = self._conversations.pop(user_id, None)
+            if conversation is not None:
+                self._total_bytes -= conversation.size_bytes
+
+    def _evict(self, keep: str) -> None:
+        """
+        Evict idle conversations, then least recently used ones until within limits. Called with the lock held.
+
+        Conversations are ordered from least to most recently used, so only the
+        ones evicted and the first one kept are looked at.
+        """
+        now = time.monotonic()
+        while self._conversations:
+            user_id, conversation = next(iter(self._conversations.items()))
+            if user_id == keep or now - conversation.last_active <= self.idle_seconds:
+                break
+            self._drop(user_id)
+
+        while len(self._conversations) > self.max_users or self._total_bytes > self.max_bytes:
+            user_id = next(iter(self._conversations))
+            if user_id == keep:
+                # The conversation in use is never evicted; look past it
+                if len(self._conversations) == 1:
+                    break
+                self._conversations.move_to_end(user_id)
+                continue
+            self._drop(user_id)
+            logger.debug(f"Evicted cached conversation for user {user_id}")
+
+    def _drop(self, user_id: str) -> None:
+        self._total_bytes -= self._conversations.pop(user_id).size_bytes
+
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+def get_conversation_store() -> ConversationStore:
+    """Get the process-wide conversation store, configured with the CONVERSATION_* variables."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ConversationStore(
+                hot_messages=int(os.getenv("CONVERSATION_HOT_MESSAGES", "50")),
+                max_users=int(os.getenv("CONVERSATION_CACHE_MAX_USERS", "1000")),
+                max_bytes=int(os.getenv("CONVERSATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+                idle_seconds=float(os.getenv("CONVERSATION_CACHE_IDLE_SECONDS", "3600")),
+            )
+        return _store
@@ -0,0 +1,148 @@
+import os
+import queue
+import asyncio
+import threading
+import contextvars
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional
+from loguru import logger
+
+def _in_caller_context(coro: Coroutine[Any, Any, Any]) -> Coroutine[Any, Any, Any]:
+    """
+    Wrap a coroutine so it sees the submitting thread's context variables
+    (e.g. the request's stage timings). Tasks on the loop otherwise start
+    from the loop thread's context.
+    """
+    context = contextvars.copy_context()
+
+    async def run_in_context():
+        for var, value in context.items():
+            var.set(value)
+        return await coro
+
+    return run_in_context()
+
+
+class BackgroundEventLoop:
+    """
+    Long-lived asyncio event loop running on a dedicated daemon thread.
+    Synchronous callers (Flask views, Qt worker threads) submit coroutines to it
+    so that HTTP connection pools and other loop-bound state are reused.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """Return the running background loop, starting it if needed."""
+        with self._lock:
+            # Threads do not survive a fork (e.g. gunicorn --preload), so every
+            # worker process needs its own loop thread.
+            if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._start()
+            return self._loop
+
+    @property
+    def thread_ident(self) -> Optional[int]:
+        """Identifier of the thread running the loop, or None if not started."""
+        thread = self._thread
+        return thread.ident if thread is not None and self._pid == os.getpid() else None
+
+    def adopt(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Use an already running loop (e.g. an ASGI server's) instead of starting one.
+        Must be called from the thread running that loop.
+        """
+        with self._lock:
+            self._loop = loop
+            self._thread = threading.current_thread()
+            self._pid = os.getpid()
+        logger.info(f"Background event loop adopted from the server (pid={self._pid})")
+
+    def _start(self) -> None:
+        """Create the loop and the thread that runs it forever."""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run_loop, name="openai-event-loop", daemon=True)
+        thread.start()
+        ready.wait()
+
+        self._loop = loop
+        self._thread = thread
+        self._pid = os.getpid()
+        logger.info(f"Background event loop started (pid={self._pid})")
+
+    def run(self, coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+        """
+        Run a coroutine on the background loop and block until it finishes.
+
+        Args:
+            coro: Coroutine to execute
+            timeout: Maximum number of seconds to wait for the result
+
+        Returns:
+            The coroutine's result
+        """
+        loop = self.get_loop()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("BackgroundEventLoop.run() cannot be called from the loop thread")
+        future = asyncio.run_coroutine_threadsafe(_in_caller_context(coro), loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, agen: AsyncIterator[Any]) -> Iterator[Any]:
+        """
+        Consume an async iterator on the background loop from synchronous code.
+
+        Items are handed over through a thread-safe queue as soon as they are
+        produced. Closing the returned generator cancels the async iterator.
+
+        Args:
+            agen: Async iterator to consume
+
+        Yields:
+            The items produced by the async iterator
+        """
+        loop = self.get_loop()
+        items: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put(("item", item))
+            except Exception as e:
+                items.put(("error", e))
+            finally:
+                items.put(("end", None))
+
+        future = asyncio.run_coroutine_threadsafe(_in_caller_context(pump()), loop)
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == "item":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            future.cancel()
+
+
+_background_loop = BackgroundEventLoop()
+
+def get_background_loop() -> BackgroundEventLoop:
+    """Get the process-wide background event loop."""
+    return _background_loop
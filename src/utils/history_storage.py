@@ -0,0 +1,1173 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Dict, Any, Iterable, Iterator, Optional, Tuple
+from contextlib import contextmanager, nullcontext
+from loguru import logger
+
+from src.utils.timings import stage
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+def _file_version(path: Path) -> tuple:
+    """Version token of a history file: identity, modification time and size."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return ()
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+@contextmanager
+def _file_lock(path: Path, shared: bool = False) -> Iterator[None]:
+    """
+    Hold an advisory lock on `path` (created if missing), exclusive unless `shared`.
+
+    The lock is taken on a file descriptor of its own, so it excludes other
+    threads as well as other processes (gunicorn workers) using the same path.
+    Shared locks are only shared where fcntl is available.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            # Locks the first byte; retries for about 10 seconds before raising OSError
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class StripedLocks:
+    """
+    A fixed set of locks shared out by key, so per-user locking uses the same
+    memory however many users come and go. Keys hashing to the same stripe
+    share a lock: never hold one key's lock while taking another's.
+    """
+
+    def __init__(self, stripes: int = 256):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def get(self, key: str) -> threading.Lock:
+        """Get the lock for a key."""
+        return self._locks[hash(key) % len(self._locks)]
+
+def format_cursor(timestamp: str, skip: int) -> str:
+    """Build a page cursor: messages older than `timestamp`, and those at `timestamp` after the first `skip`."""
+    return f"{timestamp}|{skip}"
+
+def parse_cursor(cursor: str) -> Tuple[str, Optional[int]]:
+    """
+    Split a page cursor into its timestamp and the number of messages at that
+    timestamp to skip. A plain timestamp (as sent before cursors carried a
+    count) gives None: every message at that timestamp is skipped.
+    """
+    timestamp, separator, skip = cursor.rpartition("|")
+    if separator:
+        try:
+            return timestamp, int(skip)
+        except ValueError:
+            pass
+    return cursor, None
+
+def apply_cursor(newest_first: Iterable[Dict[str, Any]], before: Optional[str]) -> Iterator[Dict[str, Any]]:
+    """Yield the messages, newest first, that come after the cursor `before` (all of them if None)."""
+    if before is None:
+        yield from newest_first
+        return
+    timestamp, skip = parse_cursor(before)
+    for message in newest_first:
+        if message["timestamp"] > timestamp:
+            continue
+        if message["timestamp"] == timestamp:
+            if skip is None:
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+        yield message
+
+def page_cursor(page: List[Dict[str, Any]], before: Optional[str]) -> str:
+    """
+    Get the cursor of the page before `page` (oldest first, non-empty), which was read with `before`.
+
+    Timestamps are not unique, so the cursor also counts the messages at the
+    oldest timestamp already returned; a bare timestamp would drop the rest of
+    them when they straddle two pages.
+    """
+    timestamp = page[0]["timestamp"]
+    skip = sum(1 for message in page if message["timestamp"] == timestamp)
+    if before is not None:
+        before_timestamp, before_skip = parse_cursor(before)
+        if before_timestamp == timestamp and before_skip is not None:
+            skip += before_skip
+    return format_cursor(timestamp, skip)
+
+class HistoryStorage(ABC):
+    """
+    Base class for chat history storage backends.
+    Backends are shared by every ChatHistory in the process and keyed by user ID.
+    """
+
+    # True if appends return before the messages are durably written
+    buffered = False
+
+    def ensure(self, user_id: str) -> None:
+        """Prepare storage for a user (create files, migrate old formats)."""
+
+    @abstractmethod
+    def user_ids(self) -> List[str]:
+        """Get the IDs of every user with stored history."""
+
+    def version(self, user_id: str) -> Optional[tuple]:
+        """
+        Get a cheap token that changes whenever a user's history changes, so
+        caches can detect writes by other processes; None if not supported.
+        """
+        return None
+
+    @abstractmethod
+    def read(self, user_id: str) -> List[Dict[str, Any]]:
+        """Get all messages for a user, oldest first."""
+
+    def count(self, user_id: str) -> int:
+        """Get the number of messages of a user."""
+        return len(self.read(user_id))
+
+    def tail(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Get the last `limit` messages for a user, oldest first."""
+        return self.read(user_id)[-limit:] if limit > 0 else []
+
+    def page(self, user_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Get the last `limit` messages before a cursor, oldest first.
+
+        Args:
+            user_id: ID of the user
+            limit: Maximum number of messages
+            before: Cursor from page_cursor, or an ISO timestamp as an exclusive
+                upper bound (None for the latest messages)
+
+        Returns:
+            The page of messages
+        """
+        if before is None:
+            return self.tail(user_id, limit)
+        if limit <= 0:
+            return []
+        older = list(islice(apply_cursor(reversed(self.read(user_id)), before), limit))
+        older.reverse()
+        return older
+
+    def range(
+        self,
+        user_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get messages with start <= timestamp < end, oldest first.
+
+        Args:
+            user_id: ID of the user
+            start: Inclusive lower bound as an ISO timestamp (None for no bound)
+            end: Exclusive upper bound as an ISO timestamp (None for no bound)
+            limit: Maximum number of messages, counted from the oldest
+
+        Returns:
+            The matching messages
+        """
+        # ISO 8601 timestamps in the same format compare correctly as strings
+        messages = [
+            msg for msg in self.read(user_id)
+            if (start is None or msg["timestamp"] >= start) and (end is None or msg["timestamp"] < end)
+        ]
+        return messages[:limit] if limit is not None else messages
+
+    @abstractmethod
+    def append(self, user_id: str, message: Dict[str, Any]) -> None:
+        """Append one message to a user's history."""
+
+    def append_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Append several messages to a user's history, in order."""
+        for message in messages:
+            self.append(user_id, message)
+
+    def append_many_versioned(
+        self, user_id: str, messages: List[Dict[str, Any]]
+    ) -> Tuple[Optional[tuple], Optional[tuple]]:
+        """
+        Append several messages like append_many, and get the history's version
+        right before and right after the write, taken atomically with it, so a
+        cache can tell whether anyone else wrote in between.
+
+        Returns:
+            The versions before and after the write (None if not supported)
+        """
+        self.append_many(user_id, messages)
+        return None, None
+
+    @abstractmethod
+    def clear(self, user_id: str) -> None:
+        """Delete every message of a user."""
+
+
+class JsonHistoryStorage(HistoryStorage):
+    """
+    Stores each user's history as a single JSON document, `<user_id>.json`.
+
+    Every append rewrites the whole file, under a per-user lock file shared by
+    all processes, into a temporary file that atomically replaces the
+    document, so a crash never leaves it half-written. The previous version is
+    kept as `<user_id>.json.bak`; a document that fails the integrity check on
+    read is set aside as `<user_id>.json.corrupt-<time>` and restored from it.
+    """
+
+    def __init__(self, history_dir: Path):
+        self.history_dir = history_dir
+        self.history_dir.mkdir(exist_ok=True)
+
+    def _path(self, user_id: str) -> Path:
+        return self.history_dir / f"{user_id}.json"
+
+    def _lock(self, user_id: str):
+        return _file_lock(self.history_dir / f"{user_id}.json.lock")
+
+    def user_ids(self) -> List[str]:
+        return sorted(path.stem for path in self.history_dir.glob("*.json"))
+
+    def version(self, user_id: str) -> Optional[tuple]:
+        return _file_version(self._path(user_id))
+
+    def ensure(self, user_id: str) -> None:
+        if self._path(user_id).exists():
+            return
+        with self._lock(user_id):
+            if not self._path(user_id).exists():
+                try:
+                    # A crash during recovery can leave only the backup
+                    self._read_locked(user_id)
+                except FileNotFoundError:
+                    self._write(user_id, [])
+
+    @staticmethod
+    def _load(path: Path) -> List[Dict[str, Any]]:
+        """Read a history document, raising ValueError if it is truncated or malformed."""
+        with open(path, "r") as f:
+            data = json.load(f)
+        messages = data.get("messages") if isinstance(data, dict) else None
+        if not isinstance(messages, list) or not all(
+            isinstance(msg, dict) and {"role", "content", "timestamp"} <= msg.keys() for msg in messages
+        ):
+            raise ValueError("not a chat history document")
+        return messages
+
+    def _read_locked(self, user_id: str) -> List[Dict[str, Any]]:
+        """Read a user's history, recovering a damaged document. Called with the user's lock held."""
+        path = self._path(user_id)
+        backup_path = self.history_dir / f"{user_id}.json.bak"
+        try:
+            return self._load(path)
+        except FileNotFoundError:
+            if not backup_path.exists():
+                raise
+            logger.error(f"Chat history {path.name} is missing")
+        except ValueError as e:
+            corrupt_path = self.history_dir / f"{user_id}.json.corrupt-{time.time_ns()}"
+            path.rename(corrupt_path)
+            logger.error(f"Chat history {path.name} is damaged ({str(e)}), moved it to {corrupt_path.name}")
+        try:
+            messages = self._load(backup_path)
+            logger.warning(f"Restored {len(messages)} messages for user {user_id} from {backup_path.name}")
+        except (OSError, ValueError):
+            messages = []
+            logger.error(f"No usable backup of {path.name}, starting an empty history")
+        self._write(user_id, messages)
+        return messages
+
+    def _write(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Atomically replace a user's document, keeping the current one as the backup. Called with the user's lock held."""
+        path = self._path(user_id)
+        tmp_path = self.history_dir / f"{user_id}.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"messages": messages}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            backup_path = self.history_dir / f"{user_id}.json.bak"
+            backup_path.unlink(missing_ok=True)
+            try:
+                # A hard link keeps the old version without copying it
+                os.link(path, backup_path)
+            except OSError:
+                shutil.copy2(path, backup_path)
+        os.replace(tmp_path, path)
+
+    def read(self, user_id: str) -> List[Dict[str, Any]]:
+        # Documents are only ever replaced whole, so reading needs no lock
+        try:
+            return self._load(self._path(user_id))
+        except ValueError:
+            with self._lock(user_id):
+                return self._read_locked(user_id)
+
+    def append(self, user_id: str, message: Dict[str, Any]) -> None:
+        self.append_many(user_id, [message])
+
+    def append_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        self.append_many_versioned(user_id, messages)
+
+    def append_many_versioned(
+        self, user_id: str, messages: List[Dict[str, Any]]
+    ) -> Tuple[Optional[tuple], Optional[tuple]]:
+        with self._lock(user_id):
+            before = self.version(user_id)
+            history = self._read_locked(user_id)
+            history.extend(messages)
+            self._write(user_id, history)
+            return before, self.version(user_id)
+
+    def clear(self, user_id: str) -> None:
+        with self._lock(user_id):
+            self._write(user_id, [])
+
+
+class JsonlHistoryStorage(HistoryStorage):
+    """
+    Append-only storage with one JSON object per line, `<user_id>.jsonl`.
+
+    Appends are a single O_APPEND write, so they cost the same regardless of
+    history size and concurrent writers never interleave partial lines. A
+    per-user lock file orders appends with the torn-line repair, migration,
+    archiving and clearing across processes. Files in the old
+    `<user_id>.json` format are migrated on first access.
+
+    The fsync policy is one of "always" (every append), "interval" (at most
+    once every `fsync_interval` seconds per process) or "never" (leave it to the OS).
+
+    With `segment_bytes` set, a file that grows past it is rolled into an
+    immutable gzip segment in `<user_id>.archive/` (compressed by a
+    background thread, outside the lock), listed with its oldest and newest
+    timestamps in the directory's `manifest.json`, and a new file is started
+    for the recent (hot) messages. Pages are read from the hot file first and
+    segments are only decompressed when a page reaches back into them.
+
+    Without segments, the hot file is read without a lock, so a read may see
+    an append in progress; its unterminated last line is left for a later read.
+    """
+
+    READ_BLOCK_SIZE = 8192
+
+    def __init__(
+        self,
+        history_dir: Path,
+        fsync: str = "never",
+        fsync_interval: float = 1.0,
+        segment_bytes: int = 0,
+    ):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.history_dir = history_dir
+        self.history_dir.mkdir(exist_ok=True)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self._last_fsync = 0.0
+        self._lock = threading.Lock()
+
+    def _path(self, user_id: str) -> Path:
+        return self.history_dir / f"{user_id}.jsonl"
+
+    def _archive_dir(self, user_id: str) -> Path:
+        return self.history_dir / f"{user_id}.archive"
+
+    def _user_lock(self, user_id: str, shared: bool = False):
+        return _file_lock(self.history_dir / f"{user_id}.jsonl.lock", shared)
+
+    def user_ids(self) -> List[str]:
+        return sorted({path.stem for path in self.history_dir.glob("*.jsonl")}
+                      | {path.stem for path in self.history_dir.glob("*.archive")})
+
+    def version(self, user_id: str) -> Optional[tuple]:
+        # Rolling the hot file into a segment does not change the history, only appends and clears do
+        return _file_version(self._path(user_id))
+
+    def _read_lock(self, user_id: str):
+        """Lock out archiving while reading, for users who have (or may get) segments."""
+        if self.segment_bytes or self._archive_dir(user_id).exists():
+            return self._user_lock(user_id, shared=True)
+        return nullcontext()
+
+    def ensure(self, user_id: str) -> None:
+        path = self._path(user_id)
+        archive_dir = self._archive_dir(user_id)
+        if archive_dir.exists() and any(archive_dir.glob("*.rolling.jsonl")):
+            self._finish_rolls(user_id)
+        legacy_path = self.history_dir / f"{user_id}.json"
+        if path.exists() or not legacy_path.exists():
+            return
+        with self._user_lock(user_id):
+            if not path.exists():
+                self._migrate(legacy_path, path)
+
+    def _migrate(self, legacy_path: Path, path: Path) -> None:
+        """Convert a `<user_id>.json` document into a `.jsonl` file."""
+        with open(legacy_path, "r") as f:
+            messages = json.load(f).get("messages", [])
+        tmp_path = path.with_suffix(".jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for message in messages:
+                f.write(json.dumps(message) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        legacy_path.rename(legacy_path.with_suffix(".json.migrated"))
+        logger.info(f"Migrated {len(messages)} messages from {legacy_path.name} to {path.name}")
+
+    @staticmethod
+    def _parse_lines(lines: List[bytes], path: Path) -> List[Dict[str, Any]]:
+        messages = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A crash mid-append can leave a torn last line
+                logger.warning(f"Skipping unreadable line in {path.name}")
+        return messages
+
+    def _read_file(self, path: Path) -> List[Dict[str, Any]]:
+        """Read every message of a hot file, rolling file or (gzip) segment."""
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rb") as f:
+            lines = f.read().split(b"\n")
+        # Whatever follows the last newline is an append in progress (or was torn by a crash)
+        lines.pop()
+        return self._parse_lines(lines, path)
+
+    def _manifest(self, user_id: str) -> List[Dict[str, Any]]:
+        """Get the user's archived segments, oldest first."""
+        manifest_path = self._archive_dir(user_id) / "manifest.json"
+        if not manifest_path.exists():
+            return []
+        with open(manifest_path, "r") as f:
+            return json.load(f)["segments"]
+
+    def _cold_files(self, user_id: str) -> List[Dict[str, Any]]:
+        """
+        Get the user's archived files, oldest first, as manifest entries with their `path`.
+
+        Includes files rolled out of the hot file until they are archived;
+        their timestamp range is unknown (`min` and `max` are None), so they
+        are never skipped, and neither are segments listed by older versions,
+        which recorded no `min` and `max`.
+        """
+        archive_dir = self._archive_dir(user_id)
+        segments = self._manifest(user_id)
+        files = [{"min": None, "max": None, **segment, "path": archive_dir / segment["file"]} for segment in segments]
+        if archive_dir.exists():
+            last_number = self._last_segment_number(segments)
+            for rolling_path in sorted(archive_dir.glob("*.rolling.jsonl")):
+                if self._file_number(rolling_path) > last_number:
+                    files.append({"path": rolling_path, "min": None, "max": None})
+        return files
+
+    @staticmethod
+    def _file_number(path: Path) -> int:
+        """Get the number of a segment or rolling file, e.g. 3 for `000003.jsonl.gz`."""
+        return int(path.name.split(".")[0])
+
+    def _last_segment_number(self, segments: List[Dict[str, Any]]) -> int:
+        """Get the number of the newest archived segment, 0 if there is none."""
+        return max((self._file_number(Path(segment["file"])) for segment in segments), default=0)
+
+    def read(self, user_id: str) -> List[Dict[str, Any]]:
+        path = self._path(user_id)
+        with self._read_lock(user_id):
+            messages = []
+            for cold_file in self._cold_files(user_id):
+                messages.extend(self._read_file(cold_file["path"]))
+            if path.exists():
+                messages.extend(self._read_file(path))
+        return messages
+
+    def count(self, user_id: str) -> int:
+        """Count from the manifest; only the hot file (and unfinished rolls) are read."""
+        path = self._path(user_id)
+        with self._read_lock(user_id):
+            total = 0
+            for cold_file in self._cold_files(user_id):
+                total += cold_file["count"] if "count" in cold_file else len(self._read_file(cold_file["path"]))
+            if path.exists():
+                total += len(self._read_file(path))
+        return total
+
+    def _reverse_lines(self, path: Path) -> Iterator[bytes]:
+        """Yield the lines of a file from last to first, reading it backwards in blocks."""
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0:
+                size = min(self.READ_BLOCK_SIZE, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + remainder).split(b"\n")
+                # The first piece may be the end of a line that starts in an earlier block
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    yield line
+            yield remainder
+
+    def _reverse_messages(self, path: Path) -> Iterator[Dict[str, Any]]:
+        """Yield the messages of a file from newest to oldest."""
+        lines = self._reverse_lines(path)
+        # Whatever follows the last newline is an append in progress (or was torn by a crash)
+        next(lines, None)
+        for line in lines:
+            for message in self._parse_lines([line], path):
+                yield message
+
+    def _reverse_history(self, user_id: str, until: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield a user's messages from newest to oldest: the hot file backwards,
+        then each segment, decompressed only when the iteration reaches it.
+        Segments that only hold messages newer than `until` are skipped.
+        """
+        path = self._path(user_id)
+        if path.exists():
+            yield from self._reverse_messages(path)
+        for cold_file in reversed(self._cold_files(user_id)):
+            # Turns can be saved out of timestamp order, so only the segment's own range tells
+            if until is not None and cold_file["min"] is not None and cold_file["min"] > until:
+                continue
+            yield from reversed(self._read_file(cold_file["path"]))
+
+    def tail(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Read the last `limit` messages by scanning the file backwards from its end."""
+        return self.page(user_id, limit)
+
+    def page(self, user_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Read a page by scanning backwards, stopping as soon as it is full."""
+        if limit <= 0:
+            return []
+        until = parse_cursor(before)[0] if before is not None else None
+        with self._read_lock(user_id):
+            messages = list(islice(apply_cursor(self._reverse_history(user_id, until), before), limit))
+        messages.reverse()
+        return messages
+
+    def range(
+        self,
+        user_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Read the messages in a time range, skipping segments that end before or start after it."""
+        path = self._path(user_id)
+        messages = []
+        with self._read_lock(user_id):
+            for cold_file in self._cold_files(user_id):
+                if cold_file["min"] is not None and (
+                    (start is not None and cold_file["max"] < start) or (end is not None and cold_file["min"] >= end)
+                ):
+                    continue
+                messages.extend(self._read_file(cold_file["path"]))
+            if path.exists():
+                messages.extend(self._read_file(path))
+        messages = [
+            msg for msg in messages
+            if (start is None or msg["timestamp"] >= start) and (end is None or msg["timestamp"] < end)
+        ]
+        return messages[:limit] if limit is not None else messages
+
+    def append(self, user_id: str, message: Dict[str, Any]) -> None:
+        self.append_many(user_id, [message])
+
+    def append_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Append the messages with a single write, so a batch is never interleaved with other writers."""
+        self.append_many_versioned(user_id, messages)
+
+    def append_many_versioned(
+        self, user_id: str, messages: List[Dict[str, Any]]
+    ) -> Tuple[Optional[tuple], Optional[tuple]]:
+        if not messages:
+            version = self.version(user_id)
+            return version, version
+        data = "".join(json.dumps(message) + "\n" for message in messages).encode("utf-8")
+        with self._user_lock(user_id):
+            before = self.version(user_id)
+            flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            fd = os.open(self._path(user_id), flags, 0o644)
+            try:
+                # Terminate a torn line left by a crash so this message stays readable
+                if os.fstat(fd).st_size:
+                    os.lseek(fd, -1, os.SEEK_END)
+                    if os.read(fd, 1) != b"\n":
+                        data = b"\n" + data
+                os.write(fd, data)
+                if self._should_fsync():
+                    os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            rolled = bool(self.segment_bytes) and size >= self.segment_bytes
+            if rolled:
+                self._roll(user_id)
+            versions = before, self.version(user_id)
+        if rolled:
+            # Compressing takes a while; do it without holding up this append or other writers
+            threading.Thread(target=self._finish_rolls_logged, args=(user_id,), name="history-archiver", daemon=True).start()
+        return versions
+
+    def _roll(self, user_id: str) -> None:
+        """Move the hot file into the archive to become the next segment. Called with the user's lock held."""
+        archive_dir = self._archive_dir(user_id)
+        archive_dir.mkdir(exist_ok=True)
+        # Renaming starts a new hot file at once; the rolling file is archived
+        # afterwards, and a crash before that is finished by ensure(). Earlier
+        # rolls may not be archived yet, so number after them as well
+        numbers = [self._file_number(path) for path in archive_dir.glob("*.rolling.jsonl")]
+        number = max([self._last_segment_number(self._manifest(user_id))] + numbers) + 1
+        os.replace(self._path(user_id), archive_dir / f"{number:06d}.rolling.jsonl")
+
+    def _finish_rolls_logged(self, user_id: str) -> None:
+        try:
+            self._finish_rolls(user_id)
+        except Exception as e:
+            logger.error(f"Error archiving chat history for user {user_id}: {str(e)}")
+
+    def _finish_rolls(self, user_id: str) -> None:
+        """
+        Compress rolling files into segments and add them to the manifest.
+
+        Files are compressed without the user's lock, which is only taken to
+        commit each segment. Several processes may compress the same file;
+        the first to commit it wins and the others discard their copy.
+        """
+        archive_dir = self._archive_dir(user_id)
+        for rolling_path in sorted(archive_dir.glob("*.rolling.jsonl")):
+            number = self._file_number(rolling_path)
+            rolled_version = _file_version(rolling_path)
+            try:
+                # Rolling files are never written again, so they can be read unlocked
+                messages = self._read_file(rolling_path)
+            except FileNotFoundError:
+                # Archived by another process meanwhile
+                continue
+            segment_name = f"{number:06d}.jsonl.gz"
+            tmp_path = archive_dir / f"{segment_name}.{os.getpid()}-{threading.get_ident()}.tmp"
+            try:
+                if messages:
+                    with open(tmp_path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                        for message in messages:
+                            f.write((json.dumps(message) + "\n").encode("utf-8"))
+                    with open(tmp_path, "rb") as f:
+                        os.fsync(f.fileno())
+                with self._user_lock(user_id):
+                    # Gone if archived meanwhile; another file if the history was also cleared and rolled again
+                    if _file_version(rolling_path) != rolled_version:
+                        continue
+                    segments = self._manifest(user_id)
+                    # Otherwise it was committed by a process that stopped before removing it
+                    if messages and number > self._last_segment_number(segments):
+                        os.replace(tmp_path, archive_dir / segment_name)
+                        timestamps = [message["timestamp"] for message in messages]
+                        segments.append({
+                            "file": segment_name,
+                            "count": len(messages),
+                            "min": min(timestamps),
+                            "max": max(timestamps),
+                        })
+                        self._write_manifest(user_id, segments)
+                        logger.info(f"Archived {len(messages)} messages for user {user_id} in {segment_name}")
+                    rolling_path.unlink()
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
+    def _write_manifest(self, user_id: str, segments: List[Dict[str, Any]]) -> None:
+        manifest_path = self._archive_dir(user_id) / "manifest.json"
+        tmp_path = manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"segments": segments}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+
+    def _should_fsync(self) -> bool:
+        if self.fsync == "always":
+            return True
+        if self.fsync == "interval":
+            now = time.monotonic()
+            with self._lock:
+                if now - self._last_fsync >= self.fsync_interval:
+                    self._last_fsync = now
+                    return True
+        return False
+
+    def clear(self, user_id: str) -> None:
+        with self._user_lock(user_id), open(self._path(user_id), "w"):
+            shutil.rmtree(self._archive_dir(user_id), ignore_errors=True)
+
+
+class SqliteHistoryStorage(HistoryStorage):
+    """
+    Stores every user's history in one SQLite database in WAL mode.
+
+    Each worker process shares a single connection across its threads; WAL
+    lets several gunicorn workers read while one writes, and writes are
+    atomic. Messages are indexed on (user_id, timestamp).
+    Existing `<user_id>.jsonl`/`.json` files are imported on first access.
+    """
+
+    max_ensured_users = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages (user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id);
+    """
+
+    def __init__(self, db_path: Path, history_dir: Path):
+        self.db_path = db_path
+        self.history_dir = history_dir
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.RLock()
+        # Users whose legacy files were already checked, most recently used last
+        self._ensured_users: "OrderedDict[str, None]" = OrderedDict()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get this process's connection, opening it after start-up or a fork."""
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(self.SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+            self._ensured_users = OrderedDict()
+        return self._connection
+
+    def _query(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [{"role": row["role"], "content": row["content"], "timestamp": row["timestamp"]} for row in rows]
+
+    def ensure(self, user_id: str) -> None:
+        with self._lock:
+            if user_id in self._ensured_users:
+                self._ensured_users.move_to_end(user_id)
+                return
+            connection = self._connect()
+            for legacy_path in (self.history_dir / f"{user_id}.jsonl", self.history_dir / f"{user_id}.json"):
+                if legacy_path.exists():
+                    # One worker imports the file while the others wait, then find it gone.
+                    # Not the .jsonl.lock itself: reading the file takes that one too
+                    with _file_lock(self.history_dir / f"{user_id}.import.lock"):
+                        if legacy_path.exists():
+                            self._import(connection, user_id, legacy_path)
+                    break
+            self._ensured_users[user_id] = None
+            # Forgotten users are only checked again, which costs two stat calls
+            while len(self._ensured_users) > self.max_ensured_users:
+                self._ensured_users.popitem(last=False)
+
+    def _import(self, connection: sqlite3.Connection, user_id: str, legacy_path: Path) -> None:
+        """Import a file-based history into the database and set the file aside. Called with the import lock held."""
+        try:
+            if legacy_path.suffix == ".jsonl":
+                messages = JsonlHistoryStorage(self.history_dir).read(user_id)
+            else:
+                with open(legacy_path, "r") as f:
+                    messages = json.load(f).get("messages", [])
+        except FileNotFoundError:
+            # Already imported by a process that does not take the import lock (e.g. an older worker)
+            return
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            imported = connection.execute("SELECT 1 FROM messages WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is None
+            if imported:
+                connection.executemany(
+                    "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                    [(user_id, msg["role"], msg["content"], msg["timestamp"]) for msg in messages],
+                )
+        try:
+            legacy_path.rename(legacy_path.with_suffix(legacy_path.suffix + ".migrated"))
+        except FileNotFoundError:
+            return
+        if imported:
+            logger.info(f"Imported {len(messages)} messages from {legacy_path.name} into {self.db_path.name}")
+        else:
+            logger.warning(
+                f"{self.db_path.name} already has messages for user {user_id}; "
+                f"set {legacy_path.name} aside without importing its {len(messages)} messages"
+            )
+
+    def user_ids(self) -> List[str]:
+        with self._lock:
+            rows = self._connect().execute("SELECT DISTINCT user_id FROM messages ORDER BY user_id").fetchall()
+        return [row["user_id"] for row in rows]
+
+    def version(self, user_id: str) -> Optional[tuple]:
+        # Row IDs only grow, so the user's newest row changes with every insert and clear
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT MAX(id) AS id FROM messages WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return (row["id"],) if row["id"] is not None else ()
+
+    def read(self, user_id: str) -> List[Dict[str, Any]]:
+        return self._query(
+            "SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp, id",
+            (user_id,),
+        )
+
+    def count(self, user_id: str) -> int:
+        with self._lock:
+            row = self._connect().execute("SELECT COUNT(*) AS n FROM messages WHERE user_id = ?", (user_id,)).fetchone()
+        return row["n"]
+
+    def tail(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        if limit <= 0:
+            return []
+        messages = self._query(
+            "SELECT role, content, timestamp FROM messages WHERE user_id = ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, limit),
+        )
+        messages.reverse()
+        return messages
+
+    def page(self, user_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, Any]]:
+        if before is None:
+            return self.tail(user_id, limit)
+        if limit <= 0:
+            return []
+        timestamp, skip = parse_cursor(before)
+        if skip is None:
+            messages = self._query(
+                "SELECT role, content, timestamp FROM messages WHERE user_id = ? AND timestamp < ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, timestamp, limit),
+            )
+        else:
+            # Rows at the cursor's timestamp come first, so the offset skips those already returned
+            messages = self._query(
+                "SELECT role, content, timestamp FROM messages WHERE user_id = ? AND timestamp <= ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+                (user_id, timestamp, limit, skip),
+            )
+        messages.reverse()
+        return messages
+
+    def range(
+        self,
+        user_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        sql = "SELECT role, content, timestamp FROM messages WHERE user_id = ?"
+        params: list = [user_id]
+        if start is not None:
+            sql += " AND timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND timestamp < ?"
+            params.append(end)
+        sql += " ORDER BY timestamp, id LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        return self._query(sql, tuple(params))
+
+    def append(self, user_id: str, message: Dict[str, Any]) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                (user_id, message["role"], message["content"], message["timestamp"]),
+            )
+
+    def append_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Insert the messages in one transaction."""
+        self.append_many_versioned(user_id, messages)
+
+    def append_many_versioned(
+        self, user_id: str, messages: List[Dict[str, Any]]
+    ) -> Tuple[Optional[tuple], Optional[tuple]]:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                # IMMEDIATE keeps other writers out between the two version reads
+                connection.execute("BEGIN IMMEDIATE")
+                before = self.version(user_id)
+                connection.executemany(
+                    "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                    [(user_id, msg["role"], msg["content"], msg["timestamp"]) for msg in messages],
+                )
+                after = self.version(user_id)
+        return before, after
+
+    def clear(self, user_id: str) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+
+class WriteBehindHistoryStorage(HistoryStorage):
+    """
+    Buffers appends in memory and persists them to `inner` in the background.
+
+    Appends only queue the message, so they never wait on disk. A daemon
+    thread writes each user's pending messages with one `append_many` call
+    when `batch_size` messages are waiting or every `flush_interval` seconds,
+    and again at interpreter exit. Reads in this process merge the pending
+    messages, so a user always sees their own writes; other processes only
+    see them once flushed. Messages still pending when the process is killed
+    without a clean exit are lost.
+
+    While `inner` keeps failing, flushes are retried with exponential backoff
+    (from `flush_interval` up to `max_backoff` seconds). Once `max_pending`
+    messages are queued, appends stop buffering and write through instead,
+    raising if the write fails.
+    """
+
+    buffered = True
+    max_backoff = 60.0
+
+    def __init__(
+        self,
+        inner: HistoryStorage,
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        max_pending: int = 10000,
+        on_flush: Optional[Callable[[str, List[Dict[str, Any]]], None]] = None,
+    ):
+        self.inner = inner
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Called with each user's messages once they are written to `inner`
+        self.on_flush = on_flush
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        # Number of messages in _pending, across users
+        self._pending_count = 0
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._pending_lock)
+        # Held while a user's batch is written and dequeued, so reads never see it twice
+        self._user_locks = StripedLocks()
+        self._flusher: Optional[threading.Thread] = None
+        self._flusher_pid: Optional[int] = None
+        atexit.register(self.flush)
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        return self._user_locks.get(user_id)
+
+    def _pending_for(self, user_id: str) -> List[Dict[str, Any]]:
+        with self._pending_lock:
+            return list(self._pending.get(user_id, ()))
+
+    def _start_flusher(self) -> None:
+        """Start the flusher thread, again in a forked worker (threads do not survive a fork). Called with the lock held."""
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher = threading.Thread(target=self._run, name="history-flusher", daemon=True)
+        self._flusher_pid = os.getpid()
+        self._flusher.start()
+
+    def _run(self) -> None:
+        backoff = self.flush_interval
+        while True:
+            with self._wakeup:
+                if not any(len(messages) >= self.batch_size for messages in self._pending.values()):
+                    self._wakeup.wait(self.flush_interval)
+            if self.flush():
+                backoff = self.flush_interval
+                continue
+            # Retrying a failing storage right away would only spin; full
+            # batches notifying the condition do not cut the wait short
+            deadline = time.monotonic() + backoff
+            with self._wakeup:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+            backoff = min(backoff * 2, max(self.max_backoff, self.flush_interval))
+
+    def flush(self) -> bool:
+        """
+        Persist every pending message.
+
+        Returns:
+            True if every user's pending messages were written
+        """
+        with self._pending_lock:
+            user_ids = [user_id for user_id, messages in self._pending.items() if messages]
+        flushed = True
+        for user_id in user_ids:
+            flushed = self._flush_user(user_id) and flushed
+        return flushed
+
+    def _flush_user(self, user_id: str) -> bool:
+        try:
+            self._write_pending(user_id)
+        except Exception as e:
+            # Keep the batch queued; the next flush retries it
+            logger.error(f"Error flushing messages for user {user_id}: {str(e)}")
+            return False
+        return True
+
+    def _write_pending(self, user_id: str, messages: List[Dict[str, Any]] = ()) -> None:
+        """Write the user's pending messages followed by `messages` in one call, raising (and keeping them queued) if it fails."""
+        with self._user_lock(user_id):
+            batch = self._pending_for(user_id)
+            if not batch and not messages:
+                return
+            written = batch + list(messages)
+            with stage("history_flush"):
+                self.inner.append_many(user_id, written)
+            with self._pending_lock:
+                remaining = self._pending.get(user_id, [])[len(batch):]
+                if remaining:
+                    self._pending[user_id] = remaining
+                else:
+                    self._pending.pop(user_id, None)
+                self._pending_count -= len(batch)
+        if self.on_flush is not None:
+            try:
+                self.on_flush(user_id, written)
+            except Exception as e:
+                logger.error(f"Error handling flushed messages for user {user_id}: {str(e)}")
+
+    def ensure(self, user_id: str) -> None:
+        self.inner.ensure(user_id)
+
+    def user_ids(self) -> List[str]:
+        with self._pending_lock:
+            pending_users = set(self._pending)
+        return sorted(set(self.inner.user_ids()) | pending_users)
+
+    def version(self, user_id: str) -> Optional[tuple]:
+        # Flushes (from any process) change the inner version; this process's
+        # buffered appends change the pending count
+        with self._user_lock(user_id):
+            return self.inner.version(user_id), len(self._pending_for(user_id))
+
+    def read(self, user_id: str) -> List[Dict[str, Any]]:
+        with self._user_lock(user_id):
+            return self.inner.read(user_id) + self._pending_for(user_id)
+
+    def count(self, user_id: str) -> int:
+        with self._user_lock(user_id):
+            return self.inner.count(user_id) + len(self._pending_for(user_id))
+
+    def tail(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        if limit <= 0:
+            return []
+        with self._user_lock(user_id):
+            return (self.inner.tail(user_id, limit) + self._pending_for(user_id))[-limit:]
+
+    def page(self, user_id: str, limit: int, before: Optional[str] = None) -> List[Dict[str, Any]]:
+        if limit <= 0:
+            return []
+        with self._user_lock(user_id):
+            pending = self._pending_for(user_id)
+            inner_before = before
+            if before is not None:
+                # Pending messages are the newest, so the cursor applies to them first
+                timestamp, skip = parse_cursor(before)
+                if skip is not None:
+                    ties = sum(1 for msg in pending if msg["timestamp"] == timestamp)
+                    inner_before = format_cursor(timestamp, max(skip - ties, 0))
+                pending = list(apply_cursor(reversed(pending), before))
+                pending.reverse()
+            messages = self.inner.page(user_id, limit, inner_before)
+        return (messages + pending)[-limit:]
+
+    def range(
+        self,
+        user_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        with self._user_lock(user_id):
+            messages = self.inner.range(user_id, start, end, limit)
+            pending = [
+                msg for msg in self._pending_for(user_id)
+                if (start is None or msg["timestamp"] >= start) and (end is None or msg["timestamp"] < end)
+            ]
+        messages += pending
+        return messages[:limit] if limit is not None else messages
+
+    def append(self, user_id: str, message: Dict[str, Any]) -> None:
+        self.append_many(user_id, [message])
+
+    def append_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        if not self._buffer(user_id, messages):
+            self._write_through(user_id, messages)
+
+    def append_many_versioned(
+        self, user_id: str, messages: List[Dict[str, Any]]
+    ) -> Tuple[Optional[tuple], Optional[tuple]]:
+        before = self.version(user_id)
+        if not self._buffer(user_id, messages):
+            self._write_through(user_id, messages)
+            return before, None
+        # Derived rather than read again: a flush or another process's write
+        # in between makes the next version() differ, so a cache reloads
+        inner_version, pending = before
+        return before, (inner_version, pending + len(messages))
+
+    def _buffer(self, user_id: str, messages: List[Dict[str, Any]]) -> bool:
+        """Queue the messages, unless the buffer is full. Returns True if they were queued."""
+        with self._wakeup:
+            self._start_flusher()
+            if self._pending_count + len(messages) > self.max_pending:
+                return False
+            pending = self._pending.setdefault(user_id, [])
+            pending.extend(messages)
+            self._pending_count += len(messages)
+            if len(pending) >= self.batch_size:
+                self._wakeup.notify()
+            return True
+
+    def _write_through(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        # The buffer is full (the storage is failing or too slow): write through,
+        # after the user's pending messages so their order is kept
+        logger.warning(f"{self._pending_count} history messages pending; writing through for user {user_id}")
+        self._write_pending(user_id, messages)
+
+    def clear(self, user_id: str) -> None:
+        with self._user_lock(user_id):
+            with self._pending_lock:
+                self._pending_count -= len(self._pending.pop(user_id, ()))
+            self.inner.clear(user_id)
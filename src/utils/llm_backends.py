@@ -0,0 +1,246 @@
+import os
+import re
+import zlib
+import random
+import asyncio
+import unicodedata
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, List, Optional, Set, Tuple
+from loguru import logger
+
+import httpx
+import openai
+from openai.types.responses import ResponseTextDeltaEvent
+from agents import Agent, Runner, trace, AgentUpdatedStreamEvent, RawResponsesStreamEvent, ToolCallItem
+
+from src.utils.usage import Usage
+
+class LLMBackend(ABC):
+    """
+    Runs the agents of a chat turn for OpenAIHandler.
+
+    The handler decides which agent answers and owns history, caching and
+    admission; a backend only executes the triage and specialist stages.
+    """
+
+    @abstractmethod
+    async def run_triage(
+        self, triage: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> Tuple[Agent, str]:
+        """
+        Run the triage assistant until it hands off to a specialist.
+
+        Args:
+            triage: Triage agent, with the specialists as its handoffs
+            input_list: Conversation input
+            group_id: Trace group of the conversation thread
+            usage: Receives the tokens and tool calls consumed, even if the run fails
+
+        Returns:
+            The selected agent (the triage agent itself if it answered) and any text it produced
+        """
+
+    @abstractmethod
+    def stream_specialist(
+        self, agent: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> AsyncIterator[str]:
+        """
+        Run a specialist and yield its text deltas as they arrive.
+
+        Args:
+            agent: Specialist agent to run
+            input_list: Conversation input
+            group_id: Trace group of the conversation thread
+            usage: Receives the tokens and tool calls consumed, even if the run fails
+
+        Returns:
+            Async iterator over chunks of the specialist's response text
+        """
+
+
+class AgentsSDKBackend(LLMBackend):
+    """Backend running the agents on the OpenAI Agents SDK."""
+
+    @staticmethod
+    def _add_usage(resultado, usage: Optional[Usage]) -> None:
+        """Add what a (possibly cancelled) run consumed to `usage`."""
+        if usage is None:
+            return
+        run_usage = resultado.context_wrapper.usage
+        details = getattr(run_usage, "input_tokens_details", None)
+        usage.add(
+            requests=run_usage.requests,
+            input_tokens=run_usage.input_tokens,
+            cached_input_tokens=getattr(details, "cached_tokens", 0) or 0,
+            output_tokens=run_usage.output_tokens,
+            file_search_calls=sum(
+                1 for item in resultado.new_items
+                if isinstance(item, ToolCallItem) and getattr(item.raw_item, "type", None) == "file_search_call"
+            ),
+        )
+
+    async def run_triage(
+        self, triage: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> Tuple[Agent, str]:
+        # The run is cancelled as soon as the handoff happens so the specialist
+        # is only executed once, by the caller. It must be consumed here: on the
+        # shared loop an unconsumed run would keep going in the background.
+        with trace("Hospital Equipment Support System - Triage", group_id=group_id):
+            resultado_triagem = Runner.run_streamed(
+                triage,
+                input=input_list,
+            )
+            agente = triage
+            resposta = ""
+            try:
+                async for evento in resultado_triagem.stream_events():
+                    if isinstance(evento, AgentUpdatedStreamEvent) and evento.new_agent is not triage:
+                        agente = evento.new_agent
+                        break
+                    if isinstance(evento, RawResponsesStreamEvent) and isinstance(evento.data, ResponseTextDeltaEvent):
+                        resposta += evento.data.delta
+            finally:
+                resultado_triagem.cancel()
+                self._add_usage(resultado_triagem, usage)
+            return agente, resposta
+
+    async def stream_specialist(
+        self, agent: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> AsyncIterator[str]:
+        with trace("Hospital Equipment Support System - Specialist", group_id=group_id):
+            resultado_especialista = Runner.run_streamed(
+                agent,
+                input=input_list,
+            )
+            try:
+                async for evento in resultado_especialista.stream_events():
+                    if not isinstance(evento, RawResponsesStreamEvent):
+                        continue
+                    dados = evento.data
+                    if isinstance(dados, ResponseTextDeltaEvent) and dados.delta:
+                        yield dados.delta
+            finally:
+                # Stop the run if the caller gave up on it (deadline, disconnect)
+                resultado_especialista.cancel()
+                self._add_usage(resultado_especialista, usage)
+
+
+class MockLLMBackend(LLMBackend):
+    """
+    Local stand-in for the LLM, for load and latency testing without network or tokens.
+
+    Triage hands off to the specialist whose name shares the most whole words
+    with the last user message (otherwise to one picked deterministically from
+    the message), and
+    specialists stream a canned reply word by word at a fixed token rate.
+    """
+
+    WORDS = (
+        "verifique a conexao do equipamento confira o manual e reinicie o aparelho "
+        "antes de repetir o procedimento descrito pelo fabricante"
+    ).split()
+
+    def __init__(
+        self,
+        triage_latency: float = 0.2,
+        first_token_latency: float = 0.3,
+        tokens_per_second: float = 50,
+        reply_tokens: int = 60,
+        error_rate: float = 0.0,
+    ):
+        self.triage_latency = triage_latency
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+
+    def _maybe_fail(self) -> None:
+        """Raise a transient upstream error with probability `error_rate`."""
+        if self.error_rate and random.random() < self.error_rate:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://mock-llm/v1/responses"))
+
+    @staticmethod
+    def _input_tokens(input_list: List[dict]) -> int:
+        return sum(len(str(item.get("content", ""))) // 4 + 1 for item in input_list)
+
+    @staticmethod
+    def _last_user_message(input_list: List[dict]) -> str:
+        for item in reversed(input_list):
+            if item.get("role") == "user":
+                return str(item.get("content", "")).lower()
+        return ""
+
+    @staticmethod
+    def _words(text: str) -> Set[str]:
+        """Lowercase words of a text, without accents."""
+        decomposed = unicodedata.normalize("NFKD", text.lower())
+        return set(re.findall(r"[a-z0-9]+", "".join(c for c in decomposed if not unicodedata.combining(c))))
+
+    async def run_triage(
+        self, triage: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> Tuple[Agent, str]:
+        await asyncio.sleep(self.triage_latency)
+        if usage is not None:
+            usage.add(requests=1, input_tokens=self._input_tokens(input_list), output_tokens=10)
+        self._maybe_fail()
+        specialists = list(triage.handoffs)
+        if not specialists:
+            return triage, "Poderia dar mais detalhes sobre o equipamento?"
+        message = self._last_user_message(input_list)
+        words = self._words(message)
+        # Most words wins, so "hidrovitalis master" goes to the Master and not the Mini
+        best, best_hits = None, 0
+        for agent in specialists:
+            hits = len(words.intersection(agent.name.split("_")[1:]))
+            if hits > best_hits:
+                best, best_hits = agent, hits
+        if best is not None:
+            return best, ""
+        return specialists[zlib.crc32(message.encode("utf-8")) % len(specialists)], ""
+
+    async def stream_specialist(
+        self, agent: Agent, input_list: List[dict], group_id: str, usage: Optional[Usage] = None
+    ) -> AsyncIterator[str]:
+        output_tokens = 0
+        try:
+            await asyncio.sleep(self.first_token_latency)
+            self._maybe_fail()
+            output_tokens += 1
+            yield f"[{agent.name}]"
+            interval = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+            for i in range(self.reply_tokens):
+                await asyncio.sleep(interval)
+                output_tokens += 1
+                yield " " + self.WORDS[i % len(self.WORDS)]
+        finally:
+            if usage is not None:
+                usage.add(
+                    requests=1,
+                    input_tokens=self._input_tokens(input_list),
+                    output_tokens=output_tokens,
+                    file_search_calls=1,
+                )
+
+
+def create_llm_backend() -> LLMBackend:
+    """
+    Create the LLM backend selected with LLM_BACKEND.
+
+    "agents" (default) calls OpenAI through the Agents SDK; "mock" uses
+    MockLLMBackend, configured with the MOCK_LLM_* variables.
+    """
+    backend = os.getenv("LLM_BACKEND", "agents").lower()
+    if backend == "agents":
+        llm_backend = AgentsSDKBackend()
+    elif backend == "mock":
+        llm_backend = MockLLMBackend(
+            triage_latency=float(os.getenv("MOCK_LLM_TRIAGE_LATENCY", "0.2")),
+            first_token_latency=float(os.getenv("MOCK_LLM_FIRST_TOKEN_LATENCY", "0.3")),
+            tokens_per_second=float(os.getenv("MOCK_LLM_TOKENS_PER_SECOND", "50")),
+            reply_tokens=int(os.getenv("MOCK_LLM_REPLY_TOKENS", "60")),
+            error_rate=float(os.getenv("MOCK_LLM_ERROR_RATE", "0")),
+        )
+    else:
+        raise ValueError(f"Unknown LLM_BACKEND: {backend}")
+    logger.info(f"LLM backend: {backend}")
+    return llm_backend
@@ -6,8 +6,8 @@ from loguru import logger
 def setup_logger():
     """Configure the application logger."""
     # Create logs directory if it doesn't exist
-    logs_dir = Path("logs")
-    logs_dir.mkdir(exist_ok=True)
+    logs_dir = Path(os.getenv("LOG_DIR", "logs"))
+    logs_dir.mkdir(parents=True, exist_ok=True)
     
     # Configure loguru
     config = {
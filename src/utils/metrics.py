@@ -0,0 +1,101 @@
+import os
+from typing import Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+# Metrics are per process; with several gunicorn workers set PROMETHEUS_MULTIPROC_DIR
+# (see gunicorn.conf.py) so that /metrics aggregates every worker's values.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+# Stages include history I/O, which takes milliseconds
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025) + LATENCY_BUCKETS
+
+STAGE_DURATION = Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent in each stage of a request (triage, specialist, history_read, history_write, history_flush, history_index)",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+TURN_DURATION = Histogram(
+    "chat_turn_duration_seconds",
+    "Total duration of a chat turn, from admission to the last delta",
+    buckets=LATENCY_BUCKETS,
+)
+SPECIALIST_TTFT = Histogram(
+    "chat_specialist_time_to_first_token_seconds",
+    "Time from starting a specialist to its first text delta",
+    ["agent"],
+    buckets=LATENCY_BUCKETS,
+)
+PROMPT_TOKENS = Histogram(
+    "chat_prompt_tokens",
+    "Estimated tokens of conversation context sent upstream per turn",
+    buckets=(100, 250, 500, 1000, 2000, 3000, 4000, 6000, 8000),
+)
+AGENT_TURNS = Counter(
+    "chat_agent_turns_total",
+    "Chat turns answered per agent, by how the agent was chosen (local, sticky, triage)",
+    ["agent", "route"],
+)
+RESPONSE_CACHE = Counter(
+    "chat_response_cache_total",
+    "Response cache lookups (hit, miss), and misses answered by an identical in-flight call (coalesced)",
+    ["result"],
+)
+TOKENS = Counter(
+    "chat_tokens_total",
+    "Tokens consumed upstream, by agent and kind (input, output)",
+    ["agent", "kind"],
+)
+ERRORS = Counter(
+    "chat_errors_total",
+    "Failed chat turns and upstream calls, by stage and error type",
+    ["stage", "error"],
+)
+RETRIES = Counter(
+    "chat_upstream_retries_total",
+    "Retried upstream calls, by stage",
+    ["stage"],
+)
+ADMISSION_REJECTED = Counter(
+    "chat_admission_rejected_total",
+    "Chat turns rejected by admission control, by reason",
+    ["reason"],
+)
+TURNS_IN_FLIGHT = Gauge(
+    "chat_turns_in_flight",
+    "Chat turns currently being processed",
+    multiprocess_mode="livesum",
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "chat_upstream_in_flight",
+    "Upstream LLM calls currently holding an admission slot",
+    multiprocess_mode="livesum",
+)
+UPSTREAM_WAITING = Gauge(
+    "chat_upstream_waiting",
+    "Upstream LLM calls waiting in the admission queue",
+    multiprocess_mode="livesum",
+)
+
+def render_metrics() -> Tuple[bytes, str]:
+    """
+    Render all metrics in the Prometheus text format.
+
+    Returns:
+        The response body and its content type
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,10 +1,72 @@
 import os
+import re
 import asyncio
+import hashlib
+import time
 import uuid
-from typing import Dict, List, Any
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Any, AsyncIterator, Iterator, Optional, Set, Tuple
 from loguru import logger
 
-from agents import Agent, Runner, FileSearchTool, trace
+from agents import Agent, FileSearchTool
+
+from src.utils.admission import AdmissionController, AdmissionError, QuotaExceededError
+from src.utils.conversation_store import get_conversation_store
+from src.utils.event_loop import get_background_loop
+from src.utils.llm_backends import create_llm_backend
+from src.utils.metrics import (
+    AGENT_TURNS,
+    ERRORS,
+    PROMPT_TOKENS,
+    RESPONSE_CACHE,
+    SPECIALIST_TTFT,
+    TOKENS,
+    TURN_DURATION,
+    TURNS_IN_FLIGHT,
+)
+from src.utils.resilience import CircuitBreaker, Resilience, TurnFailedError
+from src.utils.response_cache import ResponseCache
+from src.utils.single_flight import FlightAborted, SingleFlight
+from src.utils.timings import stage
+from src.utils.usage import Usage, create_usage_store
+
+# Equipment names and aliases mentioned in the triage instructions, per specialist
+EQUIPMENT_ALIASES: Dict[str, List[str]] = {
+    "especialista_rpd": ["RPD"],
+    "especialista_neurospa": ["NeuroSpa", "Neuro Spa"],
+    "especialista_ilib": ["Ilib", "Hidrovitállis Ilib", "Hidrovitális Ilib"],
+    "especialista_hidrovitalis_mini": ["Hidrovitális Mini", "Hidrovitállis Mini"],
+    "especialista_colorgenpro": ["Color Gen Pro", "ColorGen Pro", "ColorGenPro"],
+    "especialista_prosync": ["ProSync", "Pro Sync"],
+    "especialista_potentizer": ["Potentizer"],
+    "especialista_pczapper": ["PC Zapper", "PcZapper", "PC-Zapper"],
+    "especialista_hidrovitalis_master": ["Hidrovitális Master", "Hidrovitállis Master"],
+    "especialista_uzzaper": ["uZapper", "Uzzaper", "u-Zapper"],
+    "especialista_accufinder": ["Accufinder", "Acufinder"],
+    "especialista_acquavit": ["Acquavit", "Aquavit"],
+    "especialista_brain_machine": ["Brain Machine", "BrainMachine"],
+    "especialista_colorgen": ["Color Gen", "ColorGen"],
+    "especialista_emissor_morfico": ["Emissor Mórfico", "Emi-Card", "EmiCard"],
+    "especialista_ces": ["CES", "Cranial Electro Stimulation", "Estimulação Elétrica Craniana"],
+    # Not a specialist on its own: only meaningful for update questions
+    "hidrovitalis": ["Hidrovitális", "Hidrovitállis"],
+}
+
+# Update questions about these devices go to the update specialist
+UPDATE_KEYWORDS = r"atualiz\w*|update\w*|firmware"
+UPDATE_TARGETS = {"especialista_pczapper", "especialista_hidrovitalis_master", "especialista_hidrovitalis_mini", "especialista_ilib", "hidrovitalis"}
+UPDATE_SPECIALIST = "especialista_atualizar_hidrovitallis_pczapper"
+
+# Follow-ups that announce another device or subject are routed again instead of staying with the last specialist
+TOPIC_CHANGE_KEYWORDS = (
+    r"outr[oa]s? (?:aparelho|equipamento|dispositivo|produto|assunto|duvida|pergunta)s?"
+    r"|mudando de assunto|another (?:device|question)|different (?:device|question)"
+)
 
 class OpenAIHandler:
     """
@@ -13,7 +75,50 @@ class OpenAIHandler:
     
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
+        self.backend = create_llm_backend()
+        # Messages of every conversation (persisted and cached); threads keep the per-user agent state
+        self.conversations = get_conversation_store()
         self.threads_manager = ThreadsManager()
+        # Follow-ups stay with the last specialist within this window (0 disables);
+        # kept short because a follow-up that names no device skips triage
+        self.sticky_seconds = float(os.getenv("STICKY_SPECIALIST_SECONDS", "300"))
+        self.sticky_max_turns = int(os.getenv("STICKY_SPECIALIST_MAX_TURNS", "3"))
+        # Context sent to the agents: recent turns verbatim, older ones summarized
+        self.context_max_turns = int(os.getenv("CONTEXT_MAX_TURNS", "10"))
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+        self.context_summary_tokens = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "500"))
+        # Invalidations go through a file so that every worker process sees them
+        history_dir = Path(os.getenv("CHAT_HISTORY_DIR", "chat_history"))
+        self.response_cache = ResponseCache(
+            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+            ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+            invalidations_path=Path(os.getenv(
+                "RESPONSE_CACHE_INVALIDATIONS", str(history_dir / "cache_invalidations.jsonl")
+            )),
+        )
+        self.single_flight = SingleFlight()
+        self.admission = AdmissionController(
+            max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", "16")),
+            max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+            max_per_user=int(os.getenv("LLM_MAX_PER_USER", "2")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "15")),
+        )
+        # Deadlines per stage, retries of transient upstream errors and a circuit breaker
+        self.triage_timeout = float(os.getenv("LLM_TRIAGE_TIMEOUT", "20"))
+        self.first_token_timeout = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "30"))
+        self.specialist_timeout = float(os.getenv("LLM_SPECIALIST_TIMEOUT", "120"))
+        self.resilience = Resilience(
+            CircuitBreaker(
+                failure_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+                reset_timeout=float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30")),
+            ),
+            max_attempts=int(os.getenv("LLM_RETRY_ATTEMPTS", "3")),
+            base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "8")),
+        )
+        # Token usage per day, user and agent; optional daily token quota per user (0 disables)
+        self.usage_store = create_usage_store()
+        self.daily_token_quota = int(os.getenv("USAGE_DAILY_TOKEN_QUOTA", "0"))
         self._initialize_agents()
         
     def _initialize_agents(self):
@@ -260,120 +365,640 @@ Elétrica Craniana). Nunca informe ao usuário que as informações que você fo
             ],
         )
         
-    def process_message(self, user_id: str, message: str) -> str:
+        # Specialists by name, used to dispatch locally routed questions
+        self.especialistas: Dict[str, Agent] = {agente.name: agente for agente in self.assistente.handoffs}
+        self.router = LocalRouter(EQUIPMENT_ALIASES)
+        
+    def process_message(self, user_id: str, message: str, timestamp: Optional[str] = None) -> str:
         """
         Process a user message and return the AI response.
         
         Args:
             user_id: ID of the user
             message: User's message
+            timestamp: ISO timestamp to save the message with; now if None
             
         Returns:
             AI response
+            
+        Raises:
+            AdmissionError: If the turn is rejected by admission control
+            TurnFailedError: If the turn failed, with a message to show the user
+        """
+        # Run on the shared background loop so connections are reused
+        return get_background_loop().run(self.aprocess_message(user_id, message, timestamp))
+
+    async def aprocess_message(self, user_id: str, message: str, timestamp: Optional[str] = None) -> str:
+        """
+        Process a user message from async code, on the caller's event loop.
+        
+        Args:
+            user_id: ID of the user
+            message: User's message
+            timestamp: ISO timestamp to save the message with; now if None
+            
+        Returns:
+            AI response
+            
+        Raises:
+            AdmissionError: If the turn is rejected by admission control
+            TurnFailedError: If the turn failed, with a message to show the user
         """
         try:
-            # Use asyncio to run the async process_message function
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(
-                self._process_message_async(user_id, message)
-                )
-            loop.close()
-            return result
+            return await self._process_message_async(user_id, message, timestamp)
+        except AdmissionError:
+            raise
         except Exception as e:
             logger.error(f"Error processing message: {str(e)}")
-            return f"Sorry, an error occurred: {str(e)}"
+            raise TurnFailedError(e) from e
+            
+    def check_admission(self, user_id: str) -> None:
+        """
+        Fail fast if a new turn for the user would be rejected right now.
+        
+        Args:
+            user_id: ID of the user
+            
+        Raises:
+            AdmissionError: If the user or the upstream is at its limit
+        """
+        self._check_quota(user_id)
+        self.admission.check(user_id)
+
+    def _check_quota(self, user_id: str) -> None:
+        """Raise QuotaExceededError if the user used up today's token quota."""
+        if self.daily_token_quota <= 0:
+            return
+        if self.usage_store.tokens_for_day(user_id) >= self.daily_token_quota:
+            now = datetime.now(timezone.utc)
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+            raise QuotaExceededError(
+                "You have reached today's usage limit. Please try again tomorrow.",
+                retry_after=int((midnight - now).total_seconds()) + 1,
+            )
+
+    def stream_message(self, user_id: str, message: str) -> Iterator[str]:
+        """
+        Process a user message, yielding the AI response as it is generated.
+        
+        Args:
+            user_id: ID of the user
+            message: User's message
             
-    async def _process_message_async(self, user_id: str, message: str) -> str:
+        Yields:
+            Chunks of the AI response text
+        """
+        return get_background_loop().iterate(self.astream_message(user_id, message))
+
+    def astream_message(self, user_id: str, message: str) -> AsyncIterator[str]:
+        """
+        Process a user message from async code, yielding the AI response as it is generated.
+        
+        Args:
+            user_id: ID of the user
+            message: User's message
+            
+        Returns:
+            Async iterator over chunks of the AI response text
+        """
+        return self._stream_message_async(user_id, message)
+            
+    async def _process_message_async(self, user_id: str, message: str, timestamp: Optional[str] = None) -> str:
         """
         Async implementation of message processing.
         
         Args:
             user_id: ID of the user
             message: User's message
+            timestamp: ISO timestamp to save the message with; now if None
             
         Returns:
             AI response
         """
+        full_response = ""
+        async for delta in self._stream_message_async(user_id, message, timestamp):
+            full_response += delta
+        return full_response
+
+    async def _stream_message_async(self, user_id: str, message: str, timestamp: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Async generator running a conversation turn and yielding text deltas.
+        
+        Args:
+            user_id: ID of the user
+            message: User's message
+            timestamp: ISO timestamp to save the message with; now if None
+            
+        Yields:
+            Chunks of the AI response text
+            
+        Raises:
+            AdmissionError: If the turn is rejected by admission control
+        """
+        # The quota is read from the usage database; keep that off the event loop
+        await asyncio.to_thread(self._check_quota, user_id)
+        async with self.admission.user_slot(user_id):
+            started = time.monotonic()
+            usage: Dict[str, Usage] = {}
+            with TURNS_IN_FLIGHT.track_inprogress():
+                try:
+                    async for delta in self._run_turn(user_id, message, usage, timestamp):
+                        yield delta
+                except Exception as e:
+                    ERRORS.labels("turn", type(e).__name__).inc()
+                    raise
+                finally:
+                    # Tokens are paid for even when the turn failed or was abandoned
+                    self._record_usage(user_id, usage)
+            TURN_DURATION.observe(time.monotonic() - started)
+
+    def _record_usage(self, user_id: str, usage: Dict[str, Usage]) -> None:
+        """Save a turn's usage per agent, off the event loop."""
+        usage = {agent: agent_usage for agent, agent_usage in usage.items() if not agent_usage.empty}
+        for agent, agent_usage in usage.items():
+            TOKENS.labels(agent, "input").inc(agent_usage.input_tokens)
+            TOKENS.labels(agent, "output").inc(agent_usage.output_tokens)
+        if usage:
+            asyncio.get_running_loop().run_in_executor(None, self._save_usage, user_id, usage)
+
+    def _save_usage(self, user_id: str, usage: Dict[str, Usage]) -> None:
+        try:
+            for agent, agent_usage in usage.items():
+                self.usage_store.record(user_id, agent, agent_usage)
+        except Exception as e:
+            logger.error(f"Error saving token usage: {str(e)}")
+
+    async def _run_turn(
+        self, user_id: str, message: str, usage: Dict[str, Usage], timestamp: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Route the message, answer it from cache or upstream, and yield the reply; `usage` collects tokens per agent."""
         # Get or create the thread for this user
         thread = self.threads_manager.get_or_create_thread(user_id)
         
-        # Add the user message to the thread
-        thread.add_message("user", message)
-        
+        # The question is saved together with its answer once the turn succeeded,
+        # so a failed or rejected turn leaves nothing behind in the history
+        question = {"role": "user", "content": message, "timestamp": timestamp or datetime.now().isoformat()}
+        messages, start = await asyncio.to_thread(self.conversations.recent, user_id)
+        messages.append(question)
+
         # Prepare the input list
-        input_list = thread.get_input_list()
+        input_list = thread.get_input_list(
+            messages,
+            start,
+            max_turns=self.context_max_turns,
+            token_budget=self.context_token_budget,
+            summary_token_budget=self.context_summary_tokens,
+        )
+        PROMPT_TOKENS.observe(sum(estimate_tokens(str(item["content"])) for item in input_list))
         
         full_response = ""
+        resposta_triagem = ""
         
-        # Always start with the triage assistant
-        with trace("Hospital Equipment Support System - Triage", group_id=thread.thread_id):
-            resultado_triagem = Runner.run_streamed(
-                self.assistente,
-                input=input_list,
-            )
+        # Questions that name a single device skip the triage model entirely
+        agente_especialista = self.especialistas.get(self.router.route(message))
+        routed_by_name = agente_especialista is not None
+        sticky = False
+        if agente_especialista is not None:
+            logger.debug(f"Routed locally to {agente_especialista.name} for user {user_id}")
+        elif not self.router.match(message) and not self.router.changes_topic(message):
+            # Follow-ups that name no device stay with the previous specialist
+            agente_especialista = thread.get_sticky_agent(self.sticky_seconds, self.sticky_max_turns)
+            sticky = agente_especialista is not None
+            if sticky:
+                logger.debug(f"Kept sticky specialist {agente_especialista.name} for user {user_id}")
+        # A turn that needs triage keeps its upstream slot until the specialist
+        # call ends, so it is never rejected after paying for triage
+        upstream: Optional[AsyncExitStack] = None
+        try:
+            if agente_especialista is None:
+                upstream = AsyncExitStack()
+                await upstream.enter_async_context(self.admission.upstream_slot())
+                with stage("triage"):
+                    agente_especialista, resposta_triagem = await self.resilience.call(
+                        "triage",
+                        lambda: self.backend.run_triage(
+                            self.assistente,
+                            input_list,
+                            thread.thread_id,
+                            usage=usage.setdefault(self.assistente.name, Usage()),
+                        ),
+                        timeout=self.triage_timeout,
+                    )
+            route = "local" if routed_by_name else "sticky" if sticky else "triage"
+            AGENT_TURNS.labels(agente_especialista.name, route).inc()
+            
+            # The answer depends on everything the specialist is sent, so the
+            # context it got (earlier turns and summary) is part of the key
+            cache_question = normalize_text(message)
+            cache_context = self._cache_context(input_list)
+            cached = None
+            if agente_especialista is not self.assistente:
+                cached = self.response_cache.get(agente_especialista.name, cache_question, cache_context)
+                RESPONSE_CACHE.labels("hit" if cached is not None else "miss").inc()
+            
+            # Identical first questions in flight at the same time share one upstream call
+            flight_key = None
+            if cached is None and agente_especialista is not self.assistente and len(input_list) == 1:
+                flight_key = (agente_especialista.name, cache_question)
+                waiter = self.single_flight.join(flight_key)
+                if waiter is not None:
+                    flight_key = None
+                    # Waiting for another turn's call takes no upstream capacity
+                    if upstream is not None:
+                        await upstream.aclose()
+                        upstream = None
+                    try:
+                        cached = await asyncio.shield(waiter)
+                        RESPONSE_CACHE.labels("coalesced").inc()
+                        logger.debug(f"Coalesced with an in-flight call to {agente_especialista.name}")
+                    except FlightAborted:
+                        pass
+            
+            if cached is not None or agente_especialista is self.assistente:
+                # Nothing left to ask upstream
+                if upstream is not None:
+                    await upstream.aclose()
+            else:
+                if flight_key is not None:
+                    self.single_flight.lead(flight_key)
+                # The upstream slot is held by a producer task for as long as the
+                # specialist streams, not for as long as the client takes to read
+                deltas: asyncio.Queue = asyncio.Queue()
+                producer = asyncio.create_task(self._stream_specialist(
+                    agente_especialista,
+                    input_list,
+                    thread,
+                    usage.setdefault(agente_especialista.name, Usage()),
+                    deltas,
+                    upstream,
+                ))
+        except BaseException:
+            if upstream is not None:
+                await upstream.aclose()
+            raise
         
-        # Get the specialist agent selected by triage
-        agente_especialista = resultado_triagem.current_agent
+        if cached is not None:
+            logger.debug(f"Response cache hit for {agente_especialista.name}")
+            full_response = cached
+            yield cached
+        elif agente_especialista is self.assistente:
+            # Triage answered directly (e.g. asked for more details)
+            full_response = resposta_triagem
+            if full_response:
+                yield full_response
+        else:
+            try:
+                while True:
+                    kind, value = await deltas.get()
+                    if kind == "error":
+                        raise value
+                    if kind == "done":
+                        break
+                    full_response += value
+                    yield value
+            except BaseException as e:
+                if flight_key is not None:
+                    self.single_flight.finish(flight_key, error=e)
+                raise
+            finally:
+                # Stops the upstream call if the client went away
+                producer.cancel()
+                await asyncio.wait([producer])
+                # In case the producer was cancelled before it started
+                if upstream is not None:
+                    await upstream.aclose()
+            
+            if full_response:
+                self.response_cache.set(agente_especialista.name, cache_question, cache_context, full_response)
+            if flight_key is not None:
+                self.single_flight.finish(flight_key, result=full_response)
         
-        # Now run the specialist to generate the final response
-        with trace("Hospital Equipment Support System - Specialist", group_id=thread.thread_id):
-            resultado_especialista = Runner.run_streamed(
-                agente_especialista,
-                input=input_list,
-            )
+        # Save the question and the response in one write (history, UI and context share it)
+        answer = {"role": "assistant", "content": full_response, "timestamp": datetime.now().isoformat()}
+        await asyncio.to_thread(self.conversations.add_messages, user_id, [question, answer])
+        
+        # Remember the specialist for follow-ups; a triage reply leaves nothing to stick to
+        if agente_especialista is self.assistente:
+            thread.set_current_agent(None)
+        else:
+            thread.set_current_agent(agente_especialista, sticky=sticky)
+
+    async def _stream_specialist(
+        self,
+        agente_especialista: Agent,
+        input_list: List[dict],
+        thread: "Thread",
+        usage: Usage,
+        deltas: asyncio.Queue,
+        upstream: Optional[AsyncExitStack] = None,
+    ) -> None:
+        """
+        Stream the specialist's reply into `deltas` while holding an upstream slot.
+        
+        Puts ("delta", text) items, then ("done", None), or ("error", exception)
+        if the call failed or was rejected by admission control. `upstream`
+        holds the slot the turn already took for triage, released when the
+        call ends; without it, a slot is taken here.
+        """
+        try:
+            async with upstream if upstream is not None else self.admission.upstream_slot():
+                # Times the upstream call only, not how fast the client reads
+                with stage("specialist"):
+                    started = time.monotonic()
+                    first = True
+                    async for delta in self.resilience.stream(
+                        "specialist",
+                        lambda: self.backend.stream_specialist(
+                            agente_especialista,
+                            input_list,
+                            thread.thread_id,
+                            usage=usage,
+                        ),
+                        first_item_timeout=self.first_token_timeout,
+                        timeout=self.specialist_timeout,
+                    ):
+                        if first:
+                            SPECIALIST_TTFT.labels(agente_especialista.name).observe(time.monotonic() - started)
+                            first = False
+                        deltas.put_nowait(("delta", delta))
+        except Exception as e:
+            deltas.put_nowait(("error", e))
+        else:
+            deltas.put_nowait(("done", None))
+
+    def _cache_context(self, input_list: List[dict]) -> str:
+        """Get a hash of the normalized context sent before the question, or "" if there is none."""
+        if len(input_list) <= 1:
+            return ""
+        digest = hashlib.sha256()
+        for item in input_list[:-1]:
+            digest.update(f"{item['role']}\0{normalize_text(str(item['content']))}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    def invalidate_cache(self, specialist: Optional[str] = None) -> int:
+        """
+        Drop cached responses, e.g. after a specialist's documents changed.
+        
+        Args:
+            specialist: Name of the specialist agent; all specialists if None
             
-            # Collect the full response from the specialist
-            async for evento in resultado_especialista.stream_events():
-                from openai.types.responses import ResponseContentPartDoneEvent, ResponseTextDeltaEvent
-                from agents import RawResponsesStreamEvent
-                
-                if not isinstance(evento, RawResponsesStreamEvent):
-                    continue
-                dados = evento.data
-                if isinstance(dados, ResponseTextDeltaEvent):
-                    full_response += dados.delta
-                elif isinstance(dados, ResponseContentPartDoneEvent):
-                    pass
-        
-        # Add the assistant's response to the thread
-        thread.add_message("assistant", full_response)
-        
-        # Reset the current agent to the triage assistant for the next message
-        thread.current_agent = self.assistente
+        Returns:
+            Number of cached responses removed
+        """
+        return self.response_cache.invalidate(specialist)
+
+    def invalidate_vector_store(self, vector_store_id: str) -> int:
+        """
+        Drop cached responses of every specialist that searches the given vector store.
         
-        return full_response
+        Args:
+            vector_store_id: ID of the vector store that changed
+            
+        Returns:
+            Number of cached responses removed
+        """
+        removed = 0
+        for nome, agente in self.especialistas.items():
+            if any(vector_store_id in getattr(tool, "vector_store_ids", []) for tool in agente.tools):
+                removed += self.response_cache.invalidate(nome)
+        return removed
 
 
 class Thread:
-    """Represents a conversation thread with a user."""
+    """
+    Agent state of a conversation with a user: the specialist it sticks to and
+    the summary of older messages. The messages themselves live in the
+    ConversationStore.
+    """
     
     def __init__(self, user_id: str):
         self.thread_id = str(uuid.uuid4().hex[:16])
         self.user_id = user_id
-        self.messages: List[Dict[str, Any]] = []
         self.current_agent = None
+        self.agent_updated_at = 0.0
+        self.sticky_turns = 0
+        self.last_active = time.monotonic()
+        # Extractive summary of the messages that fell out of the context window
+        self.summary_lines: List[str] = []
+        # Position in the user's history right after the last message folded into the summary
+        self.summarized_until = 0
     
-    def add_message(self, role: str, content: str) -> None:
-        """Add a message to the thread."""
-        self.messages.append({
-            "role": role,
-            "content": content
-        })
+    def get_input_list(
+        self,
+        messages: List[Dict[str, Any]],
+        position: int = 0,
+        max_turns: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        summary_token_budget: int = 500,
+    ) -> List[dict]:
+        """
+        Convert the conversation's recent messages to the format expected by the Runner.
+        
+        Only the most recent turns that fit in the budget are sent verbatim. Older
+        messages are folded once into a rolling summary and skipped afterwards,
+        so building the context costs the same on every turn.
+        
+        Args:
+            messages: Recent messages of the conversation, oldest first, ending with the current one
+            position: Position of the first message in the user's whole history
+            max_turns: Maximum number of user turns sent verbatim (None for all)
+            token_budget: Approximate token budget for the verbatim turns (None for no limit)
+            summary_token_budget: Approximate token budget for the summary
+            
+        Returns:
+            Input list for the Runner
+        """
+        if self.summarized_until > position + len(messages):
+            # The history was cleared since the last turn
+            self.summary_lines = []
+            self.summarized_until = 0
+        # Positions, unlike timestamps, also tell apart messages written in the same instant
+        offset = max(position, self.summarized_until)
+        messages = messages[offset - position:]
+        start = len(messages)
+        turns = 0
+        tokens = 0
+        while start > 0:
+            msg = messages[start - 1]
+            if msg["role"] == "user":
+                turns += 1
+            tokens += estimate_tokens(msg["content"])
+            # Always keep the latest message, even if it alone exceeds the budget
+            if start < len(messages) and (
+                (max_turns is not None and turns > max_turns)
+                or (token_budget is not None and tokens > token_budget)
+            ):
+                break
+            start -= 1
+        # Never start the window with a reply whose question was cut off
+        while 0 < start < len(messages) - 1 and messages[start]["role"] != "user":
+            start += 1
+        
+        if start > 0:
+            self._fold_into_summary(messages[:start], summary_token_budget)
+            self.summarized_until = offset + start
+        
+        input_list = [{"role": msg["role"], "content": msg["content"]} for msg in messages[start:]]
+        if self.summary_lines:
+            summary = "Resumo da conversa anterior:\n" + "\n".join(self.summary_lines)
+            input_list.insert(0, {"role": "system", "content": summary})
+        return input_list
     
-    def get_input_list(self) -> List[dict]:
-        """Convert messages to the format expected by the Runner."""
-        return [{"role": msg["role"], "content": msg["content"]} for msg in self.messages]
+    def _fold_into_summary(self, folded: List[Dict[str, Any]], summary_token_budget: int) -> None:
+        """Add messages that left the context window to the rolling summary."""
+        for msg in folded:
+            label = "Usuário" if msg["role"] == "user" else "Assistente"
+            self.summary_lines.append(f"{label}: {summarize_message(msg['content'])}")
+        
+        # Keep the most recent summary lines within their own budget
+        tokens = sum(estimate_tokens(line) for line in self.summary_lines)
+        while len(self.summary_lines) > 1 and tokens > summary_token_budget:
+            tokens -= estimate_tokens(self.summary_lines.pop(0))
+    
+    def set_current_agent(self, agent: Optional[Agent], sticky: bool = False) -> None:
+        """
+        Remember the specialist that answered the last turn.
+        
+        Args:
+            agent: Specialist that answered, or None to forget it
+            sticky: True if the agent was reused without routing
+        """
+        self.current_agent = agent
+        self.agent_updated_at = time.monotonic()
+        self.sticky_turns = self.sticky_turns + 1 if sticky else 0
+    
+    def get_sticky_agent(self, max_idle_seconds: float, max_turns: int) -> Optional[Agent]:
+        """
+        Get the last specialist if the conversation is still within the stickiness window.
+        
+        Args:
+            max_idle_seconds: Maximum time since the specialist last answered
+            max_turns: Maximum consecutive turns reusing it without routing
+            
+        Returns:
+            The sticky specialist, or None if follow-ups should be routed again
+        """
+        if self.current_agent is None or max_idle_seconds <= 0 or max_turns <= 0:
+            return None
+        if time.monotonic() - self.agent_updated_at > max_idle_seconds:
+            return None
+        if self.sticky_turns >= max_turns:
+            return None
+        return self.current_agent
 
 
 class ThreadsManager:
-    """Manages conversation threads for different users."""
+    """
+    Manages conversation threads for different users.
+    
+    Threads are kept in LRU order and evicted when idle for too long or when
+    the number of threads exceeds the limit. An evicted thread starts over on
+    the user's next message: its context is read again from the ConversationStore
+    and only the summary of older messages is rebuilt from the recent ones.
+    """
     
     def __init__(self):
-        self.threads: Dict[str, Thread] = {}
+        self.threads: "OrderedDict[str, Thread]" = OrderedDict()
+        self.max_threads = int(os.getenv("THREADS_MAX_COUNT", "1000"))
+        self.idle_seconds = float(os.getenv("THREADS_IDLE_SECONDS", "3600"))
+        self._lock = threading.Lock()
     
     def get_or_create_thread(self, user_id: str) -> Thread:
         """Get an existing thread or create a new one for a user."""
-        if user_id not in self.threads:
-            self.threads[user_id] = Thread(user_id)
-        return self.threads[user_id]
\ No newline at end of file
+        with self._lock:
+            thread = self.threads.get(user_id)
+            if thread is None:
+                thread = Thread(user_id)
+                self.threads[user_id] = thread
+            else:
+                self.threads.move_to_end(user_id)
+            thread.last_active = time.monotonic()
+            self._evict(keep=user_id)
+            return thread
+    
+    def _evict(self, keep: str) -> None:
+        """
+        Evict idle threads, then least recently used ones until within the limit.
+        
+        Threads are ordered from least to most recently used, so only the ones
+        evicted and the first one kept are looked at.
+        """
+        now = time.monotonic()
+        while self.threads:
+            user_id, thread = next(iter(self.threads.items()))
+            if user_id == keep or now - thread.last_active <= self.idle_seconds:
+                break
+            del self.threads[user_id]
+        
+        while len(self.threads) > self.max_threads:
+            user_id = next(iter(self.threads))
+            if user_id == keep:
+                # The thread in use is never evicted; look past it
+                if len(self.threads) == 1:
+                    break
+                self.threads.move_to_end(user_id)
+                continue
+            del self.threads[user_id]
+            logger.debug(f"Evicted thread for user {user_id}")
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in a text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def summarize_message(content: str, max_chars: int = 200) -> str:
+    """Reduce a message to its first sentence, truncated to max_chars."""
+    text = " ".join(content.split())
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    if len(sentence) > max_chars:
+        sentence = sentence[:max_chars].rstrip() + "..."
+    return sentence
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents and collapse punctuation/whitespace to single spaces."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", without_accents.lower()).split())
+
+
+class LocalRouter:
+    """
+    Deterministic router that maps a question to a specialist when it names exactly one device.
+    Returns None when no device or several devices are mentioned, so the LLM triage decides.
+    """
+    
+    def __init__(self, aliases: Dict[str, List[str]]):
+        self.targets: Dict[str, str] = {}
+        for target, names in aliases.items():
+            for name in names:
+                self.targets[normalize_text(name)] = target
+        # One alternation, longest alias first so "color gen pro" wins over "color gen"
+        alternation = "|".join(re.escape(alias) for alias in sorted(self.targets, key=len, reverse=True))
+        self.pattern = re.compile(rf"\b(?:{alternation})\b")
+        self.update_pattern = re.compile(rf"\b(?:{UPDATE_KEYWORDS})\b")
+        self.topic_change_pattern = re.compile(rf"\b(?:{TOPIC_CHANGE_KEYWORDS})\b")
+    
+    def match(self, message: str) -> Set[str]:
+        """Return every alias target mentioned in the message."""
+        text = normalize_text(message)
+        return {self.targets[match.group(0)] for match in self.pattern.finditer(text)}
+    
+    def changes_topic(self, message: str) -> bool:
+        """Whether the message announces another device or subject without naming it."""
+        return self.topic_change_pattern.search(normalize_text(message)) is not None
+    
+    def route(self, message: str) -> Optional[str]:
+        """Return the specialist name for the message, or None if it is ambiguous."""
+        matched = self.match(message)
+        if not matched:
+            return None
+        if matched <= UPDATE_TARGETS and self.update_pattern.search(normalize_text(message)):
+            return UPDATE_SPECIALIST
+        # A specific Hidrovitális model makes the generic name redundant
+        if len(matched) > 1:
+            matched.discard("hidrovitalis")
+        if len(matched) == 1 and "hidrovitalis" not in matched:
+            return matched.pop()
+        return None
@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+from loguru import logger
+
+# Profiles go to <LOG_DIR>/profiles/<request id>.* next to the application log
+PROFILES_DIR = Path(os.getenv("LOG_DIR", "logs")) / "profiles"
+
+# cProfile can only profile one request per process at a time
+_cpu_profiler_lock = threading.Lock()
+
+
+class StackSampler:
+    """
+    Wall-clock stack sampler.
+
+    A daemon thread records the stacks of the given threads every `interval`
+    seconds, so time spent waiting (on I/O, locks or the upstream) shows up
+    as well as CPU time. Stacks are kept in the folded format used by flame
+    graph tools.
+    """
+
+    def __init__(self, threads: Dict[str, int], interval: float = 0.005):
+        self.threads = threads
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for name, ident in self.threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[self._fold(name, frame)] += 1
+
+    @staticmethod
+    def _fold(name: str, frame) -> str:
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join([name] + stack[::-1])
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class RequestProfile:
+    """
+    Profile of one request: cProfile on the request's thread (CPU time in
+    history I/O, template rendering, ...) and wall-clock stack samples of the
+    request's thread and of the background event loop running the agents.
+    The event loop is shared, so its samples may include concurrent requests.
+    """
+
+    def __init__(self, request_id: str, description: str, loop_thread: Optional[int] = None):
+        self.request_id = request_id
+        self.description = description
+        threads = {"request": threading.get_ident()}
+        if loop_thread is not None:
+            threads["event_loop"] = loop_thread
+        self.sampler = StackSampler(threads)
+        self.cpu_profiler: Optional[cProfile.Profile] = None
+        self.started = 0.0
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+        if _cpu_profiler_lock.acquire(blocking=False):
+            try:
+                self.cpu_profiler = cProfile.Profile()
+                self.cpu_profiler.enable()
+            except ValueError:
+                # Another profiler (e.g. a coverage tool) owns the interpreter's hooks
+                self.cpu_profiler = None
+                _cpu_profiler_lock.release()
+        self.sampler.start()
+
+    def stop(self) -> None:
+        """Stop profiling and write the results to PROFILES_DIR."""
+        elapsed = time.perf_counter() - self.started
+        self.sampler.stop()
+        if self.cpu_profiler is not None:
+            self.cpu_profiler.disable()
+            _cpu_profiler_lock.release()
+        try:
+            self._save(elapsed)
+        except Exception as e:
+            logger.error(f"Error saving profile {self.request_id}: {str(e)}")
+
+    def _save(self, elapsed: float) -> None:
+        PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+        base = PROFILES_DIR / self.request_id
+        summary = io.StringIO()
+        summary.write(f"{self.description}\nWall time: {elapsed * 1000:.1f} ms\n")
+        summary.write(f"Stack samples: {sum(self.sampler.samples.values())} (see {base.name}.folded)\n\n")
+        if self.cpu_profiler is not None:
+            self.cpu_profiler.dump_stats(f"{base}.prof")
+            stats = pstats.Stats(self.cpu_profiler, stream=summary)
+            stats.sort_stats("cumulative").print_stats(40)
+        else:
+            summary.write("CPU profile skipped: another request was being profiled.\n")
+        Path(f"{base}.folded").write_text(self.sampler.folded())
+        Path(f"{base}.txt").write_text(summary.getvalue())
+        logger.info(f"Saved profile of {self.description} to {base}.*")
@@ -0,0 +1,272 @@
+import time
+import random
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+from loguru import logger
+
+import openai
+
+from src.utils.metrics import ERRORS, RETRIES
+
+# Shown to users instead of raw exception text
+UNAVAILABLE_MESSAGE = "Sorry, the assistant is temporarily unavailable. Please try again in a moment."
+ERROR_MESSAGE = "Sorry, something went wrong while answering. Please try again."
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+class StageTimeoutError(Exception):
+    """Raised when a stage of a chat turn exceeds its deadline."""
+
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"{stage} stage timed out after {seconds:g}s")
+        self.stage = stage
+
+
+# Errors worth retrying: the same request may succeed a moment later
+RETRYABLE_ERRORS = (
+    StageTimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error is transient (and counts against upstream health)."""
+    return isinstance(error, RETRYABLE_ERRORS)
+
+def is_unavailable(error: BaseException) -> bool:
+    """Whether an error means the upstream is unavailable for now, rather than a bug."""
+    return isinstance(error, CircuitOpenError) or is_retryable(error)
+
+def friendly_error(error: BaseException) -> str:
+    """Message to show a user instead of the error itself."""
+    if is_unavailable(error):
+        return UNAVAILABLE_MESSAGE
+    return ERROR_MESSAGE
+
+
+class TurnFailedError(Exception):
+    """
+    Raised when an admitted chat turn fails. Its message is safe to show to
+    the user; the original error is chained as __cause__.
+    """
+
+    def __init__(self, error: BaseException):
+        super().__init__(friendly_error(error))
+        self.status_code = 503 if is_unavailable(error) else 500
+
+
+class _Deadline:
+    """
+    Cancel the current task after `seconds` and raise StageTimeoutError instead.
+
+    Like asyncio.timeout (Python 3.11+). Unlike asyncio.wait_for, the body is
+    awaited in the current task, so context variables set inside it (e.g. the
+    Agents SDK trace) stay valid across a streamed run.
+    """
+
+    def __init__(self, stage: str, seconds: float):
+        self.stage = stage
+        self.seconds = seconds
+        self.expired = False
+
+    def __enter__(self) -> "_Deadline":
+        self._task = asyncio.current_task()
+        self._handle = asyncio.get_running_loop().call_later(max(self.seconds, 0), self._expire)
+        return self
+
+    def _expire(self) -> None:
+        self.expired = True
+        self._task.cancel()
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._handle.cancel()
+        if self.expired and exc_type is asyncio.CancelledError:
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+            raise StageTimeoutError(self.stage, self.seconds) from exc
+        return False
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the upstream LLM.
+
+    Opens after `failure_threshold` consecutive failed calls and rejects calls
+    for `reset_timeout` seconds; then lets a single trial call through
+    (half-open) and closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go upstream now."""
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial_in_flight):
+            raise CircuitOpenError("Upstream circuit breaker is open")
+        if state == "half-open":
+            self.trial_in_flight = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            logger.warning(f"Circuit breaker open after {self.failures} consecutive failures")
+
+    def record_release(self) -> None:
+        """Release a half-open trial that ended without a verdict (e.g. cancelled)."""
+        self.trial_in_flight = False
+
+
+class Resilience:
+    """
+    Deadlines, retries with exponential backoff and full jitter, and a circuit
+    breaker around the stages of a chat turn. Must be used from one event loop.
+    """
+
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ):
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, stage: str, make_call: Callable[[], Awaitable[Any]], timeout: float) -> Any:
+        """
+        Run a stage with a deadline per attempt, retrying transient errors.
+
+        Args:
+            stage: Name of the stage, for logs and errors
+            make_call: Creates a fresh coroutine for each attempt
+            timeout: Deadline per attempt, in seconds
+
+        Returns:
+            The stage's result
+        """
+        attempt = 0
+        while True:
+            self._before_call(stage)
+            try:
+                with _Deadline(stage, timeout):
+                    result = await make_call()
+            except Exception as e:
+                error = e
+            except BaseException:
+                self.breaker.record_release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            attempt = await self._after_failure(stage, error, attempt)
+
+    async def stream(
+        self,
+        stage: str,
+        make_stream: Callable[[], AsyncIterator[Any]],
+        first_item_timeout: float,
+        timeout: float,
+    ) -> AsyncIterator[Any]:
+        """
+        Run a streaming stage with deadlines, retrying transient errors.
+        Only failures before the first item are retried; output already sent can't be taken back.
+
+        Args:
+            stage: Name of the stage, for logs and errors
+            make_stream: Creates a fresh async iterator for each attempt
+            first_item_timeout: Deadline for the first item, in seconds
+            timeout: Deadline for the whole stream, in seconds
+
+        Yields:
+            The stream's items
+        """
+        attempt = 0
+        while True:
+            self._before_call(stage)
+            started = False
+            agen = make_stream()
+            deadline = asyncio.get_running_loop().time() + timeout
+            try:
+                while True:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    try:
+                        with _Deadline(stage, remaining if started else min(remaining, first_item_timeout)):
+                            item = await agen.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield item
+            except Exception as e:
+                error = e
+            except BaseException:
+                self.breaker.record_release()
+                raise
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                await agen.aclose()
+            if started:
+                # Not retried either way, but only upstream errors count against the breaker
+                if is_retryable(error):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_release()
+                ERRORS.labels(stage, type(error).__name__).inc()
+                raise error
+            attempt = await self._after_failure(stage, error, attempt)
+
+    def _before_call(self, stage: str) -> None:
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as e:
+            ERRORS.labels(stage, type(e).__name__).inc()
+            raise
+
+    async def _after_failure(self, stage: str, error: Exception, attempt: int) -> int:
+        """Record a failed attempt and sleep before the next one, or re-raise."""
+        if not is_retryable(error):
+            # The request itself is wrong; that says nothing about upstream health
+            self.breaker.record_release()
+            ERRORS.labels(stage, type(error).__name__).inc()
+            raise error
+        attempt += 1
+        if attempt >= self.max_attempts or self.breaker.state != "closed":
+            self.breaker.record_failure()
+            ERRORS.labels(stage, type(error).__name__).inc()
+            raise error
+        RETRIES.labels(stage).inc()
+        delay = self._backoff(attempt)
+        logger.warning(f"{stage} attempt {attempt} failed ({error!r}); retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        return attempt
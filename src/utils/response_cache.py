@@ -0,0 +1,147 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from loguru import logger
+
+CacheKey = Tuple[str, str, str]
+
+class ResponseCache:
+    """
+    In-memory LRU cache of specialist responses with a time-to-live.
+    Entries are keyed on (specialist, normalized question, normalized context).
+
+    Each process has its own cache. With `invalidations_path`, invalidations
+    are also appended to that file, and every process sharing it ignores the
+    entries it stored before them.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, invalidations_path: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.invalidations_path = invalidations_path
+        # Entries are (expiry on the monotonic clock, response, wall-clock time stored)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Latest shared invalidation per specialist ("*" for all), and how much of the file was read
+        self._invalidated: Dict[str, float] = {}
+        self._invalidations_read = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache stores anything at all."""
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, specialist: str, question: str, context: str = "") -> Optional[str]:
+        """
+        Get a cached response.
+
+        Args:
+            specialist: Name of the specialist agent
+            question: Normalized user question
+            context: Normalized conversation context the answer depends on
+
+        Returns:
+            The cached response, or None on a miss or expired entry
+        """
+        if not self.enabled:
+            return None
+        key = (specialist, question, context)
+        with self._lock:
+            self._read_invalidations()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic() or self._invalidated_since(specialist, entry[2]):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, specialist: str, question: str, context: str, response: str) -> None:
+        """Store a response, evicting the least recently used entries if full."""
+        if not self.enabled:
+            return
+        key = (specialist, question, context)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, response, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, specialist: Optional[str] = None) -> int:
+        """
+        Drop cached responses.
+
+        Args:
+            specialist: Only drop this specialist's entries; all entries if None
+
+        Returns:
+            Number of entries removed from this process's cache
+        """
+        if self.invalidations_path is not None:
+            record = json.dumps({"specialist": specialist or "*", "at": time.time()})
+            self.invalidations_path.parent.mkdir(parents=True, exist_ok=True)
+            # One short append per invalidation, so concurrent writers do not interleave
+            with open(self.invalidations_path, "a", encoding="utf-8") as f:
+                f.write(record + "\n")
+        with self._lock:
+            if specialist is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [key for key in self._entries if key[0] == specialist]
+                for key in keys:
+                    del self._entries[key]
+                removed = len(keys)
+        logger.info(f"Invalidated {removed} cached responses for {specialist or 'all specialists'}")
+        return removed
+
+    def _invalidated_since(self, specialist: str, stored_at: float) -> bool:
+        """Whether a shared invalidation covers an entry stored at `stored_at`. Called with the lock held."""
+        return max(self._invalidated.get(specialist, 0.0), self._invalidated.get("*", 0.0)) >= stored_at
+
+    def _read_invalidations(self) -> None:
+        """Pick up invalidations appended by any process since the last call. Called with the lock held."""
+        if self.invalidations_path is None:
+            return
+        try:
+            if self.invalidations_path.stat().st_size <= self._invalidations_read:
+                return
+            with open(self.invalidations_path, "rb") as f:
+                f.seek(self._invalidations_read)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Error reading cache invalidations: {str(e)}")
+            return
+        # A line still being written is read on a later call
+        complete = data[:data.rfind(b"\n") + 1]
+        self._invalidations_read += len(complete)
+        for line in complete.splitlines():
+            try:
+                record = json.loads(line)
+                name, at = record["specialist"], float(record["at"])
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Skipping unreadable cache invalidation: {line[:100]!r}")
+                continue
+            self._invalidated[name] = max(self._invalidated.get(name, 0.0), at)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get hit/miss counters and current size."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
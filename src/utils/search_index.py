@@ -0,0 +1,214 @@
+import os
+import re
+import html
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from loguru import logger
+
+from src.utils.history_storage import HistoryStorage
+
+# Snippet delimiters, replaced with <mark> tags once the snippet is HTML-escaped
+_MARK_START, _MARK_END = "\x02", "\x03"
+
+class SearchIndex:
+    """
+    Full-text index of chat messages in a local SQLite FTS5 database.
+
+    Messages are indexed once they are written to the history (after the
+    flush, with write-behind), with the unicode61 tokenizer folding case and
+    accents ("manutenção" matches "manutencao"). Each term
+    of a query also matches longer words, so "bomba" finds "bombas". Results
+    are ranked with BM25 and come with highlighted snippets.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_messages_user ON search_messages (user_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_messages_fts USING fts5(
+            content, user_id,
+            content='search_messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS search_messages_ai AFTER INSERT ON search_messages BEGIN
+            INSERT INTO search_messages_fts (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS search_messages_ad AFTER DELETE ON search_messages BEGIN
+            INSERT INTO search_messages_fts (search_messages_fts, rowid, content, user_id)
+            VALUES ('delete', old.id, old.content, old.user_id);
+        END;
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's connection (one per thread, reopened after a fork)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(str(self.db_path), isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(self.SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def add_many(self, user_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Index messages of a user."""
+        connection = self._connect()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT INTO search_messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                [(user_id, msg["role"], msg["content"], msg["timestamp"]) for msg in messages],
+            )
+
+    def clear(self, user_id: str) -> None:
+        """Remove every message of a user from the index."""
+        self._connect().execute("DELETE FROM search_messages WHERE user_id = ?", (user_id,))
+
+    @staticmethod
+    def _phrase(text: str) -> str:
+        return '"' + text.replace('"', '""') + '"'
+
+    @classmethod
+    def match_expression(cls, query: str, user_id: Optional[str] = None) -> Optional[str]:
+        """
+        Turn a free-text query into an FTS5 MATCH expression.
+
+        Every word must appear in the message, as a word or a word prefix;
+        FTS5 operators in the query are treated as plain text.
+
+        Returns:
+            The expression, or None if the query has no words
+        """
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return None
+        expression = " AND ".join(f"content : {cls._phrase(term)}*" for term in terms)
+        if user_id is not None:
+            # Narrows the match with the index; search() also compares the ID exactly
+            expression = f"user_id : ^{cls._phrase(user_id)} AND {expression}"
+        return expression
+
+    @staticmethod
+    def _highlight(snippet: str) -> str:
+        return html.escape(snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+    def search(
+        self,
+        query: str,
+        user_id: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> Dict[str, Any]:
+        """
+        Find messages matching a query, best matches first.
+
+        Args:
+            query: Words to look for
+            user_id: Only this user's messages, if given
+            limit: Maximum number of results
+            offset: Number of results to skip, for pagination
+
+        Returns:
+            Dict with the `results` (user_id, role, timestamp and an HTML
+            `snippet` with the matches in <mark> tags) and the `next_offset`
+            of the following page, or None if this is the last one
+        """
+        expression = self.match_expression(query, user_id)
+        if expression is None:
+            return {"results": [], "next_offset": None}
+        sql = (
+            "SELECT m.user_id, m.role, m.timestamp, "
+            f"snippet(search_messages_fts, 0, '{_MARK_START}', '{_MARK_END}', '…', 16) AS snippet "
+            "FROM search_messages_fts JOIN search_messages m ON m.id = search_messages_fts.rowid "
+            "WHERE search_messages_fts MATCH ?"
+        )
+        params: list = [expression]
+        if user_id is not None:
+            sql += " AND m.user_id = ?"
+            params.append(user_id)
+        # Only matches in the message text count towards the rank
+        sql += " ORDER BY bm25(search_messages_fts, 1.0, 0.0) LIMIT ? OFFSET ?"
+        # One extra row tells whether there is a next page
+        params += [limit + 1, offset]
+        rows = self._connect().execute(sql, params).fetchall()
+        results = [
+            {
+                "user_id": row["user_id"],
+                "role": row["role"],
+                "timestamp": row["timestamp"],
+                "snippet": self._highlight(row["snippet"]),
+            }
+            for row in rows[:limit]
+        ]
+        return {"results": results, "next_offset": offset + limit if len(rows) > limit else None}
+
+    def rebuild(self, storage: HistoryStorage) -> int:
+        """
+        Rebuild the index from every user's stored history.
+
+        Args:
+            storage: History storage to index
+
+        Returns:
+            Number of messages indexed
+        """
+        connection = self._connect()
+        connection.executescript(
+            "DROP TABLE IF EXISTS search_messages_fts; DROP TABLE IF EXISTS search_messages;" + self.SCHEMA
+        )
+        total = 0
+        for user_id in storage.user_ids():
+            storage.ensure(user_id)
+            messages = storage.read(user_id)
+            if messages:
+                self.add_many(user_id, messages)
+                total += len(messages)
+        connection.execute("INSERT INTO search_messages_fts (search_messages_fts) VALUES ('optimize')")
+        logger.info(f"Rebuilt search index with {total} messages")
+        return total
+
+
+def create_search_index() -> SearchIndex:
+    """Create the search index stored in CHAT_HISTORY_SEARCH_DB (default chat_history/search.db)."""
+    history_dir = Path(os.getenv("CHAT_HISTORY_DIR", "chat_history"))
+    return SearchIndex(Path(os.getenv("CHAT_HISTORY_SEARCH_DB", str(history_dir / "search.db"))))
+
+
+_index: Optional[SearchIndex] = None
+_index_lock = threading.Lock()
+
+def get_search_index() -> Optional[SearchIndex]:
+    """Get the process-wide search index, or None unless CHAT_HISTORY_SEARCH=1."""
+    global _index
+    if os.getenv("CHAT_HISTORY_SEARCH", "0") != "1":
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = create_search_index()
+            logger.info(f"Chat history search index in {_index.db_path}")
+        return _index
+
+
+if __name__ == "__main__":
+    # python -m src.utils.search_index: index the existing chat history
+    from dotenv import load_dotenv
+    from src.utils.chat_history import get_history_storage
+
+    load_dotenv()
+    index = create_search_index()
+    print(f"Indexed {index.rebuild(get_history_storage())} messages into {index.db_path}")
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Any, Dict, Hashable, Optional
+
+class FlightAborted(Exception):
+    """Raised to waiters when the leading call was cancelled before finishing."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls so only one of them does the work.
+
+    The first caller for a key becomes the leader and must call `finish()`;
+    callers arriving while it is in flight await its result instead. All
+    callers must run on the same event loop.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def join(self, key: Hashable) -> Optional[asyncio.Future]:
+        """
+        Get the in-flight call for a key.
+
+        Args:
+            key: Identity of the call
+
+        Returns:
+            A future with the leader's result, or None if nothing is in flight
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    def lead(self, key: Hashable) -> None:
+        """Register the caller as the leader for a key."""
+        future = asyncio.get_running_loop().create_future()
+        # Waiters are optional; don't warn about exceptions nobody retrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+
+    def finish(self, key: Hashable, result: Any = None, error: Optional[BaseException] = None) -> None:
+        """
+        Publish the leader's outcome to its waiters.
+
+        Args:
+            key: Identity of the call
+            result: Result of the call
+            error: Exception raised by the call, if it failed
+        """
+        future = self._calls.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None and not isinstance(error, Exception):
+            # Cancelled or closed (e.g. the client disconnected): waiters run it themselves
+            future.set_exception(FlightAborted())
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
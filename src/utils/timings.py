@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from src.utils.metrics import STAGE_DURATION
+
+# Milliseconds spent per stage by the current request; None when not collecting
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+def start_timings() -> Dict[str, float]:
+    """Start collecting stage timings for the current request."""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+def get_timings() -> Optional[Dict[str, float]]:
+    """Get the current request's stage timings, or None if not collecting."""
+    return _timings.get()
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time the block as stage `name`: always in the stage duration histogram, and
+    in the current request's timings if they were started.
+    """
+    timings = _timings.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.labels(name).observe(elapsed)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Format stage timings as a Server-Timing header value."""
+    return ", ".join(f"{name};dur={duration:.1f}" for name, duration in timings.items())
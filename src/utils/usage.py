@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from loguru import logger
+
+class Usage:
+    """Tokens and tool calls consumed by one or more upstream runs."""
+
+    def __init__(self):
+        self.requests = 0
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+        self.file_search_calls = 0
+
+    def add(
+        self,
+        requests: int = 0,
+        input_tokens: int = 0,
+        cached_input_tokens: int = 0,
+        output_tokens: int = 0,
+        file_search_calls: int = 0,
+    ) -> None:
+        self.requests += requests
+        self.input_tokens += input_tokens
+        self.cached_input_tokens += cached_input_tokens
+        self.output_tokens += output_tokens
+        self.file_search_calls += file_search_calls
+
+    @property
+    def empty(self) -> bool:
+        return not (self.requests or self.input_tokens or self.output_tokens or self.file_search_calls)
+
+
+def today() -> str:
+    """Current accounting day (UTC), as YYYY-MM-DD."""
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class UsageStore:
+    """
+    Token usage aggregated per day, user and agent, in a local SQLite database.
+
+    Costs are not stored: they are computed when reading, from the prices per
+    million tokens (and per thousand file search calls) given at construction,
+    so they can be configured after the fact.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage (
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            cached_input_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            file_search_calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id, agent)
+        );
+    """
+
+    GROUPS = {"day": "day", "user": "user_id", "agent": "agent"}
+
+    def __init__(
+        self,
+        db_path: Path,
+        input_cost: float = 0.0,
+        cached_input_cost: float = 0.0,
+        output_cost: float = 0.0,
+        file_search_cost: float = 0.0,
+    ):
+        self.db_path = db_path
+        self.input_cost = input_cost
+        self.cached_input_cost = cached_input_cost
+        self.output_cost = output_cost
+        self.file_search_cost = file_search_cost
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's connection (one per thread, reopened after a fork)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(str(self.db_path), isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(self.SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def record(self, user_id: str, agent: str, usage: Usage, day: Optional[str] = None) -> None:
+        """
+        Add a run's usage to the user's and agent's totals for the day.
+
+        Args:
+            user_id: ID of the user
+            agent: Name of the agent that ran
+            usage: Usage to add
+            day: Accounting day; today (UTC) if None
+        """
+        self._connect().execute(
+            "INSERT INTO usage (day, user_id, agent, requests, input_tokens, cached_input_tokens, output_tokens, file_search_calls) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (day, user_id, agent) DO UPDATE SET "
+            "requests = requests + excluded.requests, "
+            "input_tokens = input_tokens + excluded.input_tokens, "
+            "cached_input_tokens = cached_input_tokens + excluded.cached_input_tokens, "
+            "output_tokens = output_tokens + excluded.output_tokens, "
+            "file_search_calls = file_search_calls + excluded.file_search_calls",
+            (
+                day or today(), user_id, agent, usage.requests, usage.input_tokens,
+                usage.cached_input_tokens, usage.output_tokens, usage.file_search_calls,
+            ),
+        )
+
+    def tokens_for_day(self, user_id: str, day: Optional[str] = None) -> int:
+        """Total input and output tokens used by a user on a day (today if None)."""
+        row = self._connect().execute(
+            "SELECT COALESCE(SUM(input_tokens + output_tokens), 0) FROM usage WHERE day = ? AND user_id = ?",
+            (day or today(), user_id),
+        ).fetchone()
+        return row[0]
+
+    def summary(
+        self,
+        group_by: List[str],
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        user_id: Optional[str] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        """
+        Aggregate usage, most expensive first.
+
+        Args:
+            group_by: Any of "day", "user" and "agent"
+            start: First day included, as YYYY-MM-DD (None for no bound)
+            end: Last day included, as YYYY-MM-DD (None for no bound)
+            user_id: Only this user's usage, if given
+            limit: Maximum number of rows
+
+        Returns:
+            One dict per group with its token counts and estimated cost
+        """
+        columns = [self.GROUPS[group] for group in group_by]
+        conditions, params = [], []
+        if start:
+            conditions.append("day >= ?")
+            params.append(start)
+        if end:
+            conditions.append("day <= ?")
+            params.append(end)
+        if user_id:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        cost = (
+            f"(SUM(input_tokens - cached_input_tokens) * {self.input_cost:f}"
+            f" + SUM(cached_input_tokens) * {self.cached_input_cost:f}"
+            f" + SUM(output_tokens) * {self.output_cost:f}) / 1000000.0"
+            f" + SUM(file_search_calls) * {self.file_search_cost:f} / 1000.0"
+        )
+        sql = (
+            "SELECT " + "".join(f"{column}, " for column in columns)
+            + "SUM(requests) AS requests, SUM(input_tokens) AS input_tokens, "
+            "SUM(cached_input_tokens) AS cached_input_tokens, SUM(output_tokens) AS output_tokens, "
+            f"SUM(file_search_calls) AS file_search_calls, {cost} AS cost FROM usage"
+            + (" WHERE " + " AND ".join(conditions) if conditions else "")
+            + (" GROUP BY " + ", ".join(columns) if columns else "")
+            + " ORDER BY cost DESC, input_tokens + output_tokens DESC LIMIT ?"
+        )
+        rows = self._connect().execute(sql, params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+
+def create_usage_store() -> UsageStore:
+    """Create the usage store configured with USAGE_DB and the USAGE_COST_* prices."""
+    history_dir = Path(os.getenv("CHAT_HISTORY_DIR", "chat_history"))
+    store = UsageStore(
+        Path(os.getenv("USAGE_DB", str(history_dir / "usage.db"))),
+        input_cost=float(os.getenv("USAGE_COST_INPUT_PER_MTOK", "0")),
+        cached_input_cost=float(os.getenv("USAGE_COST_CACHED_INPUT_PER_MTOK", "0")),
+        output_cost=float(os.getenv("USAGE_COST_OUTPUT_PER_MTOK", "0")),
+        file_search_cost=float(os.getenv("USAGE_COST_FILE_SEARCH_PER_KCALL", "0")),
+    )
+    logger.info(f"Usage accounting in {store.db_path}")
+    return store
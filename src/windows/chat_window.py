@@ -17,6 +17,7 @@ from src.components.typing_indicator import TypingIndicator
 from src.utils.styles import apply_stylesheet, get_icon_path
 from src.utils.openai_handler import OpenAIHandler
 from src.utils.chat_history import ChatHistory
+from src.utils.resilience import TurnFailedError
 
 class ChatWorker(QThread):
     """Worker thread for handling chat message processing."""
@@ -39,6 +40,10 @@ class ChatWorker(QThread):
             self.typing_stopped.emit()
             self.message_received.emit(response)
             logger.debug(f"ChatWorker finished processing message for user_id={self.user_id}")
+        except TurnFailedError as e:
+            # Already logged by the handler; the message is meant for the user
+            self.typing_stopped.emit()
+            self.message_received.emit(str(e))
         except Exception as e:
             self.typing_stopped.emit()
             self.message_received.emit(f"Error: {str(e)}")
@@ -222,13 +227,10 @@ class ChatWindow(QMainWindow):
         user_bubble = MessageBubble(message_text, "user", timestamp)
         self.messages_layout.insertWidget(self.messages_layout.count() - 2, user_bubble)
         
-        # Save message to history
-        self.chat_history.add_message("user", message_text, timestamp.isoformat())
-        
         # Scroll to bottom
         self.scroll_to_bottom()
         
-        # Process message in background thread
+        # Process message in background thread; the handler saves the question and the reply
         self.chat_worker = ChatWorker(self.openai_handler, message_text, self.user.id)
         self.chat_worker.typing_started.connect(self.show_typing_indicator)
         self.chat_worker.typing_stopped.connect(self.hide_typing_indicator)
@@ -244,9 +246,6 @@ class ChatWindow(QMainWindow):
         assistant_bubble = MessageBubble(response, "assistant", timestamp)
         self.messages_layout.insertWidget(self.messages_layout.count() - 2, assistant_bubble)
         
-        # Save message to history
-        self.chat_history.add_message("assistant", response, timestamp.isoformat())
-        
         # Scroll to bottom
         self.scroll_to_bottom()
         
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Set before anything reads them at import time (main.py, the LLM backend)
+_session_dir = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ.update({
+    "LLM_BACKEND": "mock",
+    "MOCK_LLM_TRIAGE_LATENCY": "0",
+    "MOCK_LLM_FIRST_TOKEN_LATENCY": "0",
+    "MOCK_LLM_TOKENS_PER_SECOND": "0",
+    "MOCK_LLM_REPLY_TOKENS": "5",
+    "MOCK_LLM_ERROR_RATE": "0",
+    "OPENAI_API_KEY": "test",
+    "SUPABASE_URL": "https://test.supabase.co",
+    "SUPABASE_KEY": "test",
+    "CHAT_HISTORY_DIR": os.path.join(_session_dir, "chat_history"),
+    "CHAT_JOB_DB": os.path.join(_session_dir, "jobs.db"),
+    "CHAT_JOB_WORKERS": "1",
+    "LOG_DIR": os.path.join(_session_dir, "logs"),
+    "LLM_RETRY_BASE_DELAY": "0",
+})
+
+from src.utils import chat_history, conversation_store, search_index
+
+
+def reset_singletons() -> None:
+    """Drop the process-wide storage, conversation store and search index, so they are rebuilt from the environment."""
+    chat_history._storage = None
+    conversation_store._store = None
+    search_index._index = None
+
+
+@pytest.fixture(autouse=True)
+def history_dir(tmp_path, monkeypatch):
+    """Run each test in an empty directory, with an empty history directory and fresh singletons."""
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "chat_history"
+    path.mkdir()
+    for name in ("CHAT_HISTORY_BACKEND", "CHAT_HISTORY_FSYNC", "CHAT_HISTORY_DB", "CHAT_HISTORY_WRITE_BEHIND",
+                 "CHAT_HISTORY_SEGMENT_BYTES", "CHAT_HISTORY_SEARCH", "CHAT_HISTORY_SEARCH_DB", "USAGE_DB"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("CHAT_HISTORY_DIR", str(path))
+    reset_singletons()
+    yield path
+    reset_singletons()
+
+
+@pytest.fixture
+def handler():
+    """An OpenAIHandler on the mock backend, using the test's history directory."""
+    from src.utils.openai_handler import OpenAIHandler
+    return OpenAIHandler()
+
+
+def message(i: int, timestamp: str = None, role: str = "user") -> dict:
+    return {"role": role, "content": f"m{i}", "timestamp": timestamp or f"2025-01-01T00:00:{i:02d}"}
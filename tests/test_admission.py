@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from src.utils import admission
+from src.utils.admission import AdmissionController, OverloadedError, UserBusyError
+
+
+def test_rejects_turns_beyond_the_per_user_limit():
+    controller = AdmissionController(max_per_user=1)
+
+    async def main():
+        async with controller.user_slot("u"):
+            with pytest.raises(UserBusyError):
+                controller.check("u")
+            with pytest.raises(UserBusyError):
+                async with controller.user_slot("u"):
+                    pass
+            # Other users are not affected
+            controller.check("v")
+        controller.check("u")
+
+    asyncio.run(main())
+    assert controller._per_user == {}
+
+
+def test_rejects_when_the_queue_is_full():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+
+    async def main():
+        async with controller.upstream_slot():
+            with pytest.raises(OverloadedError):
+                async with controller.upstream_slot():
+                    pass
+
+    asyncio.run(main())
+    assert controller.rejected == 1
+
+
+@pytest.mark.parametrize("fallback", [False, True])
+def test_queue_timeout_releases_nothing_it_did_not_get(monkeypatch, fallback):
+    if fallback:
+        # Python 3.10 has no asyncio.timeout
+        monkeypatch.setattr(admission, "_timeout", admission._Timeout)
+    controller = AdmissionController(max_concurrent=1, queue_timeout=0.05)
+
+    async def main():
+        async with controller.upstream_slot():
+            with pytest.raises(OverloadedError):
+                async with controller.upstream_slot():
+                    pass
+            assert controller.waiting == 0
+        # The slot is free again, and only one can be taken
+        async with controller.upstream_slot():
+            assert controller._get_semaphore().locked()
+        assert not controller._get_semaphore().locked()
+
+    asyncio.run(main())
+    assert controller.active == 0
+
+
+def test_waiter_gets_the_slot_when_it_is_released():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=5)
+    order = []
+
+    async def turn(name, hold):
+        async with controller.upstream_slot():
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def main():
+        await asyncio.gather(turn("a", 0.05), turn("b", 0))
+
+    asyncio.run(main())
+    assert order == ["a", "b"]
+    assert controller.active == 0 and controller.waiting == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController(max_concurrent=1, queue_timeout=5)
+
+    async def main():
+        async with controller.upstream_slot():
+            waiter = asyncio.create_task(controller.upstream_slot().__aenter__())
+            await asyncio.sleep(0.01)
+            assert controller.waiting == 1
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            assert controller.waiting == 0
+        async with controller.upstream_slot():
+            pass
+
+    asyncio.run(main())
+    assert controller.active == 0
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+import time
+
+from src.utils.chat_history import ChatHistory
+from src.utils.chat_jobs import ChatJobQueue
+
+
+def test_runs_submitted_jobs(tmp_path):
+    turns = []
+
+    def run_turn(user_id, message, turn_timestamp):
+        turns.append((user_id, message, turn_timestamp))
+        return message.upper()
+
+    queue = ChatJobQueue(run_turn, tmp_path / "jobs.db", workers=2)
+    job = queue.submit("u", "ola")
+    assert job["status"] in ("queued", "running", "done")
+
+    job = queue.wait(job["id"], timeout=5)
+    assert job["status"] == "done"
+    assert job["response"] == "OLA"
+    assert turns[0][:2] == ("u", "ola") and turns[0][2]
+
+
+def test_failed_job_reports_the_error(tmp_path):
+    def run_turn(user_id, message, turn_timestamp):
+        raise RuntimeError("no upstream")
+
+    queue = ChatJobQueue(run_turn, tmp_path / "jobs.db", workers=1)
+    job = queue.wait(queue.submit("u", "ola")["id"], timeout=5)
+
+    assert job["status"] == "failed"
+    assert job["error"] == "no upstream"
+
+
+def test_wait_returns_as_soon_as_the_job_finishes(tmp_path):
+    release = threading.Event()
+
+    def run_turn(user_id, message, turn_timestamp):
+        release.wait(5)
+        return "ok"
+
+    queue = ChatJobQueue(run_turn, tmp_path / "jobs.db", workers=1)
+    job_id = queue.submit("u", "ola")["id"]
+    # By then, polling alone would next look at 1.75s
+    threading.Timer(0.8, release.set).start()
+
+    started = time.monotonic()
+    assert queue.wait(job_id, timeout=30)["status"] == "done"
+    assert time.monotonic() - started < 1.5
+
+
+def test_unknown_job_is_none(tmp_path):
+    queue = ChatJobQueue(lambda user_id, message, timestamp: "ok", tmp_path / "jobs.db", workers=1)
+
+    assert queue.get("missing") is None
+    assert queue.wait("missing", timeout=1) is None
+
+
+def test_runs_one_job_per_user_at_a_time(tmp_path):
+    lock = threading.Lock()
+    running = {}
+    overlaps = []
+    order = []
+
+    def run_turn(user_id, message, turn_timestamp):
+        with lock:
+            running[user_id] = running.get(user_id, 0) + 1
+            overlaps.append(running[user_id] > 1)
+            order.append((user_id, message))
+        time.sleep(0.05)
+        with lock:
+            running[user_id] -= 1
+        return message
+
+    queue = ChatJobQueue(run_turn, tmp_path / "jobs.db", workers=4)
+    jobs = [queue.submit(user_id, str(i)) for i in range(3) for user_id in ("a", "b")]
+
+    assert all(queue.wait(job["id"], timeout=5)["status"] == "done" for job in jobs)
+    assert not any(overlaps)
+    assert [message for user_id, message in order if user_id == "a"] == ["0", "1", "2"]
+
+
+def stale_job(db_path, turn_timestamp):
+    """Insert a job left running by a worker that died, as another process would have."""
+    queue = ChatJobQueue(lambda *args: None, db_path, workers=0)
+    connection = queue._connect()
+    connection.execute(
+        "INSERT INTO jobs (id, user_id, message, status, created_at, updated_at, turn_timestamp) "
+        "VALUES ('stale', 'u', 'ola', 'running', 0, 0, ?)",
+        (turn_timestamp,),
+    )
+
+
+def test_reclaimed_job_is_not_run_twice_when_it_had_finished(tmp_path):
+    turn_timestamp = "2025-01-01T00:00:00"
+    stale_job(tmp_path / "jobs.db", turn_timestamp)
+    runs = []
+
+    def run_turn(user_id, message, timestamp):
+        runs.append(timestamp)
+        return "again"
+
+    def recover_turn(user_id, message, timestamp):
+        return "first" if timestamp == turn_timestamp else None
+
+    queue = ChatJobQueue(run_turn, tmp_path / "jobs.db", workers=1, stale_seconds=1, recover_turn=recover_turn)
+    queue._ensure_workers()
+    job = queue.wait("stale", timeout=5)
+
+    assert job["status"] == "done"
+    assert job["response"] == "first"
+    assert runs == []
+
+
+def test_reclaimed_job_runs_again_with_its_first_timestamp(tmp_path):
+    turn_timestamp = "2025-01-01T00:00:00"
+    stale_job(tmp_path / "jobs.db", turn_timestamp)
+    runs = []
+
+    def run_turn(user_id, message, timestamp):
+        runs.append(timestamp)
+        return "again"
+
+    queue = ChatJobQueue(
+        run_turn, tmp_path / "jobs.db", workers=1, stale_seconds=1, recover_turn=lambda *args: None
+    )
+    queue._ensure_workers()
+
+    assert queue.wait("stale", timeout=5)["response"] == "again"
+    assert runs == [turn_timestamp]
+
+
+def test_adds_turn_timestamp_to_an_old_database(tmp_path):
+    db_path = tmp_path / "jobs.db"
+    connection = sqlite3.connect(str(db_path))
+    connection.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, message TEXT NOT NULL, "
+        "status TEXT NOT NULL, response TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    connection.execute("INSERT INTO jobs VALUES ('old', 'u', 'ola', 'queued', NULL, NULL, 0, 0)")
+    connection.commit()
+    connection.close()
+
+    queue = ChatJobQueue(lambda user_id, message, timestamp: timestamp, db_path, workers=1)
+    queue._ensure_workers()
+    job = queue.wait("old", timeout=5)
+
+    assert job["status"] == "done"
+    assert job["response"]
+
+
+def test_recover_chat_turn_finds_the_saved_reply():
+    from main import recover_chat_turn
+
+    ChatHistory("u").add_messages([
+        {"role": "user", "content": "ola", "timestamp": "2025-01-01T00:00:00"},
+        {"role": "assistant", "content": "primeira", "timestamp": "2025-01-01T00:00:01"},
+        {"role": "user", "content": "ola", "timestamp": "2025-01-01T00:00:02"},
+        {"role": "assistant", "content": "segunda", "timestamp": "2025-01-01T00:00:03"},
+    ])
+
+    assert recover_chat_turn("u", "ola", "2025-01-01T00:00:02") == "segunda"
+    assert recover_chat_turn("u", "ola", "2025-01-01T00:00:05") is None
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+
+from conftest import message
+from src.utils.chat_history import ChatHistory, get_history_storage
+from src.utils.conversation_store import ConversationStore
+from src.utils.history_storage import JsonlHistoryStorage, WriteBehindHistoryStorage
+
+
+def add(store, user_id, *indexes):
+    for i in indexes:
+        msg = message(i)
+        store.add_message(user_id, msg["role"], msg["content"], msg["timestamp"])
+
+
+def test_recent_returns_position_of_first_cached_message():
+    store = ConversationStore(hot_messages=5)
+    add(store, "u", *range(3))
+    assert store.recent("u") == ([message(i) for i in range(3)], 0)
+
+    add(store, "u", *range(3, 12))
+    assert store.recent("u") == ([message(i) for i in range(7, 12)], 7)
+    # Every message was persisted
+    assert ChatHistory("u").get_messages() == [message(i) for i in range(12)]
+    # A fresh store (another worker, a restart) agrees on the position
+    assert ConversationStore(hot_messages=5).recent("u") == ([message(i) for i in range(7, 12)], 7)
+
+
+def test_reloads_after_another_process_wrote():
+    store = ConversationStore(hot_messages=10)
+    add(store, "u", 0)
+    assert store.recent("u")[0] == [message(0)]
+
+    # Written behind the cache's back, like another worker would
+    ChatHistory("u").add_message("user", "m1", message(1)["timestamp"])
+    assert store.recent("u")[0] == [message(0), message(1)]
+
+    add(store, "u", 2)
+    assert store.recent("u")[0] == [message(0), message(1), message(2)]
+
+
+def test_failed_write_leaves_cache_unchanged(monkeypatch):
+    store = ConversationStore(hot_messages=10)
+    add(store, "u", 0)
+
+    def fail(self, messages):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ChatHistory, "add_messages", fail)
+        with pytest.raises(OSError):
+            add(store, "u", 1)
+
+    assert store.recent("u")[0] == [message(0)]
+    assert ChatHistory("u").get_messages() == [message(0)]
+
+
+def test_clear_forgets_the_conversation():
+    store = ConversationStore(hot_messages=10)
+    add(store, "u", 0, 1)
+    store.clear("u")
+
+    assert store.recent("u") == ([], 0)
+    assert ChatHistory("u").get_messages() == []
+
+
+def test_evicts_least_recently_used_within_limits():
+    store = ConversationStore(hot_messages=10, max_users=2)
+    for user_id in ("a", "b", "c"):
+        add(store, user_id, 0)
+        store.recent(user_id)
+
+    assert list(store._conversations) == ["b", "c"]
+    assert store._total_bytes == sum(c.size_bytes for c in store._conversations.values())
+
+
+def test_evicts_by_bytes_but_keeps_the_conversation_in_use():
+    # "m0" is 2 bytes; each conversation holds two messages
+    store = ConversationStore(hot_messages=10, max_bytes=6)
+    for user_id in ("a", "b", "c"):
+        add(store, user_id, 0, 1)
+        store.recent(user_id)
+        assert user_id in store._conversations
+        assert store._total_bytes == sum(c.size_bytes for c in store._conversations.values())
+        assert store._total_bytes <= 6
+
+    add(store, "c", *range(2, 10))
+    assert list(store._conversations) == ["c"]
+    assert store._total_bytes == store._conversations["c"].size_bytes
+
+
+def test_evicts_idle_conversations():
+    store = ConversationStore(hot_messages=10, idle_seconds=60)
+    add(store, "a", 0)
+    store.recent("a")
+    store._conversations["a"].last_active = time.monotonic() - 120
+
+    store.recent("b")
+    assert list(store._conversations) == ["b"]
+    assert store._total_bytes == 0
+
+
+def test_latest_page_is_served_from_cache_with_cursor():
+    store = ConversationStore(hot_messages=10)
+    messages = [message(i, f"2025-01-01T00:00:{i // 3:02d}") for i in range(8)]
+    store.add_messages("u", messages)
+
+    page = store.page("u", 4)
+    assert page["messages"] == messages[-4:]
+    assert page["has_more"] is True
+
+    older = store.page("u", 10, page["next_before"])
+    assert older["messages"] == messages[:4]
+    assert older["has_more"] is False
+
+
+def test_write_behind_reloads_after_another_process_flushed(monkeypatch, history_dir):
+    monkeypatch.setenv("CHAT_HISTORY_BACKEND", "jsonl")
+    monkeypatch.setenv("CHAT_HISTORY_WRITE_BEHIND", "1")
+    monkeypatch.setenv("CHAT_HISTORY_FLUSH_INTERVAL", "60")
+    store = ConversationStore(hot_messages=10)
+    add(store, "u", 0)
+    store.recent("u")
+    loads = []
+    monkeypatch.setattr(store, "_load", lambda *args, _load=store._load: loads.append(1) or _load(*args))
+
+    # This process's own buffered writes keep the cache valid
+    add(store, "u", 1)
+    assert store.recent("u")[0] == [message(0), message(1)]
+    assert loads == []
+    assert get_history_storage().flush() is True
+
+    # Another worker's buffer, flushed to the same files
+    other = WriteBehindHistoryStorage(JsonlHistoryStorage(history_dir), flush_interval=60)
+    other.append("u", message(2))
+    assert store.recent("u")[0] == [message(0), message(1)]
+    assert other.flush() is True
+    assert store.recent("u")[0] == [message(0), message(1), message(2)]
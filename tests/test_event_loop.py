@@ -0,0 +1,130 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+
+import pytest
+
+from src.utils.event_loop import BackgroundEventLoop
+
+
+async def current_thread():
+    return threading.current_thread()
+
+
+def test_runs_coroutines_on_one_long_lived_loop():
+    background = BackgroundEventLoop()
+
+    first = background.run(current_thread())
+    second = background.run(current_thread())
+
+    assert first is second
+    assert first is not threading.current_thread()
+    assert first.name == "openai-event-loop"
+
+
+def test_timeout_cancels_the_coroutine():
+    background = BackgroundEventLoop()
+    cancelled = threading.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        background.run(slow(), timeout=0.05)
+    assert cancelled.wait(1)
+
+
+def test_refuses_to_block_the_loop_thread():
+    background = BackgroundEventLoop()
+
+    async def nested():
+        background.run(current_thread())
+
+    with pytest.raises(RuntimeError):
+        background.run(nested())
+
+
+def test_iterates_an_async_generator_from_sync_code():
+    background = BackgroundEventLoop()
+
+    async def count(n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield i
+
+    assert list(background.iterate(count(5))) == [0, 1, 2, 3, 4]
+
+
+def test_iterate_raises_the_generators_error():
+    background = BackgroundEventLoop()
+
+    async def failing():
+        yield 1
+        raise ValueError("upstream failed")
+
+    items = background.iterate(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_closing_the_iterator_cancels_the_generator():
+    background = BackgroundEventLoop()
+    stopped = threading.Event()
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "delta"
+        finally:
+            stopped.set()
+
+    items = background.iterate(endless())
+    assert next(items) == "delta"
+    items.close()
+    assert stopped.wait(1)
+
+
+def test_adopts_a_running_server_loop():
+    background = BackgroundEventLoop()
+    adopted = threading.Event()
+    stop = threading.Event()
+
+    async def serve():
+        background.adopt(asyncio.get_running_loop())
+        adopted.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+
+    server = threading.Thread(target=asyncio.run, args=(serve(),))
+    server.start()
+    try:
+        assert adopted.wait(1)
+        assert background.run(current_thread()) is server
+    finally:
+        stop.set()
+        server.join()
+
+
+def test_coroutines_see_the_callers_stage_timings():
+    from src.utils.timings import stage, start_timings
+
+    background = BackgroundEventLoop()
+
+    async def timed():
+        with stage("triage"):
+            await asyncio.sleep(0)
+
+    def request():
+        timings = start_timings()
+        background.run(timed())
+        return timings
+
+    # In a copy of the context, so the timings do not leak into other tests
+    assert "triage" in contextvars.copy_context().run(request)
@@ -0,0 +1,460 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from loguru import logger
+
+from conftest import message
+from src.utils.chat_history import ChatHistory, get_history_storage
+from src.utils.history_storage import (
+    HistoryStorage,
+    JsonHistoryStorage,
+    JsonlHistoryStorage,
+    SqliteHistoryStorage,
+    StripedLocks,
+    WriteBehindHistoryStorage,
+    format_cursor,
+    page_cursor,
+    parse_cursor,
+)
+
+BACKENDS = ["json", "jsonl", "jsonl-segments", "sqlite"]
+
+
+def create_storage(kind: str, history_dir: Path) -> HistoryStorage:
+    if kind == "json":
+        return JsonHistoryStorage(history_dir)
+    if kind == "jsonl":
+        return JsonlHistoryStorage(history_dir)
+    if kind == "jsonl-segments":
+        return JsonlHistoryStorage(history_dir, segment_bytes=300)
+    return SqliteHistoryStorage(history_dir / "history.db", history_dir)
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, history_dir):
+    storage = create_storage(request.param, history_dir)
+    storage.ensure("u")
+    return storage
+
+
+def test_append_and_read(storage):
+    messages = [message(i) for i in range(20)]
+    for msg in messages:
+        storage.append("u", msg)
+
+    assert storage.read("u") == messages
+    assert storage.tail("u", 3) == messages[-3:]
+    assert storage.tail("u", 0) == []
+    assert storage.range("u", messages[5]["timestamp"], messages[8]["timestamp"]) == messages[5:8]
+    assert storage.range("u", messages[5]["timestamp"], limit=2) == messages[5:7]
+    assert storage.range("u", end=messages[2]["timestamp"]) == messages[:2]
+
+
+def test_versions_change_with_writes(storage):
+    before, after = storage.append_many_versioned("u", [message(0)])
+    assert before != after
+    assert storage.version("u") == after
+
+    storage.clear("u")
+    assert storage.read("u") == []
+    assert storage.version("u") != after
+
+
+def test_clear(storage):
+    storage.append("u", message(0))
+    storage.clear("u")
+
+    assert storage.read("u") == []
+
+
+def test_backends_must_implement_the_storage_methods():
+    class ReadOnlyStorage(HistoryStorage):
+        def read(self, user_id):
+            return []
+
+    with pytest.raises(TypeError, match="append"):
+        ReadOnlyStorage()
+
+
+def test_jsonl_tail_reads_across_blocks(history_dir):
+    storage = JsonlHistoryStorage(history_dir)
+    storage.READ_BLOCK_SIZE = 16
+    messages = [message(i) for i in range(30)]
+    for msg in messages:
+        storage.append("u", msg)
+
+    assert storage.tail("u", 7) == messages[-7:]
+    assert storage.tail("u", 100) == messages
+
+
+def test_pages_keep_messages_with_tied_timestamps(storage):
+    # Four messages per timestamp, so ties straddle page boundaries
+    messages = [message(i, f"2025-01-01T00:00:{i // 4:02d}") for i in range(30)]
+    storage.append_many("u", messages[:15])
+    storage.append_many("u", messages[15:])
+    wait_for_archiving()
+
+    for limit in (1, 3, 5):
+        pages, before = [], None
+        while True:
+            page = storage.page("u", limit + 1, before)
+            has_more = len(page) > limit
+            page = page[-limit:]
+            pages = page + pages
+            if not has_more:
+                break
+            before = page_cursor(page, before)
+        assert contents(pages) == contents(messages)
+
+
+def test_plain_timestamp_cursor_is_exclusive(storage):
+    storage.append_many("u", [message(i, f"2025-01-01T00:00:{i // 2:02d}") for i in range(10)])
+    wait_for_archiving()
+
+    assert contents(storage.page("u", 100, "2025-01-01T00:00:02")) == ["m0", "m1", "m2", "m3"]
+
+
+def test_cursor_round_trip():
+    assert parse_cursor(format_cursor("2025-01-01T00:00:00", 3)) == ("2025-01-01T00:00:00", 3)
+    assert parse_cursor("2025-01-01T00:00:00") == ("2025-01-01T00:00:00", None)
+
+
+def test_json_document_recovers_from_backup(history_dir):
+    storage = JsonHistoryStorage(history_dir)
+    storage.ensure("u")
+    storage.append("u", message(0))
+    storage.append("u", message(1))
+    (history_dir / "u.json").write_text('{"messages": [')
+
+    assert storage.read("u") == [message(0)]
+    assert list(history_dir.glob("u.json.corrupt-*"))
+
+
+def test_jsonl_migrates_legacy_json(history_dir):
+    (history_dir / "u.json").write_text(json.dumps({"messages": [message(0), message(1)]}))
+    storage = JsonlHistoryStorage(history_dir)
+    storage.ensure("u")
+
+    assert storage.read("u") == [message(0), message(1)]
+    assert (history_dir / "u.json.migrated").exists()
+
+
+def test_jsonl_skips_torn_line(history_dir):
+    storage = JsonlHistoryStorage(history_dir)
+    storage.append("u", message(0))
+    with open(history_dir / "u.jsonl", "a") as f:
+        f.write('{"role": "user", "cont')
+    storage.append("u", message(1))
+
+    assert storage.read("u") == [message(0), message(1)]
+    assert storage.tail("u", 1) == [message(1)]
+
+
+def test_jsonl_leaves_an_append_in_progress_for_later(history_dir):
+    storage = JsonlHistoryStorage(history_dir)
+    storage.append("u", message(0))
+    warnings = []
+    handler_id = logger.add(warnings.append, level="WARNING")
+    try:
+        # What an unlocked read can see while another process appends
+        with open(history_dir / "u.jsonl", "a") as f:
+            f.write('{"role": "user", "cont')
+
+        assert storage.read("u") == [message(0)]
+        assert storage.tail("u", 1) == [message(0)]
+    finally:
+        logger.remove(handler_id)
+    assert warnings == []
+
+
+def test_jsonl_rejects_unknown_fsync_policy(history_dir):
+    with pytest.raises(ValueError):
+        JsonlHistoryStorage(history_dir, fsync="sometimes")
+
+
+def wait_for_archiving() -> None:
+    for thread in threading.enumerate():
+        if thread.name == "history-archiver":
+            thread.join()
+
+
+def contents(messages):
+    return [msg["content"] for msg in messages]
+
+
+def test_page_returns_messages_before_the_cursor(storage):
+    messages = [message(i) for i in range(10)]
+    for msg in messages:
+        storage.append("u", msg)
+
+    assert storage.page("u", 3) == messages[-3:]
+    assert storage.page("u", 3, messages[5]["timestamp"]) == messages[2:5]
+    assert storage.page("u", 10, messages[2]["timestamp"]) == messages[:2]
+    assert storage.page("u", 3, messages[0]["timestamp"]) == []
+
+
+@pytest.mark.parametrize("backend", ["json", "jsonl", "sqlite"])
+def test_chat_history_pages_through_everything(monkeypatch, backend):
+    monkeypatch.setenv("CHAT_HISTORY_BACKEND", backend)
+    history = ChatHistory("u")
+    messages = [message(i) for i in range(10)]
+    for msg in messages:
+        history.add_message(msg["role"], msg["content"], msg["timestamp"])
+
+    pages, before = [], None
+    while True:
+        page = history.get_page(4, before)
+        pages = page["messages"] + pages
+        if not page["has_more"]:
+            assert page["next_before"] is None
+            break
+        before = page["next_before"]
+    assert contents(pages) == contents(messages)
+
+
+def test_storage_keeps_users_apart(storage):
+    storage.ensure("v")
+    storage.append("u", message(0))
+    storage.append("v", message(1))
+
+    assert storage.read("u") == [message(0)]
+    storage.clear("v")
+    assert storage.read("u") == [message(0)]
+
+
+def test_jsonl_archives_old_messages_into_segments(history_dir):
+    storage = JsonlHistoryStorage(history_dir, segment_bytes=300)
+    messages = [message(i) for i in range(40)]
+    for msg in messages:
+        storage.append("u", msg)
+    wait_for_archiving()
+
+    archive = history_dir / "u.archive"
+    assert not list(archive.glob("*.rolling.jsonl"))
+    segments = json.loads((archive / "manifest.json").read_text())["segments"]
+    assert segments
+    assert all((archive / segment["file"]).exists() for segment in segments)
+    assert storage.read("u") == messages
+    assert contents(storage.tail("u", 3)) == ["m37", "m38", "m39"]
+    assert contents(storage.page("u", 3, before=messages[10]["timestamp"])) == ["m7", "m8", "m9"]
+
+    storage.clear("u")
+    assert storage.read("u") == []
+    assert not archive.exists()
+
+
+def test_jsonl_finds_messages_saved_out_of_order_in_segments(history_dir):
+    storage = JsonlHistoryStorage(history_dir, segment_bytes=300)
+    late = message(5)
+    for msg in [message(i) for i in range(10, 20)] + [late] + [message(i) for i in range(20, 40)]:
+        storage.append("u", msg)
+    wait_for_archiving()
+
+    segments = storage._manifest("u")
+    assert any(segment["min"] == late["timestamp"] for segment in segments)
+    assert storage.range("u", start=late["timestamp"], end=message(6)["timestamp"]) == [late]
+    assert storage.page("u", 5, before=format_cursor(message(6)["timestamp"], 0)) == [late]
+
+
+def test_jsonl_finishes_interrupted_roll(history_dir):
+    storage = JsonlHistoryStorage(history_dir, segment_bytes=300)
+    # Leaves a couple of messages in the hot file
+    messages = [message(i) for i in range(42)]
+    for msg in messages:
+        storage.append("u", msg)
+    wait_for_archiving()
+    # A crash right after renaming the hot file into the archive
+    number = storage._last_segment_number(storage._manifest("u")) + 1
+    (history_dir / "u.jsonl").rename(history_dir / "u.archive" / f"{number:06d}.rolling.jsonl")
+
+    assert storage.read("u") == messages
+    storage.ensure("u")
+    assert not list((history_dir / "u.archive").glob("*.rolling.jsonl"))
+    assert storage.read("u") == messages
+    assert storage.count("u") == 42
+
+
+@pytest.mark.parametrize("legacy", ["json", "jsonl"])
+def test_sqlite_imports_legacy_files(history_dir, legacy):
+    if legacy == "json":
+        (history_dir / "u.json").write_text(json.dumps({"messages": [message(0), message(1)]}))
+    else:
+        (history_dir / "u.jsonl").write_text("".join(json.dumps(msg) + "\n" for msg in [message(0), message(1)]))
+    storage = SqliteHistoryStorage(history_dir / "history.db", history_dir)
+    storage.ensure("u")
+
+    assert storage.read("u") == [message(0), message(1)]
+    assert (history_dir / f"u.{legacy}.migrated").exists()
+    # Imported once: a second process sees the rows and nothing to import
+    other = SqliteHistoryStorage(history_dir / "history.db", history_dir)
+    other.ensure("u")
+    assert other.read("u") == [message(0), message(1)]
+
+
+def test_sqlite_imports_legacy_file_once_under_concurrency(history_dir):
+    with open(history_dir / "u.jsonl", "w") as f:
+        for i in range(5):
+            f.write(json.dumps(message(i)) + "\n")
+    storages = [SqliteHistoryStorage(history_dir / "history.db", history_dir) for _ in range(4)]
+    threads = [threading.Thread(target=storage.ensure, args=("u",)) for storage in storages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert storages[0].read("u") == [message(i) for i in range(5)]
+    assert (history_dir / "u.jsonl.migrated").exists()
+
+
+def test_sqlite_sets_aside_legacy_file_without_importing_over_rows(history_dir):
+    storage = SqliteHistoryStorage(history_dir / "history.db", history_dir)
+    storage.append("u", message(0))
+    (history_dir / "u.json").write_text(json.dumps({"messages": [message(1)]}))
+
+    storage.ensure("u")
+
+    assert storage.read("u") == [message(0)]
+    assert (history_dir / "u.json.migrated").exists()
+
+
+def test_sqlite_remembers_a_bounded_number_of_checked_users(history_dir):
+    storage = SqliteHistoryStorage(history_dir / "history.db", history_dir)
+    storage.max_ensured_users = 2
+    for user_id in ("a", "b", "c"):
+        storage.ensure(user_id)
+    assert list(storage._ensured_users) == ["b", "c"]
+
+    # A forgotten user is checked again
+    (history_dir / "a.json").write_text(json.dumps({"messages": [message(0)]}))
+    storage.ensure("a")
+    assert storage.read("a") == [message(0)]
+
+
+@pytest.mark.parametrize("backend", ["json", "jsonl", "sqlite"])
+def test_chat_history_uses_the_configured_backend(monkeypatch, history_dir, backend):
+    monkeypatch.setenv("CHAT_HISTORY_BACKEND", backend)
+    ChatHistory("u").add_message("user", "m0", "2025-01-01T00:00:00")
+
+    assert (history_dir / ("history.db" if backend == "sqlite" else f"u.{backend}")).exists()
+    assert ChatHistory("u").get_messages() == [message(0)]
+    assert ChatHistory("u").get_messages_between(start="2025-01-01T00:00:00") == [message(0)]
+
+
+class FlakyStorage(HistoryStorage):
+    """In-memory storage whose writes fail while `failing` is set."""
+
+    def __init__(self):
+        self.failing = False
+        self.calls = 0
+        self.messages = []
+
+    def user_ids(self):
+        return ["u"] if self.messages else []
+
+    def read(self, user_id):
+        return list(self.messages)
+
+    def append(self, user_id, message):
+        self.append_many(user_id, [message])
+
+    def append_many(self, user_id, messages):
+        self.calls += 1
+        if self.failing:
+            raise OSError("disk full")
+        self.messages.extend(messages)
+
+    def clear(self, user_id):
+        self.messages.clear()
+
+
+def test_write_behind_merges_pending_messages(history_dir):
+    inner = JsonlHistoryStorage(history_dir)
+    storage = WriteBehindHistoryStorage(inner, batch_size=100, flush_interval=60)
+    storage.append("u", message(0))
+    storage.append_many("u", [message(1), message(2)])
+
+    assert inner.read("u") == []
+    assert storage.read("u") == [message(i) for i in range(3)]
+    assert contents(storage.tail("u", 2)) == ["m1", "m2"]
+    assert contents(storage.page("u", 10, before="2025-01-01T00:00:02")) == ["m0", "m1"]
+
+    storage.flush()
+    assert inner.read("u") == [message(i) for i in range(3)]
+    assert storage.read("u") == [message(i) for i in range(3)]
+
+
+def test_write_behind_flushes_full_batches_in_the_background(history_dir):
+    inner = JsonlHistoryStorage(history_dir)
+    storage = WriteBehindHistoryStorage(inner, batch_size=2, flush_interval=60)
+    storage.append_many("u", [message(0), message(1)])
+
+    deadline = time.monotonic() + 5
+    while not inner.read("u") and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert inner.read("u") == [message(0), message(1)]
+
+
+def test_write_behind_clear_drops_pending_messages(history_dir):
+    inner = JsonlHistoryStorage(history_dir)
+    inner.append("u", message(0))
+    storage = WriteBehindHistoryStorage(inner, batch_size=100, flush_interval=60)
+    storage.append("u", message(1))
+
+    storage.clear("u")
+    storage.flush()
+    assert storage.read("u") == [] and inner.read("u") == []
+
+
+def test_write_behind_backs_off_while_flushes_fail():
+    inner = FlakyStorage()
+    inner.failing = True
+    storage = WriteBehindHistoryStorage(inner, batch_size=1, flush_interval=0.05)
+    storage.append("u", message(0))
+    time.sleep(0.5)
+
+    # 0.05 + 0.1 + 0.2 seconds of backoff: a handful of attempts, not a busy loop
+    assert 1 <= inner.calls <= 6
+    assert storage.flush() is False
+    inner.failing = False
+    assert storage.flush() is True
+    assert inner.messages == [message(0)]
+
+
+def test_write_behind_writes_through_when_full():
+    inner = FlakyStorage()
+    inner.failing = True
+    storage = WriteBehindHistoryStorage(inner, batch_size=100, flush_interval=60, max_pending=3)
+    storage.append_many("u", [message(0), message(1), message(2)])
+
+    with pytest.raises(OSError):
+        storage.append("u", message(3))
+    assert storage.read("u") == [message(0), message(1), message(2)]
+
+    inner.failing = False
+    storage.append("u", message(3))
+    assert inner.messages == [message(i) for i in range(4)]
+    assert storage._pending_count == 0
+
+
+def test_write_behind_indexes_on_flush(monkeypatch, history_dir):
+    monkeypatch.setenv("CHAT_HISTORY_BACKEND", "jsonl")
+    monkeypatch.setenv("CHAT_HISTORY_WRITE_BEHIND", "1")
+    monkeypatch.setenv("CHAT_HISTORY_FLUSH_INTERVAL", "60")
+    monkeypatch.setenv("CHAT_HISTORY_SEARCH", "1")
+    from src.utils.search_index import get_search_index
+
+    ChatHistory("u").add_messages([{"role": "user", "content": "bomba de infusao", "timestamp": "2025-01-01T00:00:00"}])
+    assert get_search_index().search("bomba", user_id="u")["results"] == []
+
+    assert get_history_storage().flush() is True
+    assert len(get_search_index().search("bomba", user_id="u")["results"]) == 1
+
+
+def test_striped_locks_are_shared_by_key():
+    locks = StripedLocks(stripes=4)
+
+    assert locks.get("u") is locks.get("u")
+    assert len({id(locks.get(f"user-{i}")) for i in range(1000)}) <= 4
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from agents import Agent
+
+from src.utils.llm_backends import LLMBackend, MockLLMBackend
+from src.utils.usage import Usage
+
+
+def test_backends_must_implement_both_stages():
+    class TriageOnlyBackend(LLMBackend):
+        async def run_triage(self, triage, input_list, group_id, usage=None):
+            return triage, ""
+
+    with pytest.raises(TypeError, match="stream_specialist"):
+        TriageOnlyBackend()
+
+
+def specialist(name: str) -> Agent:
+    return Agent(name=name, instructions="")
+
+
+def triage_to(*names: str) -> Agent:
+    return Agent(name="triage", instructions="", handoffs=[specialist(name) for name in names])
+
+
+@pytest.mark.parametrize("text, expected", [
+    # "ces" is part of "processo" and "acesso", but not a word of the message
+    ("Qual o processo de acesso do RPD?", "especialista_rpd"),
+    ("Como configurar o Hidrovitális Master?", "especialista_hidrovitalis_master"),
+    ("Dúvida sobre o CES", "especialista_ces"),
+])
+def test_mock_triage_matches_whole_words(text, expected):
+    triage = triage_to("especialista_ces", "especialista_hidrovitalis_mini", "especialista_hidrovitalis_master", "especialista_rpd")
+    backend = MockLLMBackend(triage_latency=0)
+
+    agent, _ = asyncio.run(backend.run_triage(triage, [{"role": "user", "content": text}], "g"))
+
+    assert agent.name == expected
+
+
+def test_mock_specialist_records_usage_when_cancelled_before_the_first_token():
+    backend = MockLLMBackend(first_token_latency=10)
+    usage = Usage()
+
+    async def main():
+        stream = backend.stream_specialist(specialist("especialista_rpd"), [{"role": "user", "content": "ola"}], "g", usage)
+        try:
+            await asyncio.wait_for(stream.__anext__(), timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(main())
+    assert usage.requests == 1 and usage.output_tokens == 0
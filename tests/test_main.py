@@ -0,0 +1,54 @@
+import pytest
+
+from src.utils.resilience import CircuitOpenError, TurnFailedError
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """A logged-in test client whose chat turns fail."""
+    import main
+
+    def process_message(user_id, message, timestamp=None):
+        raise TurnFailedError(CircuitOpenError())
+
+    monkeypatch.setattr(main.openai_handler, "process_message", process_message)
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = {"id": "u", "email": "u@example.com"}
+    return client
+
+
+def test_api_chat_reports_a_failed_turn_as_an_error(client):
+    response = client.post("/api/chat", json={"message": "Como ligar o RPD?"})
+
+    assert response.status_code == 503
+    assert "response" not in response.get_json()
+    assert "temporarily unavailable" in response.get_json()["error"]
+
+
+def test_chat_form_keeps_the_message_of_a_failed_turn(client):
+    response = client.post("/chat", data={"message": "Como ligar o RPD?"})
+
+    assert response.status_code == 503
+    page = response.get_data(as_text=True)
+    assert "temporarily unavailable" in page
+    assert ">Como ligar o RPD?</textarea>" in page
+
+
+def test_admin_can_invalidate_the_response_cache(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    main.openai_handler.response_cache.set("especialista_rpd", "como ligar o rpd", "", "Aperte o botao")
+
+    assert client.post("/api/admin/cache/invalidate", json={"specialist": "especialista_rpd"}).status_code == 401
+    response = client.post(
+        "/api/admin/cache/invalidate",
+        json={"specialist": "especialista_rpd"},
+        headers={"X-Admin-Token": "secret"},
+    )
+    assert response.status_code == 200 and response.get_json() == {"removed": 1}
+    assert main.openai_handler.response_cache.get("especialista_rpd", "como ligar o rpd") is None
+
+    response = client.post("/api/admin/cache/invalidate", json={"specialist": "nobody"}, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 404
@@ -0,0 +1,406 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import message
+from src.utils.chat_history import ChatHistory
+from src.utils.openai_handler import EQUIPMENT_ALIASES, UPDATE_SPECIALIST, LocalRouter, Thread, ThreadsManager, summarize_message
+from src.utils.resilience import TurnFailedError
+
+
+class CountingBackend:
+    """Wraps the mock backend, counting triage and specialist calls."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.triage_calls = 0
+        self.specialist_calls = []
+        self.fail = False
+
+    async def run_triage(self, *args, **kwargs):
+        self.triage_calls += 1
+        return await self.backend.run_triage(*args, **kwargs)
+
+    def stream_specialist(self, agent, input_list, *args, **kwargs):
+        self.specialist_calls.append((agent.name, input_list))
+        if self.fail:
+            raise ValueError("upstream rejected the request")
+        return self.backend.stream_specialist(agent, input_list, *args, **kwargs)
+
+
+@pytest.fixture
+def backend(handler):
+    handler.backend = CountingBackend(handler.backend)
+    return handler.backend
+
+
+def ask(handler, user_id, text, timestamp=None):
+    return asyncio.run(handler.aprocess_message(user_id, text, timestamp))
+
+
+@pytest.fixture(scope="module")
+def router():
+    return LocalRouter(EQUIPMENT_ALIASES)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Como ligar o RPD?", "especialista_rpd"),
+    ("Qual a voltagem do color gen pro", "especialista_colorgenpro"),
+    ("Dúvida sobre o ColorGen", "especialista_colorgen"),
+    ("Como configurar o Hidrovitállis Master?", "especialista_hidrovitalis_master"),
+    ("Como atualizar o firmware do PC Zapper?", "especialista_atualizar_hidrovitallis_pczapper"),
+    ("Atualização do Hidrovitális", "especialista_atualizar_hidrovitallis_pczapper"),
+    ("Como usar o Hidrovitális?", None),
+    ("Posso usar o RPD junto com o NeuroSpa?", None),
+    ("Bom dia, preciso de ajuda", None),
+    ("O aparelho não liga", None),
+    ("Qual o processo de acesso?", None),
+])
+def test_local_router(router, text, expected):
+    assert router.route(text) == expected
+
+
+def test_every_route_is_a_specialist(handler):
+    names = {agente.name for agente in handler.assistente.handoffs}
+
+    assert set(EQUIPMENT_ALIASES) - {"hidrovitalis"} <= names
+    assert UPDATE_SPECIALIST in names
+
+
+def test_named_device_skips_triage(handler, backend):
+    reply = ask(handler, "u", "Como ligar o RPD?")
+
+    assert reply.startswith("[especialista_rpd]")
+    assert backend.triage_calls == 0
+    assert [name for name, _ in backend.specialist_calls] == ["especialista_rpd"]
+
+
+def test_follow_up_sticks_to_the_previous_specialist(handler, backend):
+    ask(handler, "u", "Como ligar o RPD?")
+    reply = ask(handler, "u", "E quanto tempo dura a sessão?")
+
+    assert reply.startswith("[especialista_rpd]")
+    assert backend.triage_calls == 0
+    # The follow-up was sent with the earlier turn
+    assert len(backend.specialist_calls[-1][1]) == 3
+
+
+def test_sticky_specialist_expires_after_max_turns(handler, backend):
+    handler.sticky_max_turns = 1
+    ask(handler, "u", "Como ligar o RPD?")
+    ask(handler, "u", "E quanto tempo dura a sessão?")
+    assert backend.triage_calls == 0
+
+    ask(handler, "u", "E qual a frequência?")
+    assert backend.triage_calls == 1
+
+
+def test_mentioning_another_device_leaves_the_sticky_specialist(handler, backend):
+    ask(handler, "u", "Como ligar o RPD?")
+    reply = ask(handler, "u", "E o NeuroSpa, como liga?")
+
+    assert reply.startswith("[especialista_neurospa]")
+
+
+def test_announcing_another_device_leaves_the_sticky_specialist(handler, backend):
+    ask(handler, "u", "Como ligar o RPD?")
+    ask(handler, "u", "Tenho uma dúvida sobre outro aparelho")
+
+    assert backend.triage_calls == 1
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Tenho uma dúvida sobre outro aparelho", True),
+    ("Mudando de assunto: qual a garantia?", True),
+    ("E a outra pergunta que fiz?", True),
+    ("E quanto tempo dura a sessão?", False),
+    ("Outra coisa: ele esquenta?", False),
+])
+def test_local_router_detects_topic_changes(router, text, expected):
+    assert router.changes_topic(text) is expected
+
+
+def test_identical_first_question_is_served_from_cache(handler, backend):
+    first = ask(handler, "u", "Como ligar o RPD?")
+    second = ask(handler, "v", "como ligar o  rpd")
+
+    assert second == first
+    assert len(backend.specialist_calls) == 1
+
+
+def test_cache_is_keyed_on_the_context_sent(handler, backend):
+    ask(handler, "u", "Como ligar o RPD?")
+    ask(handler, "u", "Qual a voltagem?")
+    # Same question, but after a different conversation
+    ask(handler, "v", "Como ligar o NeuroSpa?")
+    ask(handler, "v", "Qual a voltagem?")
+    # Same question after the same conversation
+    ask(handler, "w", "Como ligar o RPD?")
+    ask(handler, "w", "Qual a voltagem?")
+
+    assert len(backend.specialist_calls) == 4
+
+
+def test_cache_covers_earlier_turns_of_a_question_naming_its_device(handler, backend):
+    ask(handler, "u", "Como ligar o RPD?")
+    ask(handler, "u", "Como ligar o NeuroSpa?")
+    ask(handler, "v", "Qual a voltagem do RPD?")
+    ask(handler, "v", "Como ligar o NeuroSpa?")
+
+    # The NeuroSpa question was sent after a different conversation each time
+    assert len(backend.specialist_calls) == 4
+
+
+def test_concurrent_identical_questions_share_one_call(handler, backend):
+    backend.backend.first_token_latency = 0.2
+
+    async def main():
+        return await asyncio.gather(*(
+            handler.aprocess_message(user_id, "Como ligar o RPD?") for user_id in ("a", "b", "c")
+        ))
+
+    replies = asyncio.run(main())
+    assert len(set(replies)) == 1 and replies[0].startswith("[especialista_rpd]")
+    assert len(backend.specialist_calls) == 1
+    assert handler.single_flight.coalesced == 2
+    for user_id in ("a", "b", "c"):
+        assert [msg["role"] for msg in ChatHistory(user_id).get_messages()] == ["user", "assistant"]
+
+
+def test_failed_turn_leaves_no_history(handler, backend):
+    backend.fail = True
+    with pytest.raises(TurnFailedError, match="something went wrong") as failure:
+        ask(handler, "u", "Como ligar o RPD?")
+
+    assert failure.value.status_code == 500
+    assert ChatHistory("u").get_messages() == []
+    assert handler.admission.active == 0 and handler.admission._per_user == {}
+
+    backend.fail = False
+    ask(handler, "u", "Como ligar o RPD?")
+    # The failed question is not part of the next turn's context
+    assert len(backend.specialist_calls[-1][1]) == 1
+
+
+def test_abandoned_stream_releases_the_upstream_slot(handler, backend):
+    backend.backend.reply_tokens = 1000
+
+    async def main():
+        stream = handler.astream_message("u", "Como ligar o RPD?")
+        await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert handler.admission.active == 0
+    assert ChatHistory("u").get_messages() == []
+
+
+def test_triaged_turn_keeps_its_upstream_slot_for_the_specialist(handler, backend):
+    handler.admission.max_concurrent = 1
+    backend.backend.triage_latency = 0.1
+    backend.backend.first_token_latency = 0.1
+    finished = []
+
+    async def turn(user_id, text, delay):
+        await asyncio.sleep(delay)
+        await handler.aprocess_message(user_id, text)
+        finished.append(user_id)
+
+    async def main():
+        # "b" is routed locally and asks for a slot while "a" is in triage
+        await asyncio.gather(turn("a", "Bom dia, preciso de ajuda", 0), turn("b", "Como ligar o RPD?", 0.05))
+
+    asyncio.run(main())
+    assert backend.triage_calls == 1
+    assert finished == ["a", "b"]
+    assert handler.admission.active == 0
+
+
+def test_abandoned_triaged_stream_releases_the_upstream_slot(handler, backend):
+    backend.backend.reply_tokens = 1000
+
+    async def main():
+        stream = handler.astream_message("u", "Bom dia, preciso de ajuda")
+        await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert backend.triage_calls == 1
+    assert handler.admission.active == 0
+
+
+def test_router_matches_every_device_named(router):
+    assert router.match("RPD ou NeuroSpa?") == {"especialista_rpd", "especialista_neurospa"}
+    assert router.match("E quanto tempo dura a sessão?") == set()
+
+
+def test_upstream_slot_is_released_before_the_client_reads_everything(handler, backend):
+    async def main():
+        stream = handler.astream_message("u", "Como ligar o RPD?")
+        await stream.__anext__()
+        # The specialist has finished; the client has not read the rest yet
+        for _ in range(10):
+            await asyncio.sleep(0)
+        active = handler.admission.active
+        rest = [delta async for delta in stream]
+        return active, rest
+
+    active, rest = asyncio.run(main())
+    assert active == 0
+    assert len(rest) == 5
+
+
+def test_turns_with_tied_timestamps_keep_their_context(handler, backend):
+    handler.context_max_turns = 2
+    timestamp = "2025-01-01T00:00:00"
+    for i in range(4):
+        ask(handler, "u", f"Pergunta {i} sobre o RPD", timestamp)
+
+    input_list = backend.specialist_calls[-1][1]
+    assert input_list[0]["role"] == "system"
+    assert input_list[0]["content"].count("Pergunta") == 2
+    assert [item["content"] for item in input_list if item["role"] == "user"] == [
+        "Pergunta 2 sobre o RPD",
+        "Pergunta 3 sobre o RPD",
+    ]
+
+
+def test_sticky_agent_within_the_window():
+    thread = Thread("u")
+    assert thread.get_sticky_agent(900, 10) is None
+
+    agent = object()
+    thread.set_current_agent(agent)
+    assert thread.get_sticky_agent(900, 10) is agent
+    # Disabled
+    assert thread.get_sticky_agent(0, 10) is None
+    assert thread.get_sticky_agent(900, 0) is None
+
+    thread.set_current_agent(None)
+    assert thread.get_sticky_agent(900, 10) is None
+
+
+def test_sticky_agent_expires_after_max_turns():
+    thread = Thread("u")
+    agent = object()
+    thread.set_current_agent(agent)
+    thread.set_current_agent(agent, sticky=True)
+    assert thread.get_sticky_agent(900, 2) is agent
+
+    thread.set_current_agent(agent, sticky=True)
+    assert thread.get_sticky_agent(900, 2) is None
+    # Routing to it again starts a new window
+    thread.set_current_agent(agent)
+    assert thread.get_sticky_agent(900, 2) is agent
+
+
+def test_sticky_agent_expires_when_idle():
+    thread = Thread("u")
+    thread.set_current_agent(object())
+    thread.agent_updated_at = time.monotonic() - 120
+
+    assert thread.get_sticky_agent(60, 10) is None
+
+
+def test_invalidate_vector_store_drops_its_specialists_answers(handler):
+    handler.response_cache.set("especialista_rpd", "como ligar o rpd", "", "Aperte o botao")
+    handler.response_cache.set("especialista_neurospa", "como ligar o neurospa", "", "Gire o botao")
+
+    vector_store_id = handler.especialista_rpd.tools[0].vector_store_ids[0]
+    assert handler.invalidate_vector_store(vector_store_id) == 1
+    assert handler.response_cache.get("especialista_rpd", "como ligar o rpd") is None
+    assert handler.response_cache.get("especialista_neurospa", "como ligar o neurospa") == "Gire o botao"
+
+
+def test_threads_are_evicted_least_recently_used(monkeypatch):
+    monkeypatch.setenv("THREADS_MAX_COUNT", "2")
+    manager = ThreadsManager()
+    for user_id in ("a", "b", "a", "c"):
+        manager.get_or_create_thread(user_id)
+
+    assert list(manager.threads) == ["a", "c"]
+
+
+def test_idle_threads_are_evicted(monkeypatch):
+    monkeypatch.setenv("THREADS_IDLE_SECONDS", "60")
+    manager = ThreadsManager()
+    manager.get_or_create_thread("a").last_active = time.monotonic() - 120
+    manager.get_or_create_thread("b")
+
+    assert list(manager.threads) == ["b"]
+
+
+def conversation(turns):
+    """A conversation of `turns` answered questions, followed by the current one."""
+    contents = []
+    for i in range(turns):
+        contents += [("user", f"Pergunta {i}. Com detalhes."), ("assistant", f"Resposta {i}. Com detalhes.")]
+    contents.append(("user", "Pergunta atual"))
+    return [
+        {"role": role, "content": content, "timestamp": f"2025-01-01T00:{i // 60:02d}:{i % 60:02d}"}
+        for i, (role, content) in enumerate(contents)
+    ]
+
+
+def test_context_keeps_recent_turns_and_summarizes_older_ones():
+    thread = Thread("u")
+
+    input_list = thread.get_input_list(conversation(5), max_turns=2)
+    assert input_list[0] == {
+        "role": "system",
+        "content": "Resumo da conversa anterior:\n"
+        + "\n".join(f"Usuário: Pergunta {i}.\nAssistente: Resposta {i}." for i in range(4)),
+    }
+    assert [item["content"] for item in input_list[1:]] == [
+        "Pergunta 4. Com detalhes.", "Resposta 4. Com detalhes.", "Pergunta atual",
+    ]
+
+
+def test_context_respects_the_token_budget_but_keeps_the_current_message():
+    thread = Thread("u")
+    messages = conversation(3)[:-1]
+    messages.append({"role": "assistant", "content": "x" * 400, "timestamp": "2025-01-01T00:01:00"})
+    messages.append({"role": "user", "content": "y" * 400, "timestamp": "2025-01-01T00:01:01"})
+
+    input_list = thread.get_input_list(messages, token_budget=50)
+    assert input_list[-1] == {"role": "user", "content": "y" * 400}
+    # Never starts with a reply whose question was cut off
+    assert input_list[1]["role"] == "user"
+
+
+def test_summary_stays_within_its_budget():
+    thread = Thread("u")
+
+    thread.get_input_list(conversation(40), max_turns=1, summary_token_budget=50)
+    assert sum(len(line) // 4 + 1 for line in thread.summary_lines) <= 50
+    assert thread.summary_lines[-1] == "Assistente: Resposta 39."
+
+
+def test_summary_folds_each_message_once():
+    thread = Thread("u")
+    messages = [message(i, "2025-01-01T00:00:00", "user" if i % 2 == 0 else "assistant") for i in range(10)]
+
+    thread.get_input_list(messages[:6], 0, max_turns=1)
+    assert thread.summarized_until == 4
+    # Later turns see a window that starts further along the history
+    input_list = thread.get_input_list(messages[4:], 4, max_turns=1)
+
+    assert thread.summarized_until == 8
+    assert [line.split(": ")[1] for line in thread.summary_lines] == [f"m{i}" for i in range(8)]
+    assert [item["content"] for item in input_list[1:]] == ["m8", "m9"]
+
+
+def test_summary_resets_after_the_history_was_cleared():
+    thread = Thread("u")
+    thread.get_input_list([message(i) for i in range(6)], 0, max_turns=1)
+    assert thread.summary_lines
+
+    input_list = thread.get_input_list([message(0)], 0, max_turns=1)
+    assert thread.summary_lines == []
+    assert input_list == [{"role": "user", "content": "m0"}]
+
+
+def test_summarize_message_keeps_the_first_sentence():
+    assert summarize_message("Primeira frase. Segunda frase.") == "Primeira frase."
+    assert summarize_message("a" * 300, max_chars=10) == "aaaaaaaaaa..."
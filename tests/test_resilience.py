@@ -0,0 +1,155 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from src.utils.resilience import (
+    ERROR_MESSAGE,
+    UNAVAILABLE_MESSAGE,
+    CircuitBreaker,
+    CircuitOpenError,
+    Resilience,
+    StageTimeoutError,
+    TurnFailedError,
+    friendly_error,
+)
+
+
+def connection_error() -> openai.APIConnectionError:
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://test/v1/responses"))
+
+
+def make_stream(items, fail_after=None, error=None):
+    """Return a stream factory yielding `items`, failing after `fail_after` of them on each attempt."""
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+
+        async def stream():
+            for i, item in enumerate(items):
+                if i == fail_after:
+                    raise error
+                yield item
+
+        return stream()
+
+    factory.attempts = attempts
+    return factory
+
+
+async def collect(resilience, factory, first_item_timeout=1, timeout=1):
+    items = []
+    async for item in resilience.stream("specialist", factory, first_item_timeout=first_item_timeout, timeout=timeout):
+        items.append(item)
+    return items
+
+
+def test_call_retries_transient_errors():
+    resilience = Resilience(CircuitBreaker(), max_attempts=3, base_delay=0)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise connection_error()
+        return "ok"
+
+    assert asyncio.run(resilience.call("triage", flaky, timeout=1)) == "ok"
+    assert len(calls) == 3
+    assert resilience.breaker.failures == 0
+
+
+def test_call_times_out_each_attempt():
+    resilience = Resilience(CircuitBreaker(), max_attempts=2, base_delay=0)
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    with pytest.raises(StageTimeoutError):
+        asyncio.run(resilience.call("triage", slow, timeout=0.01))
+    assert resilience.breaker.failures == 1
+
+
+def test_stream_retries_before_the_first_item():
+    resilience = Resilience(CircuitBreaker(), max_attempts=3, base_delay=0)
+    factory = make_stream(["a", "b"], fail_after=0, error=connection_error())
+
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(collect(resilience, factory))
+    assert len(factory.attempts) == 3
+    assert resilience.breaker.failures == 1
+
+
+def test_stream_does_not_retry_after_the_first_item():
+    resilience = Resilience(CircuitBreaker(), max_attempts=3, base_delay=0)
+    factory = make_stream(["a", "b"], fail_after=1, error=connection_error())
+    items = []
+
+    async def main():
+        async for item in resilience.stream("specialist", factory, first_item_timeout=1, timeout=1):
+            items.append(item)
+
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(main())
+    assert items == ["a"]
+    assert len(factory.attempts) == 1
+    # A retryable upstream error counts against the breaker
+    assert resilience.breaker.failures == 1
+
+
+def test_stream_error_after_first_item_that_is_not_upstream_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.opened_at = 0.0  # long expired: half-open
+    resilience = Resilience(breaker, max_attempts=3, base_delay=0)
+    factory = make_stream(["a", "b"], fail_after=1, error=ValueError("bad item"))
+
+    with pytest.raises(ValueError):
+        asyncio.run(collect(resilience, factory))
+    assert breaker.failures == 0
+    assert breaker.trial_in_flight is False
+    assert breaker.state == "half-open"
+
+
+def test_stream_first_item_deadline():
+    resilience = Resilience(CircuitBreaker(), max_attempts=1, base_delay=0)
+
+    def factory():
+        async def stream():
+            await asyncio.sleep(1)
+            yield "late"
+
+        return stream()
+
+    with pytest.raises(StageTimeoutError):
+        asyncio.run(collect(resilience, factory, first_item_timeout=0.01, timeout=5))
+
+
+def test_breaker_opens_and_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.opened_at -= 60
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_friendly_error():
+    assert friendly_error(connection_error()) == UNAVAILABLE_MESSAGE
+    assert friendly_error(CircuitOpenError()) == UNAVAILABLE_MESSAGE
+    assert friendly_error(ValueError()) == ERROR_MESSAGE
+
+
+def test_turn_failed_error():
+    unavailable = TurnFailedError(connection_error())
+    assert str(unavailable) == UNAVAILABLE_MESSAGE and unavailable.status_code == 503
+    failed = TurnFailedError(ValueError("bug"))
+    assert str(failed) == ERROR_MESSAGE and failed.status_code == 500
@@ -0,0 +1,86 @@
+import json
+import time
+
+from src.utils.response_cache import ResponseCache
+
+
+def test_get_returns_what_was_set():
+    cache = ResponseCache()
+    cache.set("especialista_rpd", "como ligar o rpd", "", "Aperte o botao")
+
+    assert cache.get("especialista_rpd", "como ligar o rpd") == "Aperte o botao"
+    assert cache.get("especialista_rpd", "como ligar o rpd", "outro contexto") is None
+    assert cache.get("especialista_neurospa", "como ligar o rpd") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.set("s", "a", "", "A")
+    cache.set("s", "b", "", "B")
+    cache.get("s", "a")
+    cache.set("s", "c", "", "C")
+
+    assert cache.get("s", "b") is None
+    assert cache.get("s", "a") == "A"
+    assert cache.get("s", "c") == "C"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl_seconds=60)
+    cache.set("s", "a", "", "A")
+    key, (expires_at, response, stored_at) = next(iter(cache._entries.items()))
+    cache._entries[key] = (time.monotonic() - 1, response, stored_at)
+
+    assert cache.get("s", "a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(max_entries=0)
+    cache.set("s", "a", "", "A")
+
+    assert cache.get("s", "a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_invalidate_per_specialist():
+    cache = ResponseCache()
+    cache.set("s1", "a", "", "A")
+    cache.set("s1", "b", "", "B")
+    cache.set("s2", "a", "", "A")
+
+    assert cache.invalidate("s1") == 2
+    assert cache.get("s2", "a") == "A"
+    assert cache.invalidate() == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_invalidations_are_shared_through_the_file(tmp_path):
+    path = tmp_path / "invalidations.jsonl"
+    worker_a = ResponseCache(invalidations_path=path)
+    worker_b = ResponseCache(invalidations_path=path)
+    worker_b.set("s1", "a", "", "A")
+    worker_b.set("s2", "a", "", "A")
+
+    assert worker_a.invalidate("s1") == 0
+    assert worker_b.get("s1", "a") is None
+    assert worker_b.get("s2", "a") == "A"
+
+    time.sleep(0.01)
+    worker_b.set("s1", "a", "", "new")
+    assert worker_b.get("s1", "a") == "new"
+
+
+def test_partly_written_invalidation_is_read_once_complete(tmp_path):
+    path = tmp_path / "invalidations.jsonl"
+    cache = ResponseCache(invalidations_path=path)
+    cache.set("s", "a", "", "A")
+    record = json.dumps({"specialist": "s", "at": time.time()}) + "\n"
+
+    path.write_text(record[:10])
+    assert cache.get("s", "a") == "A"
+    path.write_text(record)
+    assert cache.get("s", "a") is None
@@ -0,0 +1,61 @@
+from src.utils.chat_history import ChatHistory, get_history_storage
+from src.utils.search_index import SearchIndex, get_search_index
+
+
+def add(index, user_id, *contents):
+    index.add_many(user_id, [
+        {"role": "user", "content": content, "timestamp": f"2025-01-01T00:00:{i:02d}"}
+        for i, content in enumerate(contents)
+    ])
+
+
+def test_search_ranks_and_highlights_matches(tmp_path):
+    index = SearchIndex(tmp_path / "search.db")
+    add(index, "u", "A bomba de infusão não liga", "Bomba, bomba, bomba de infusão", "Outro assunto")
+
+    results = index.search("bomba")["results"]
+    assert len(results) == 2
+    assert results[0]["timestamp"] == "2025-01-01T00:00:01"
+    assert "<mark>Bomba</mark>" in results[0]["snippet"]
+
+
+def test_search_ignores_accents_and_fts_syntax(tmp_path):
+    index = SearchIndex(tmp_path / "search.db")
+    add(index, "u", "Atualização do Hidrovitális", "<script>")
+
+    assert len(index.search("atualizacao hidrovitalis")["results"]) == 1
+    assert index.search('"bomba OR NEAR(')["results"] == []
+    assert index.search("   ")["results"] == []
+    assert index.search("script")["results"][0]["snippet"] == "&lt;<mark>script</mark>&gt;"
+
+
+def test_search_pages_and_scopes_to_a_user(tmp_path):
+    index = SearchIndex(tmp_path / "search.db")
+    add(index, "u", *(f"bomba {i}" for i in range(3)))
+    add(index, "u2", "bomba")
+
+    first = index.search("bomba", user_id="u", limit=2)
+    assert len(first["results"]) == 2 and first["next_offset"] == 2
+    second = index.search("bomba", user_id="u", limit=2, offset=2)
+    assert len(second["results"]) == 1 and second["next_offset"] is None
+    assert {result["user_id"] for result in index.search("bomba")["results"]} == {"u", "u2"}
+
+    index.clear("u")
+    assert [result["user_id"] for result in index.search("bomba")["results"]] == ["u2"]
+
+
+def test_chat_history_feeds_the_index(monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_SEARCH", "1")
+    ChatHistory("u").add_message("user", "bomba de infusao", "2025-01-01T00:00:00")
+
+    assert len(get_search_index().search("bomba", user_id="u")["results"]) == 1
+    ChatHistory("u").clear_history()
+    assert get_search_index().search("bomba", user_id="u")["results"] == []
+
+
+def test_rebuild_indexes_the_stored_history(tmp_path):
+    ChatHistory("u").add_message("user", "bomba de infusao", "2025-01-01T00:00:00")
+    index = SearchIndex(tmp_path / "search.db")
+
+    assert index.rebuild(get_history_storage()) == 1
+    assert len(index.search("bomba")["results"]) == 1
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from src.utils.single_flight import FlightAborted, SingleFlight
+
+
+def test_waiters_get_the_leaders_result():
+    flight = SingleFlight()
+
+    async def main():
+        assert flight.join("k") is None
+        flight.lead("k")
+        waiters = [flight.join("k") for _ in range(2)]
+        flight.finish("k", result="answer")
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(main()) == ["answer", "answer"]
+    assert flight.coalesced == 2
+
+
+def test_waiters_get_the_leaders_error():
+    flight = SingleFlight()
+
+    async def main():
+        flight.lead("k")
+        waiter = flight.join("k")
+        flight.finish("k", error=ValueError("bad"))
+        with pytest.raises(ValueError):
+            await waiter
+        # Finished calls are forgotten
+        assert flight.join("k") is None
+
+    asyncio.run(main())
+
+
+def test_cancelled_leader_lets_waiters_run_themselves():
+    flight = SingleFlight()
+
+    async def main():
+        flight.lead("k")
+        waiter = flight.join("k")
+        flight.finish("k", error=asyncio.CancelledError())
+        with pytest.raises(FlightAborted):
+            await waiter
+
+    asyncio.run(main())
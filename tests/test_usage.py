@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from src.utils.admission import QuotaExceededError
+from src.utils.usage import Usage, UsageStore
+
+
+def usage(input_tokens, output_tokens, cached_input_tokens=0):
+    run = Usage()
+    run.add(requests=1, input_tokens=input_tokens, cached_input_tokens=cached_input_tokens, output_tokens=output_tokens)
+    return run
+
+
+def test_usage_is_aggregated_per_day_user_and_agent(tmp_path):
+    store = UsageStore(tmp_path / "usage.db")
+    store.record("u", "triage", usage(100, 10), day="2025-01-01")
+    store.record("u", "triage", usage(50, 5), day="2025-01-01")
+    store.record("u", "especialista_rpd", usage(200, 20), day="2025-01-01")
+    store.record("u", "triage", usage(1, 1), day="2025-01-02")
+    store.record("v", "triage", usage(7, 7), day="2025-01-01")
+
+    assert store.tokens_for_day("u", "2025-01-01") == 385
+    assert store.tokens_for_day("u", "2025-01-03") == 0
+    rows = store.summary(["agent"], start="2025-01-01", end="2025-01-01", user_id="u")
+    assert [(row["agent"], row["requests"], row["input_tokens"]) for row in rows] == [
+        ("especialista_rpd", 1, 200), ("triage", 2, 150),
+    ]
+
+
+def test_cost_is_computed_from_the_prices(tmp_path):
+    store = UsageStore(tmp_path / "usage.db", input_cost=2, cached_input_cost=1, output_cost=10)
+    store.record("u", "triage", usage(1_000_000, 100_000, cached_input_tokens=500_000))
+
+    [row] = store.summary([])
+    assert row["cost"] == pytest.approx(0.5 * 2 + 0.5 * 1 + 0.1 * 10)
+
+
+def test_turns_are_recorded_and_the_quota_enforced(handler):
+    asyncio.run(handler.aprocess_message("u", "Como ligar o RPD?"))
+    assert [row["agent"] for row in handler.usage_store.summary(["agent"])] == ["especialista_rpd"]
+
+    handler.daily_token_quota = handler.usage_store.tokens_for_day("u")
+
+    with pytest.raises(QuotaExceededError):
+        handler.check_admission("u")
+    # Other users are not affected
+    handler.check_admission("v")